@@ -0,0 +1,104 @@
+import gc
+import hashlib
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from catalog import Catalog
+from search_index import TrigramIndex
+
+
+# The catalog layout before peer ids, kept here for comparison: a dict of publisher records per file,
+# each publication with its own ("username", ip, tcp_port) tuple, and per-username dicts for liveness
+# and content hashes. Only what publishing touches is reproduced.
+class DictCatalog:
+    def __init__(self):
+        self.files = {}                                                             # Format: {filename: {"username": ("username", ip, tcp_port)}}
+        self.user_files = {}                                                        # Format: {"username": {filename: None}}
+        self.search_index = TrigramIndex()
+        self.live_users = set()
+        self.live_publishers = {}                                                   # Format: {filename: {"username": None}}
+        self.content_hashes = {}                                                    # Format: {filename: {"username": content hash}}
+        self.hash_files = {}                                                        # Format: {content hash: {filename: {"username": None}}}
+
+    def peer_online(self, username):
+        self.live_users.add(username)
+
+    def publish(self, filename, username, ip, tcp_port, content_hash=None):
+        publishers = self.files.get(filename)
+        if publishers is None:
+            publishers = self.files[filename] = {}
+            self.search_index.add(filename)
+        elif username in publishers:
+            return False
+
+        publishers[username] = (username, ip, tcp_port)
+        self.user_files.setdefault(username, {})[filename] = None
+        if content_hash is not None:
+            self.content_hashes.setdefault(filename, {})[username] = content_hash
+            self.hash_files.setdefault(content_hash, {}).setdefault(filename, {})[username] = None
+        if username in self.live_users:
+            self.live_publishers.setdefault(filename, {})[username] = None
+        return True
+
+
+# Stands in for the search index when measuring the catalog maps alone
+class NoIndex:
+    def add(self, filename):
+        pass
+
+
+def resident_bytes():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+# Publish files x publishers into a fresh catalog of the given layout, every user online, and put
+# (MB held, seconds) on results. Strings are built anew for each publication, as they are when
+# decoded from a request, so only the catalog itself can share them.
+def build(layout, with_index, files, publishers, users, results):
+    gc.disable()
+    before = resident_bytes()
+    catalog = Catalog() if layout == "peer ids" else DictCatalog()
+    if not with_index:
+        catalog.search_index = NoIndex()
+
+    for user in range(users):
+        catalog.peer_online(f"user{user}")
+
+    start = time.perf_counter()
+    for file in range(files):
+        content_hash = hashlib.sha256(file.to_bytes(4, "big")).digest()
+        for publisher in range(publishers):
+            user = (file * 7 + publisher * 131) % users
+            catalog.publish(f"music/artist_{file % 5000:04d}/track_{file:07d}.mp3", f"user{user}",
+                            f"10.{user >> 16 & 255}.{user >> 8 & 255}.{user & 255}", 6000 + user % 1000,
+                            content_hash.hex())
+    results.put(((resident_bytes() - before) / 1e6, time.perf_counter() - start))
+
+
+# Usage: bench_catalog_memory.py [files] [publishers per file] [users]
+def main():
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    publishers = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    users = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+
+    print(f"{files} files x {publishers} publishers from {users} users, every publication with a content hash")
+    print(f"{'layout':<14}{'search index':<14}{'RSS MB':>10}{'bytes/publication':>19}{'publish s':>11}")
+    for with_index in (False, True):
+        for layout in ("dicts", "peer ids"):
+            # A process per run, so each starts from an empty heap
+            results = multiprocessing.Queue()
+            process = multiprocessing.Process(target=build, args=(layout, with_index, files, publishers, users, results))
+            process.start()
+            megabytes, seconds = results.get()
+            process.join()
+            print(f"{layout:<14}{'yes' if with_index else 'no':<14}{megabytes:>10.0f}"
+                  f"{megabytes * 1e6 / (files * publishers):>19.0f}{seconds:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+import gc
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from catalog import Catalog
+from catalog_store import CatalogStore, write_snapshot
+
+
+# Catalog of files spread over users, each published by publishers peers, every other one with a content hash
+def build_catalog(files, publishers, users=2000):
+    catalog = Catalog()
+    for i in range(files):
+        for j in range(publishers):
+            user = (i + j * 7919) % users
+            catalog.publish(f"share/dir{i % 1000}/file_{i:07d}.dat", f"user{user}", f"10.0.{user // 250}.{user % 250}",
+                            50000 + user % 100, f"{i:064x}" if i % 2 else None)
+    return catalog
+
+
+def main():
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    publishers = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    journal_records = int(sys.argv[3]) if len(sys.argv) > 3 else 100_000
+    directory = tempfile.mkdtemp(prefix="bench_catalog_store_")
+
+    try:
+        start = time.perf_counter()
+        gc.disable()
+        catalog = build_catalog(files, publishers)
+        gc.enable()
+        print(f"built {files} files x {publishers} publishers in {time.perf_counter() - start:.2f}s")
+
+        start = time.perf_counter()
+        write_snapshot(catalog, os.path.join(directory, "snapshot"), 0)
+        size = os.path.getsize(os.path.join(directory, "snapshot"))
+        print(f"snapshot written in {time.perf_counter() - start:.2f}s ({size / 1e6:.1f} MB)")
+        del catalog
+        gc.collect()
+
+        # Journal records on top of the snapshot, as a server would leave them between compactions
+        extra = Catalog()
+        store = CatalogStore(directory)
+        store.segment = 1
+        store._open_segment()
+        extra.journal = store
+        for i in range(journal_records):
+            extra.publish(f"fresh/file_{i:07d}.dat", f"user{i % 2000}", "10.1.0.1", 50000, f"{i:064x}")
+        store.close()
+
+        restored = Catalog()
+        start = time.perf_counter()
+        loaded, replayed = CatalogStore(directory).open(restored)
+        opened = time.perf_counter() - start
+        print(f"restored {loaded} publications + {replayed} journal records in {opened:.2f}s "
+              f"({loaded / max(opened, 1e-9) / 1e6:.2f}M publications/s overall)")
+
+        start = time.perf_counter()
+        restored.warm_search_index()
+        print(f"search index filled in {time.perf_counter() - start:.2f}s (in the background on a live server)")
+
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
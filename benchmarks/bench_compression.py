@@ -0,0 +1,116 @@
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transfer import fetch_range, parse_encoded_range_request, parse_range_request, read_header, serve_range
+
+LEVELS = ["DEBUG", "INFO", "INFO", "INFO", "WARNING", "ERROR"]
+EVENTS = ["request served", "cache miss", "peer joined", "lease renewed", "chunk verified", "upload finished"]
+
+
+# Total bytes put on the wire by the uploader. served is set once the server has finished a transfer,
+# since the downloader can have every byte before the server has recorded the last of them.
+class WireCounter:
+    def __init__(self):
+        self.total = 0
+        self.served = threading.Event()
+
+    def add(self, byte_count):
+        self.total += byte_count
+
+
+# Log lines: repetitive text of the kind that dominates transfers of logs and dumps
+def make_log(path, size):
+    rng = random.Random(1)
+    with open(path, "w") as file:
+        written = 0
+        while written < size:
+            line = (f"2026-10-17T{rng.randrange(24):02d}:{rng.randrange(60):02d}:{rng.randrange(60):02d}.{rng.randrange(1000):03d} "
+                    f"{rng.choice(LEVELS)} {rng.choice(EVENTS)} peer=10.0.{rng.randrange(256)}.{rng.randrange(256)}:"
+                    f"{rng.randrange(6000, 7000)} bytes={rng.randrange(1 << 20)} ms={rng.random() * 50:.3f}\n")
+            written += file.write(line)
+
+
+# Random bytes: stands in for archives and media, which compression cannot shrink
+def make_random(path, size):
+    with open(path, "wb") as file:
+        for offset in range(0, size, 1024 * 1024):
+            file.write(os.urandom(min(1024 * 1024, size - offset)))
+
+
+# Serve range requests on a listening socket, counting the bytes each upload puts on the wire
+def serve(listener, directory, counter):
+    while True:
+        conn, _ = listener.accept()
+        try:
+            with conn:
+                request = conn.recv(1024)
+                header, _ = read_header(conn, request)
+                if header.startswith("DOWNLOAD_RANGE_ENC "):
+                    filename, offset, length, encodings = parse_encoded_range_request(header)
+                else:
+                    (filename, offset, length), encodings = parse_range_request(header), None
+                serve_range(conn, os.path.join(directory, filename), offset, length, counter, encodings)
+        finally:
+            counter.served.set()
+
+
+# Download a file count times into a discarding sink; returns (fastest seconds, wire bytes per download)
+def run(port, filename, count, encodings, counter):
+    sink = open(os.devnull, "wb")
+    best = float("inf")
+    counter.total = 0
+
+    for _ in range(count):
+        counter.served.clear()
+        start = time.perf_counter()
+        size, _, written = fetch_range("127.0.0.1", port, filename, 0, None, sink, encodings=encodings)
+        best = min(best, time.perf_counter() - start)
+        assert written == size, f"short transfer of {filename}"
+        counter.served.wait()
+
+    sink.close()
+    return best, counter.total / count
+
+
+# Usage: bench_compression.py [size in MB] [link Mbit/s]
+# Throughput is measured over loopback, where the CPU is the limit. "at link" estimates a download
+# over a link of the given speed, taking the slower of the measured time and the wire bytes' transfer time.
+def main():
+    size = int(float(sys.argv[1]) * 1024 * 1024) if len(sys.argv) > 1 else 64 * 1024 * 1024
+    link = float(sys.argv[2]) if len(sys.argv) > 2 else 100.0
+    directory = tempfile.mkdtemp(prefix="bench_compression_")
+    counter = WireCounter()
+
+    listener = socket.create_server(("127.0.0.1", 0))
+    port = listener.getsockname()[1]
+    threading.Thread(target=serve, args=(listener, directory, counter), daemon=True).start()
+
+    try:
+        make_log(os.path.join(directory, "log.txt"), size)
+        make_random(os.path.join(directory, "random.bin"), size)
+        count = max(1, min(10, (256 * 1024 * 1024) // size))
+
+        print(f"{size // (1024 * 1024)} MB files, best of {count}; 'at link' is the estimated seconds over {link:g} Mbit/s")
+        print(f"{'file':<12}{'transfer':<10}{'MB/s':>9}{'wire MB':>10}{'ratio':>8}{'at link s':>11}")
+        for filename in ("log.txt", "random.bin"):
+            for label, encodings in (("raw", ()), ("zlib", ("zlib",))):
+                seconds, wire = run(port, filename, count, encodings, counter)
+                at_link = max(seconds, wire * 8 / (link * 1e6))
+                print(f"{filename:<12}{label:<10}{size / seconds / 1e6:>9.1f}{wire / 1e6:>10.1f}"
+                      f"{wire / size:>8.3f}{at_link:>11.2f}")
+    finally:
+        listener.close()
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+
+if __name__ == "__main__":
+    main()
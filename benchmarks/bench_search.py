@@ -0,0 +1,66 @@
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from search_index import TrigramIndex
+
+EXTENSIONS = [".mp4", ".iso", ".txt", ".pdf", ".mp3", ".tar.gz", ".jpg"]
+SYLLABLES = ["ka", "lo", "mi", "ne", "ru", "sa", "to", "vi", "ze", "qua", "bri", "dro", "fen", "gul", "hox"]
+QUERIES = [".mp4", ".iso", "a", "_20", "kalo", "brifen", "ubuntu", "zzq"]
+
+
+# Build a synthetic catalog of unique filenames from a vocabulary of made-up words
+def make_filenames(count, seed=1):
+    rng = random.Random(seed)
+    words = ["".join(rng.choices(SYLLABLES, k=rng.randint(2, 4))) for _ in range(2000)]
+    filenames = {}
+
+    while len(filenames) < count:
+        stem = "_".join(rng.sample(words, 2)) + f"_{rng.randint(1990, 2024)}"
+        tag = "".join(rng.choices(string.ascii_lowercase + string.digits, k=6))
+        filenames[f"{stem}_{tag}{rng.choice(EXTENSIONS)}"] = None
+
+    return list(filenames)
+
+
+# The pre-index behaviour of handle_search_files: test every filename
+def linear_search(filenames, substring):
+    return [filename for filename in filenames if substring in filename]
+
+
+# Average seconds per call over the given number of repeats
+def time_call(function, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        function()
+    return (time.perf_counter() - start) / repeats
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    filenames = make_filenames(count)
+
+    start = time.perf_counter()
+    index = TrigramIndex()
+    for filename in filenames:
+        index.add(filename)
+    print(f"Indexed {count} filenames in {time.perf_counter() - start:.2f}s")
+
+    print(f"{'query':<12}{'matches':>10}{'linear ms':>12}{'index ms':>12}{'speedup':>10}")
+    for query in QUERIES:
+        expected = linear_search(filenames, query)
+        assert index.search(query) == expected, f"index results differ for {query!r}"
+
+        linear = time_call(lambda: linear_search(filenames, query), repeats)
+        indexed = time_call(lambda: index.search(query), repeats)
+        print(f"{query:<12}{len(expected):>10}{linear * 1000:>12.2f}{indexed * 1000:>12.2f}{linear / indexed:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transfer import copy_file_buffered, stream_file
+
+
+# The original send_file loop: 1 KB reads and one sendall per chunk
+def legacy_send(conn, file):
+    sent = 0
+    while (chunk := file.read(1024)):
+        conn.sendall(chunk)
+        sent += len(chunk)
+    return sent
+
+
+# Accept one connection and drain it, recording the byte count
+def drain(listener, result):
+    conn, _ = listener.accept()
+    with conn:
+        buffer = bytearray(1024 * 1024)
+        total = 0
+        while (read := conn.recv_into(buffer)):
+            total += read
+    result.append(total)
+
+
+# Send the file over loopback TCP with the given sender; returns (wall seconds, sender CPU seconds)
+def run(sender, path, size):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as listener:
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        result = []
+        receiver = threading.Thread(target=drain, args=(listener, result))
+        receiver.start()
+
+        with socket.create_connection(listener.getsockname()) as conn, open(path, "rb") as file:
+            start, cpu_start = time.perf_counter(), time.thread_time()
+            sent = sender(conn, file)
+            wall, cpu = time.perf_counter() - start, time.thread_time() - cpu_start
+
+        receiver.join()
+
+    assert sent == size and result == [size], "short transfer"
+    return wall, cpu
+
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    size = size_mb * 1024 * 1024
+
+    senders = [
+        ("legacy 1 KB loop", legacy_send),
+        ("buffered 256 KB", copy_file_buffered),
+        ("zero-copy sendfile", stream_file),
+    ]
+
+    with tempfile.NamedTemporaryFile(delete=False) as file:
+        block = os.urandom(1024 * 1024)
+        for _ in range(size_mb):
+            file.write(block)
+        path = file.name
+
+    try:
+        print(f"Sending {size_mb} MB over loopback TCP")
+        print(f"{'sender':<22}{'MB/s':>10}{'sender CPU s':>15}")
+        for name, sender in senders:
+            run(sender, path, size)  # Warm the page cache
+            wall, cpu = run(sender, path, size)
+            print(f"{name:<22}{size_mb / wall:>10.1f}{cpu:>15.3f}")
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+import multiprocessing
+import os
+import random
+import selectors
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Files published before the run, and the sockets each client process keeps a request in flight on
+FILES = 10_000
+SOCKETS_PER_CLIENT = 16
+
+
+def request(sock, message):
+    sock.sendto(message.encode(), sock.getpeername())
+    return sock.recv(65535).decode()
+
+
+# Client process: log in as its own user, then keep one QUERY_FILE in flight on every socket for
+# duration seconds (a closed loop, so throughput is what the server sustains). Puts the reply count on results.
+def drive(port, user, duration, results):
+    control = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    control.connect(("127.0.0.1", port))
+    control.settimeout(5)
+    request(control, f"#1 AUTH {user} secret")
+
+    selector = selectors.DefaultSelector()
+    tags = {}                                                                       # Format: {socket: next tag}
+    for _ in range(SOCKETS_PER_CLIENT):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.connect(("127.0.0.1", port))
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ)
+        tags[sock] = 1
+
+    def send(sock):
+        sock.send(f"#{tags[sock]} QUERY_FILE file_{random.randrange(FILES):06d}.dat {user}".encode())
+        tags[sock] += 1
+
+    for sock in tags:
+        send(sock)
+
+    replies = 0
+    start = last_heartbeat = time.perf_counter()
+    while (now := time.perf_counter()) - start < duration:
+        if now - last_heartbeat > 1:
+            control.send(f"HEARTBEAT {user}".encode())
+            last_heartbeat = now
+
+        events = selector.select(0.2)
+        for key, _ in events:
+            key.fileobj.recv(65535)
+            replies += 1
+            send(key.fileobj)
+
+        # A lost datagram would stall its socket, so resend on any socket that has gone quiet
+        if not events:
+            for sock in tags:
+                send(sock)
+
+    results.put(replies)
+
+
+def run(workers, clients, duration, directory):
+    port = random.randint(40000, 50000)
+    mode = ["async"] if workers == 0 else ["sharded", str(workers)]
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT, "server.py"), str(port), *mode], cwd=directory,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                              env=dict(os.environ, CATALOG_STATE_DIR="",
+                                       CREDENTIALS_PATH=os.path.join(directory, "credentials.txt")))
+
+    try:
+        time.sleep(1 + 0.2 * workers)
+
+        publisher = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        publisher.connect(("127.0.0.1", port))
+        publisher.settimeout(5)
+        request(publisher, "#1 AUTH publisher secret")
+        names = [f"file_{i:06d}.dat" for i in range(FILES)]
+        for tag, first in enumerate(range(0, FILES, 500), 2):
+            request(publisher, f"#{tag} PUBLISH_BATCH publisher 6000  " + "\n".join(names[first:first + 500]))
+
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=drive, args=(port, f"user{i}", duration, results))
+                     for i in range(clients)]
+        for process in processes:
+            process.start()
+
+        # Keep the publisher's lease alive so its files stay visible
+        deadline = time.perf_counter() + duration + 2
+        while time.perf_counter() < deadline:
+            publisher.send(b"HEARTBEAT publisher")
+            time.sleep(1)
+
+        replies = sum(results.get() for _ in processes)
+        for process in processes:
+            process.join()
+        return replies / duration
+
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    worker_counts = [int(count) for count in sys.argv[1].split(",")] if len(sys.argv) > 1 else [0, 1, 2, 4]
+    clients = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    duration = float(sys.argv[3]) if len(sys.argv) > 3 else 5.0
+    directory = tempfile.mkdtemp(prefix="bench_sharding_")
+
+    try:
+        with open(os.path.join(directory, "credentials.txt"), "w") as credentials:
+            credentials.writelines(f"{user} secret\n" for user in ["publisher", *(f"user{i}" for i in range(clients))])
+
+        print(f"{os.cpu_count()} CPUs, {clients} client processes x {SOCKETS_PER_CLIENT} sockets, QUERY_FILE over {FILES} files")
+        print(f"{'server':<16}{'requests/s':>12}")
+        for workers in worker_counts:
+            label = "async" if workers == 0 else f"sharded x{workers}"
+            print(f"{label:<16}{run(workers, clients, duration, directory):>12.0f}")
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import contextlib
+import io
+import multiprocessing
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import client
+from manifest import compute_manifest
+
+# Bytes moved per file size, so small files are fetched many times and large ones a few
+BYTES_PER_SIZE = 256 * 1024 * 1024
+
+
+# Peer process: serve the files in directory with the client's own file server
+def serve(directory, port):
+    os.chdir(directory)
+    sys.stdout = open(os.devnull, "w")                                              # send_file prints a line per upload
+    client.start_file_server(port)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# Download a file count times with download_file_from_peer; returns seconds per download
+def run(filename, port, count, manifest):
+    timings = []
+    for _ in range(count):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            done = client.download_file_from_peer(filename, "127.0.0.1", port, manifest)
+            timings.append(time.perf_counter() - start)
+        assert done, f"download of {filename} failed"
+        os.remove(filename)
+    return min(timings), sum(timings) / len(timings)
+
+
+# Usage: bench_transfer.py [sizes in KB, comma-separated]
+def main():
+    sizes = [int(size) * 1024 for size in sys.argv[1].split(",")] if len(sys.argv) > 1 else \
+        [64 * 1024, 1024 * 1024, 16 * 1024 * 1024, 256 * 1024 * 1024]
+    served = tempfile.mkdtemp(prefix="bench_transfer_peer_")
+    downloads = tempfile.mkdtemp(prefix="bench_transfer_get_")
+    port = free_port()
+    peer = multiprocessing.Process(target=serve, args=(served, port), daemon=True)
+    peer.start()
+    cwd = os.getcwd()
+
+    try:
+        manifests = {}
+        for size in sizes:
+            filename = f"file_{size}.bin"
+            with open(os.path.join(served, filename), "wb") as file:
+                for offset in range(0, size, 1024 * 1024):
+                    file.write(os.urandom(min(1024 * 1024, size - offset)))
+            manifests[filename] = compute_manifest(os.path.join(served, filename))
+
+        os.chdir(downloads)
+        time.sleep(0.5)                                                             # Let the file server start listening
+
+        # MB/s from the fastest download of each size, ms/file the mean; verified downloads check every chunk against the manifest
+        print(f"{'size':>10}{'files':>7}{'plain MB/s':>12}{'ms/file':>9}{'verified MB/s':>15}{'ms/file':>9}")
+        for size in sizes:
+            filename = f"file_{size}.bin"
+            count = max(1, min(200, BYTES_PER_SIZE // size))
+            best, mean = run(filename, port, count, None)
+            verified_best, verified_mean = run(filename, port, count, manifests[filename])
+            print(f"{size // 1024:>8}KB{count:>7}{size / best / 1e6:>12.1f}{mean * 1000:>9.2f}"
+                  f"{size / verified_best / 1e6:>15.1f}{verified_mean * 1000:>9.2f}")
+    finally:
+        os.chdir(cwd)
+        peer.terminate()
+        shutil.rmtree(served)
+        shutil.rmtree(downloads)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+import hashlib
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import wire
+from server import paginate, parse_publish, parse_query, read_request, split_paging
+
+# Fields of the PUBLISH case: username, filename, tcp port and the manifest's content hash
+PUBLISH_FIELDS = ("yoda", "holiday_photos_0001.jpg", 55001, hashlib.sha256(b"holiday_photos_0001.jpg").hexdigest())
+
+
+# Server-side parse of a text request, as dispatch_request does it: decode, tag, paging, fields
+def parse_text(data, parse):
+    tag, command, message, _ = read_request(data)
+    if command in wire.PAGED_COMMANDS:
+        message, _ = split_paging(message)
+    return parse(message)
+
+
+def parse_binary(data):
+    return read_request(data)
+
+
+def run(function, number):
+    seconds = min(timeit.repeat(function, number=number, repeat=9))
+    return seconds / number * 1e9
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    items = [f"holiday_photos_{i:04d}.jpg" for i in range(40)]
+    pages, position = paginate("FOUND_FILES", items, 0, 1400)
+    page_fields = (1, len(pages), len(items), wire.NO_CURSOR if position >= len(items) else position, pages[0])
+    page_text = f"#42 FOUND_FILES PAGE {page_fields[0]} {page_fields[1]} {page_fields[2]} - {', '.join(pages[0])}"
+
+    cases = [
+        ("PUBLISH request",
+         f"#42 {wire.format_text_request('PUBLISH', PUBLISH_FIELDS)}".encode(),
+         wire.encode_request(42, "PUBLISH", PUBLISH_FIELDS),
+         lambda data: parse_text(data, parse_publish), parse_binary,
+         lambda: f"#42 {wire.format_text_request('PUBLISH', PUBLISH_FIELDS)}".encode(),
+         lambda: wire.encode_request(42, "PUBLISH", PUBLISH_FIELDS)),
+        ("SEARCH_FILES request",
+         f"#42 {wire.format_text_request('SEARCH_FILES', ('photo', 'yoda', 0, 1400))}".encode(),
+         wire.encode_request(42, "SEARCH_FILES", ("photo", "yoda", 0, 1400)),
+         lambda data: parse_text(data, parse_query), parse_binary,
+         lambda: f"#42 {wire.format_text_request('SEARCH_FILES', ('photo', 'yoda', 0, 1400))}".encode(),
+         lambda: wire.encode_request(42, "SEARCH_FILES", ("photo", "yoda", 0, 1400))),
+        (f"FOUND_FILES page ({len(pages[0])} items)",
+         page_text.encode(),
+         wire.encode_reply(42, "FOUND_FILES", page_fields),
+         lambda data: wire.parse_text_reply(data.decode().partition(" ")[2]), wire.decode_reply,
+         lambda: f"#42 FOUND_FILES PAGE 1 1 {len(items)} - {', '.join(pages[0])}".encode(),
+         lambda: wire.encode_reply(42, "FOUND_FILES", page_fields)),
+    ]
+
+    print(f"{'message':<28}{'bytes text/bin':>16}{'parse ns text/bin':>22}{'build ns text/bin':>22}")
+    for label, text, binary, parse_text_case, parse_binary_case, build_text, build_binary in cases:
+        parse_t = run(lambda: parse_text_case(text), number)
+        parse_b = run(lambda: parse_binary_case(binary), number)
+        build_t = run(build_text, number)
+        build_b = run(build_binary, number)
+        print(f"{label:<28}{len(text):>8}/{len(binary):<7}{parse_t:>13.0f}/{parse_b:<8.0f}{build_t:>13.0f}/{build_b:<8.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,358 @@
+import asyncio
+import heapq
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import wire
+
+# UDP sockets the virtual peers share; replies are matched by request tag, not by socket
+SOCKETS = 64
+
+# Files each virtual peer publishes before the measured run, as queries and searches need something to find
+FILES_PER_PEER = 5
+
+# "repeat_search" operations: the first REPEAT_SEARCHERS peers each repeat searches for the same few substrings,
+# the way users re-run their usual searches (e.g. "sch .mp4"); each matches the files of ten peers
+REPEAT_SEARCHERS = 20
+REPEAT_SUBSTRINGS = [f"vpeer0{n:03d}" for n in range(10)]
+
+# Logins in flight at once while the peers join
+LOGIN_CONCURRENCY = 256
+
+# Seconds after which an unanswered request counts as lost (requests are not retransmitted)
+REQUEST_TIMEOUT = 2.0
+
+# How often the scheduler wakes up to send due requests and heartbeats
+TICK = 0.005
+
+# Password of every virtual peer in the generated credentials file
+PASSWORD = "secret"
+
+
+# Many lightweight virtual peers in one process, driving a server over a pool of UDP sockets.
+# Every peer logs in, heartbeats on its own phase and issues an open-loop stream of requests,
+# so the offered load does not drop when the server slows down. Requests are tagged; the server
+# echoes the tag, which finds the request's send time and kind when its reply arrives.
+#
+# With a fixed heartbeat_interval, peers log in with AUTH and heartbeat on that interval like older
+# clients. With None, they negotiate a lease as client.py does: each heartbeats at the renewal interval
+# the server grants, and only when it has sent nothing else for that long.
+class LoadGenerator(asyncio.DatagramProtocol):
+    def __init__(self, address, peers, heartbeat_interval=None):
+        self.address = address
+        self.peers = [f"vpeer{i:05d}" for i in range(peers)]
+        self.heartbeat_interval = heartbeat_interval
+        self.intervals = [heartbeat_interval or 1.0] * peers                        # Heartbeat interval of each peer
+        self.last_sent = [0.0] * peers                                              # Time each peer last sent anything
+        self.transports = []
+        self.pending = {}                                                           # Format: {tag: (kind, send time, future or None)} - in send order
+        self.latencies = {}                                                         # Format: {kind: [seconds, ...]}
+        self.sent = {}                                                              # Format: {kind: count}
+        self.lost = {}                                                              # Format: {kind: count}
+        self.heartbeats = 0
+        self.publishers = []                                                        # Indexes of the peers whose files are published
+        self._heartbeat_due = []                                                    # Format: [(due time, peer index), ...]
+        self._tags = 0
+        self._extra_files = 0
+
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        for _ in range(SOCKETS):
+            transport, _ = await loop.create_datagram_endpoint(lambda: self, remote_addr=self.address)
+            self.transports.append(transport)
+
+    def datagram_received(self, data, address):
+        tag, _, reply = data.partition(b" ")
+        entry = self.pending.pop(tag, None)
+        if entry is None:
+            return                                                                  # Late reply to a request already counted as lost
+
+        kind, sent, future = entry
+        self.latencies.setdefault(kind, []).append(time.perf_counter() - sent)
+        if future is not None and not future.done():
+            future.set_result(reply.decode())
+
+    # Send a tagged request for a peer. With wait, returns a future for the reply text (None once it is lost).
+    def send(self, kind, peer, message, wait=False):
+        self._tags += 1
+        tag = f"#{self._tags}".encode()
+        future = asyncio.get_running_loop().create_future() if wait else None
+        self.pending[tag] = (kind, time.perf_counter(), future)
+        self.sent[kind] = self.sent.get(kind, 0) + 1
+        self.last_sent[peer] = time.perf_counter()
+        self.transports[peer % SOCKETS].sendto(tag + b" " + message.encode())
+        return future
+
+    async def request(self, kind, peer, message):
+        return await self.send(kind, peer, message, wait=True)
+
+    # Count requests unanswered for REQUEST_TIMEOUT as lost. pending is in send order, so only its head is checked.
+    def expire(self, now):
+        expired = []
+        for tag, (kind, sent, future) in self.pending.items():
+            if now - sent < REQUEST_TIMEOUT:
+                break
+            expired.append(tag)
+
+        for tag in expired:
+            kind, _, future = self.pending.pop(tag)
+            self.lost[kind] = self.lost.get(kind, 0) + 1
+            if future is not None and not future.done():
+                future.set_result(None)
+
+    # Send a request until it is answered, at most attempts times. Returns the reply text, or None if every copy was lost.
+    async def request_retrying(self, kind, peer, message, attempts=3):
+        for _ in range(attempts):
+            reply = await self.request(kind, peer, message)
+            if reply is not None:
+                return reply
+        return None
+
+    # Log a peer in and publish its files (retrying lost requests), then start its heartbeats. Peers
+    # whose files could not be published are left out of publishers, so queries never ask for them.
+    async def join(self, index, limit):
+        login = f"AUTH {self.peers[index]} {PASSWORD}" if self.heartbeat_interval else \
+            f"AUTHX {wire.LEASE_CAPABILITY} {self.peers[index]} {PASSWORD}"
+
+        async with limit:
+            reply = wire.parse_text_reply(await self.request_retrying("auth", index, login) or "")
+            if reply[0] != "AUTH_SUCCESS":
+                raise RuntimeError(f"{self.peers[index]} could not log in: {reply[0]}")
+
+            self.intervals[index] = float(reply[1].get("renew", self.intervals[index]))
+            heapq.heappush(self._heartbeat_due, (time.perf_counter() + random.uniform(0, self.intervals[index]), index))
+
+            # A retried batch that did arrive the first time is answered "0" for files already published, which is fine
+            files = "\n".join(self.filename(index, i) for i in range(FILES_PER_PEER))
+            reply = await self.request_retrying("publish_batch", index, f"PUBLISH_BATCH {self.peers[index]} 6000  {files}")
+            if reply is not None and reply.startswith("PUB_BATCH "):
+                self.publishers.append(index)
+
+    def filename(self, index, number):
+        return f"{self.peers[index]}_file{number}.dat"
+
+    # One request of the given kind from a random peer
+    def send_operation(self, kind):
+        index = random.randrange(len(self.peers))
+        user = self.peers[index]
+
+        if kind == "publish":
+            self._extra_files += 1
+            self.send(kind, index, f"PUBLISH {user} extra{self._extra_files}_{user}.dat 6000")
+        elif kind == "search":
+            self.send(kind, index, f"SEARCH_FILES {self.peers[random.randrange(len(self.peers))]}_ {user}")
+        elif kind == "repeat_search":
+            index = random.randrange(min(REPEAT_SEARCHERS, len(self.peers)))
+            self.send(kind, index, f"SEARCH_FILES {random.choice(REPEAT_SUBSTRINGS)} {self.peers[index]}")
+        elif kind == "query":
+            owner = random.choice(self.publishers)
+            self.send(kind, index, f"QUERY_FILE {self.filename(owner, random.randrange(FILES_PER_PEER))} {user}")
+        else:
+            raise ValueError(f"unknown operation {kind}")
+
+    # Send the heartbeats that are due; heartbeats get no reply. Negotiated-lease peers that sent a
+    # request within their interval skip the heartbeat, as that request renewed the lease.
+    def send_heartbeats(self, now):
+        while self._heartbeat_due and self._heartbeat_due[0][0] <= now:
+            due, index = heapq.heappop(self._heartbeat_due)
+            interval = self.intervals[index]
+
+            if self.heartbeat_interval is None and now - self.last_sent[index] < interval:
+                heapq.heappush(self._heartbeat_due, (self.last_sent[index] + interval, index))
+                continue
+
+            self.transports[index % SOCKETS].sendto(f"HEARTBEAT {self.peers[index]}".encode())
+            self.last_sent[index] = now
+            self.heartbeats += 1
+
+            # A peer whose heartbeat went out late keeps to the interval from now rather than catching up
+            due += interval
+            heapq.heappush(self._heartbeat_due, (due if due > now else now + interval, index))
+
+    # Heartbeats and timeouts only, e.g. while the peers join
+    async def idle(self, stop):
+        while not stop.is_set():
+            now = time.perf_counter()
+            self.send_heartbeats(now)
+            self.expire(now)
+            await asyncio.sleep(TICK)
+
+    # Offer rate requests/s, drawn from the mix, for duration seconds while heartbeats continue
+    async def drive(self, rate, mix, duration):
+        kinds, weights = list(mix), list(mix.values())
+        start = last = time.perf_counter()
+        owed = 0.0
+
+        while (now := time.perf_counter()) - start < duration:
+            owed += (now - last) * rate
+            last = now
+            count = int(owed)
+            owed -= count
+
+            for kind in random.choices(kinds, weights, k=count):
+                self.send_operation(kind)
+            self.send_heartbeats(now)
+            self.expire(now)
+            await asyncio.sleep(TICK)
+
+        return time.perf_counter() - start
+
+    # Wait for the replies still in flight, so they are counted as answered or lost
+    async def drain(self):
+        while self.pending:
+            now = time.perf_counter()
+            self.send_heartbeats(now)
+            self.expire(now)
+            await asyncio.sleep(TICK)
+
+    # Sum of a STATS item over all shards (items are "name=value" or "shard<k>.name=value"), or 0
+    async def server_stat(self, name):
+        reply = await self.request("stats", 0, f"STATS {self.peers[0]}")
+        total = 0
+        for item in (reply or "").partition(" ")[2].split(", "):
+            key, _, value = item.partition("=")
+            if key == name or key.endswith("." + name):
+                total += int(value)
+        return total
+
+
+# Server counters of result cache lookups, per command
+CACHE_STATS = [f"{name}.{command}" for name in ("result_cache_hits", "result_cache_stale_hits", "result_cache_misses")
+               for command in ("SEARCH_FILES", "QUERY_FILE")]
+
+
+def percentile(values, q):
+    return values[min(int(q * len(values)), len(values) - 1)] if values else 0.0
+
+
+# "publish=1,search=2,query=7" -> {"publish": 1.0, ...}
+def parse_mix(text):
+    return {kind: float(weight) for kind, weight in (part.split("=") for part in text.split(","))}
+
+
+# Start server.py on a free port with credentials for the virtual peers. server is "async", "sync" or "sharded:<workers>".
+def start_server(server, peers, directory):
+    with open(os.path.join(directory, "credentials.txt"), "w") as credentials:
+        credentials.writelines(f"vpeer{i:05d} {PASSWORD}\n" for i in range(peers))
+
+    port = random.randint(40000, 50000)
+    mode = server.split(":")
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, "server.py"), str(port), *mode], cwd=directory,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT,
+                               env=dict(os.environ, CATALOG_STATE_DIR="", LOG_LEVEL="warning",
+                                        CREDENTIALS_PATH=os.path.join(directory, "credentials.txt")))
+    time.sleep(1.5)
+    return process, ("127.0.0.1", port)
+
+
+async def run(address, peers, rate, duration, mix, heartbeat_interval):
+    generator = LoadGenerator(address, peers, heartbeat_interval)
+    await generator.open()
+
+    # Join every peer while the ones already in keep heartbeating
+    stop = asyncio.Event()
+    idler = asyncio.ensure_future(generator.idle(stop))
+    start = time.perf_counter()
+    limit = asyncio.Semaphore(LOGIN_CONCURRENCY)
+    join_drops_before = await generator.server_stat("udp_receive_drops")
+    await asyncio.gather(*(generator.join(index, limit) for index in range(peers)))
+    joined = time.perf_counter() - start
+    stop.set()
+    await idler
+    if not generator.publishers:
+        raise RuntimeError("no peer could publish its files")
+
+    expired_before = await generator.server_stat("leases_expired")
+    cache_before = {name: await generator.server_stat(name) for name in CACHE_STATS}
+    drops_before = await generator.server_stat("udp_receive_drops")
+    join_drops = drops_before - join_drops_before
+    join_sent, join_lost = ({kind: counts.get(kind, 0) for kind in ("auth", "publish_batch")}
+                            for counts in (generator.sent, generator.lost))
+    generator.latencies.clear()
+    heartbeats_before = generator.heartbeats
+
+    elapsed = await generator.drive(rate, mix, duration)
+    heartbeats = generator.heartbeats - heartbeats_before
+    await generator.drain()
+
+    false_evictions = await generator.server_stat("leases_expired") - expired_before
+    kernel_drops = await generator.server_stat("udp_receive_drops") - drops_before
+    cache = {name: await generator.server_stat(name) - cache_before[name] for name in CACHE_STATS}
+
+    print(f"{peers} peers joined in {joined:.2f}s ({peers / joined:.0f} logins/s, "
+          f"{sum(join_lost.values())} of {sum(join_sent.values())} join requests lost, "
+          f"kernel receive drops {join_drops}, {peers - len(generator.publishers)} peers without published files)")
+    intervals = sorted(generator.intervals)
+    print(f"offered {rate:.0f} requests/s for {elapsed:.1f}s, heartbeat interval "
+          f"{intervals[0]:g}-{intervals[-1]:g}s ({'negotiated' if heartbeat_interval is None else 'fixed'})")
+    print(f"{'operation':<12}{'sent':>9}{'replies':>9}{'lost':>7}{'loss %':>8}{'p50 ms':>9}{'p99 ms':>9}")
+
+    all_latencies = []
+    total_sent = total_lost = 0
+    for kind in mix:
+        sent = generator.sent.get(kind, 0)
+        lost = generator.lost.get(kind, 0)
+        latencies = sorted(generator.latencies.get(kind, []))
+        all_latencies.extend(latencies)
+        total_sent += sent
+        total_lost += lost
+        print(f"{kind:<12}{sent:>9}{len(latencies):>9}{lost:>7}{100 * lost / max(sent, 1):>8.2f}"
+              f"{percentile(latencies, 0.5) * 1000:>9.2f}{percentile(latencies, 0.99) * 1000:>9.2f}")
+
+    all_latencies.sort()
+    print(f"{'all':<12}{total_sent:>9}{len(all_latencies):>9}{total_lost:>7}{100 * total_lost / max(total_sent, 1):>8.2f}"
+          f"{percentile(all_latencies, 0.5) * 1000:>9.2f}{percentile(all_latencies, 0.99) * 1000:>9.2f}")
+    print(f"throughput {len(all_latencies) / elapsed:.0f} replies/s, "
+          f"{heartbeats / elapsed:.0f} heartbeats/s sent")
+    print(f"false evictions {false_evictions}, kernel receive drops {kernel_drops}")
+    for command in ("SEARCH_FILES", "QUERY_FILE"):
+        hits, stale, misses = (cache[f"{name}.{command}"] for name in ("result_cache_hits", "result_cache_stale_hits", "result_cache_misses"))
+        print(f"result cache {command}: {hits} hits, {stale} stale hits, {misses} misses "
+              f"({100 * (hits + stale) / max(hits + stale + misses, 1):.1f}% answered from the cache)")
+
+    for transport in generator.transports:
+        transport.close()
+
+
+# Usage: loadgen.py [peers] [requests/s] [seconds] [mix] [server] [heartbeat seconds]
+#   server is async (default), sync or sharded:<workers> to start a local server.py,
+#   or host:port for a running server whose credentials include vpeer00000... with password "secret".
+#   heartbeat seconds is "lease" (default) to negotiate leases, or a fixed interval such as 1 for older clients.
+#   mix weighs the operations publish, search (a different substring each time), repeat_search and query.
+def main():
+    peers = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    rate = float(sys.argv[2]) if len(sys.argv) > 2 else 4000
+    duration = float(sys.argv[3]) if len(sys.argv) > 3 else 20
+    mix = parse_mix(sys.argv[4] if len(sys.argv) > 4 else "publish=1,search=2,query=7")
+    server = sys.argv[5] if len(sys.argv) > 5 else "async"
+    heartbeat_interval = None if len(sys.argv) <= 6 or sys.argv[6] == "lease" else float(sys.argv[6])
+
+    process = directory = None
+    if server.split(":")[0] in ("async", "sync", "sharded"):
+        directory = tempfile.mkdtemp(prefix="loadgen_")
+        process, address = start_server(server, peers, directory)
+    else:
+        host, port = server.rsplit(":", 1)
+        address = (host, int(port))
+
+    try:
+        print(f"server {server}, mix {mix}")
+        asyncio.run(run(address, peers, rate, duration, mix, heartbeat_interval))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        if directory is not None:
+            shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
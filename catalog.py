@@ -0,0 +1,313 @@
+import sys
+import threading
+
+from peer_table import PeerTable
+from search_index import TrigramIndex
+
+# Filenames indexed per lock acquisition while the search index of a restored catalog is filled in
+WARM_INDEX_SLICE = 2_000
+
+
+# The server's record of published files. Besides the filename -> publishers map it keeps a
+# username -> filenames reverse index and a trigram index of filenames, and every mutation goes
+# through publish/unpublish so the three never drift apart. Published files outlive their
+# publisher's session (a user sees them again in LIST_FILES after logging back in), so peer
+# expiry does not touch these maps.
+#
+# The catalog is laid out to stay small at millions of publications. Publisher records live once
+# in a PeerTable, and a file holds a tuple of peer ids in publication order. Filenames, usernames
+# and content hashes are interned, so every map shares one string object per name. A file has few
+# publishers, so finding a user's publication of it is a scan of that tuple.
+#
+# Publications may carry a content hash (the root of the file's chunk manifest). Files are also
+# indexed by hash, so publishers of the same name with different contents can be told apart and
+# files with identical contents found under any name.
+#
+# Liveness is tracked alongside: live_publishers holds, for each file, the publishers that are
+# currently online, and is updated incrementally by peer_online/peer_offline. A file with no
+# entry there has only offline publishers and can be skipped without looking at its peer list.
+#
+# generation is bumped by every change to publications or liveness, so a result computed from the
+# catalog can be tagged with it and recognised as out of date later (see result_cache.ResultCache).
+#
+# Once journal is set (see catalog_store.CatalogStore), every change to a publication is also
+# recorded there, under the catalog lock so the journal sees changes in the order they happened.
+# The record is encoded before anything changes, so a change the journal cannot hold is rejected
+# (ValueError) rather than kept in memory only to be lost on restart.
+class Catalog:
+    def __init__(self):
+        self.peers = PeerTable()
+        self.files = {}                                                             # Format: {filename: (peer id, ...)} in publication order
+        self.user_files = {}                                                        # Format: {"username": {filename: None}} - dict as an ordered set
+        self.search_index = TrigramIndex()
+        self.live_users = set()                                                     # Format: {"username", ...}
+        self.live_publishers = {}                                                   # Format: {filename: (peer id, ...)} - only files with a live publisher, in the order they came online
+        self.content_hashes = {}                                                    # Format: {filename: (content hash or None, ...)} - lined up with files[filename], only files with a hashed publication
+        self.hash_files = {}                                                        # Format: {content hash: filename, or {filename: None} once several files share it}
+        self.generation = 0                                                         # Count of changes so far
+
+        self.journal = None
+
+        # The request thread and the peer monitor thread both update the catalog
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.files)
+
+    def __contains__(self, filename):
+        return filename in self.files
+
+    # Record that a user publishes a file, optionally with its content hash. Returns False if they had
+    # already published it - a new content hash (the file changed) still replaces the old one.
+    def publish(self, filename, username, ip, tcp_port, content_hash=None):
+        with self.lock:
+            filename = sys.intern(filename)
+            if content_hash is not None:
+                content_hash = sys.intern(content_hash)
+
+            peer_ids = self.files.get(filename, ())
+            hashes = self.content_hashes.get(filename)
+            index = self._position(peer_ids, username)
+
+            if index is not None:
+                if content_hash is not None and (hashes is None or hashes[index] != content_hash):
+                    entry = self._journal_publish(filename, self.peers.record(peer_ids[index]), content_hash)
+                    hashes = hashes or (None,) * len(peer_ids)
+                    self._set_content_hashes(filename, hashes[:index] + (content_hash,) + hashes[index + 1:])
+                    self.generation += 1
+                    if entry is not None:
+                        self.journal.append(entry)
+                return False
+
+            entry = self._journal_publish(filename, (username, ip, tcp_port), content_hash)
+            self.generation += 1
+            if not peer_ids:
+                self.search_index.add(filename)
+
+            peer_id = self.peers.acquire(username, ip, tcp_port)
+            username = self.peers.usernames[peer_id]
+            self.files[filename] = peer_ids + (peer_id,)
+            self.user_files.setdefault(username, {})[filename] = None
+            if hashes is not None or content_hash is not None:
+                self.content_hashes[filename] = (hashes or (None,) * len(peer_ids)) + (content_hash,)
+                if content_hash is not None and (hashes is None or content_hash not in hashes):
+                    self._add_hash_file(content_hash, filename)
+
+            if username in self.live_users:
+                self.live_publishers[filename] = self.live_publishers.get(filename, ()) + (peer_id,)
+
+            if entry is not None:
+                self.journal.append(entry)
+
+            return True
+
+    # Remove a user's publication if it was made from the same address and port. Returns True if removed.
+    def unpublish(self, filename, username, ip, tcp_port):
+        with self.lock:
+            peer_ids = self.files.get(filename, ())
+            index = self._position(peer_ids, username)
+            if index is None or peer_ids[index] != self.peers.find(username, ip, tcp_port):
+                return False
+
+            entry = None if self.journal is None else self.journal.encode_unpublish(filename, (username, ip, tcp_port))
+            self.generation += 1
+            peer_id = peer_ids[index]
+            hashes = self.content_hashes.get(filename)
+            if hashes is not None:
+                self._set_content_hashes(filename, hashes[:index] + hashes[index + 1:])
+
+            # If no one publishes the file any more, drop it from the catalog and the search index
+            if len(peer_ids) == 1:
+                del self.files[filename]
+                self.search_index.remove(filename)
+            else:
+                self.files[filename] = peer_ids[:index] + peer_ids[index + 1:]
+
+            user_files = self.user_files[username]
+            del user_files[filename]
+            if not user_files:
+                del self.user_files[username]
+
+            self._drop_live_publisher(filename, peer_id)
+            self.peers.release(peer_id)
+
+            if entry is not None:
+                self.journal.append(entry)
+
+            return True
+
+    # Encoded journal record of a publication, or None when there is no journal
+    def _journal_publish(self, filename, record, content_hash):
+        return None if self.journal is None else self.journal.encode_publish(filename, record, content_hash)
+
+    # Publish several files for one user under a single lock acquisition. Returns publish()'s result for each file.
+    def publish_many(self, filenames, username, ip, tcp_port, content_hashes=None):
+        content_hashes = content_hashes or [None] * len(filenames)
+
+        with self.lock:
+            return [self.publish(filename, username, ip, tcp_port, content_hash)
+                    for filename, content_hash in zip(filenames, content_hashes)]
+
+    # Unpublish several files for one user under a single lock acquisition. Returns unpublish()'s result for each file.
+    def unpublish_many(self, filenames, username, ip, tcp_port):
+        with self.lock:
+            return [self.unpublish(filename, username, ip, tcp_port) for filename in filenames]
+
+    # Load the contents of a snapshot into an empty catalog, given its peer table and maps already built
+    # (see the Format comments in __init__; strings interned). Filenames join the search index
+    # unindexed; see warm_search_index.
+    def restore(self, peers, files, user_files, content_hashes):
+        with self.lock:
+            self.peers = peers
+            self.files = files
+            self.user_files = user_files
+            self.content_hashes = content_hashes
+            self.generation += 1
+            for filename, hashes in content_hashes.items():
+                for content_hash in dict.fromkeys(hashes):
+                    if content_hash is not None:
+                        self._add_hash_file(content_hash, filename)
+            self.search_index.add_many(files)
+
+    # Post the trigrams of restored filenames a slice at a time, releasing the lock in between so
+    # requests are served while a large catalog is being indexed
+    def warm_search_index(self):
+        while True:
+            with self.lock:
+                if not self.search_index.index_pending(WARM_INDEX_SLICE):
+                    return
+
+    # A user came online - their files gain a live publisher. Costs O(files of that user).
+    def peer_online(self, username):
+        with self.lock:
+            if username in self.live_users:
+                return
+
+            self.live_users.add(username)
+            self.generation += 1
+            for filename in self.user_files.get(username, ()):
+                peer_ids = self.files[filename]
+                peer_id = peer_ids[self._position(peer_ids, username)]
+                self.live_publishers[filename] = self.live_publishers.get(filename, ()) + (peer_id,)
+
+    # A user went offline - their files lose a live publisher. Costs O(files of that user).
+    def peer_offline(self, username):
+        with self.lock:
+            if username not in self.live_users:
+                return
+
+            self.live_users.discard(username)
+            self.generation += 1
+            for filename in self.user_files.get(username, ()):
+                live = self.live_publishers.get(filename, ())
+                index = self._position(live, username)
+                if index is not None:
+                    self._drop_live_publisher(filename, live[index])
+
+    def _drop_live_publisher(self, filename, peer_id):
+        live = self.live_publishers.get(filename)
+        if live is not None and peer_id in live:
+            if len(live) == 1:
+                del self.live_publishers[filename]
+            else:
+                self.live_publishers[filename] = tuple(live_id for live_id in live if live_id != peer_id)
+
+    # Index of the user's peer id in a tuple of peer ids, or None
+    def _position(self, peer_ids, username):
+        usernames = self.peers.usernames
+        for index, peer_id in enumerate(peer_ids):
+            if usernames[peer_id] == username:
+                return index
+        return None
+
+    # Replace the content hashes of a file's publications, lined up with its peer ids, and move the
+    # file between the hash_files entries of the hashes it gained and lost
+    def _set_content_hashes(self, filename, hashes):
+        previous = self.content_hashes.get(filename, ())
+        if any(content_hash is not None for content_hash in hashes):
+            self.content_hashes[filename] = hashes
+        else:
+            self.content_hashes.pop(filename, None)
+
+        for content_hash in set(previous).difference(hashes):
+            if content_hash is not None:
+                self._drop_hash_file(content_hash, filename)
+        for content_hash in set(hashes).difference(previous):
+            if content_hash is not None:
+                self._add_hash_file(content_hash, filename)
+
+    # Most content is published under a single name, so hash_files holds that name alone until a second one shares it
+    def _add_hash_file(self, content_hash, filename):
+        holders = self.hash_files.get(content_hash)
+        if holders is None:
+            self.hash_files[content_hash] = filename
+        elif isinstance(holders, dict):
+            holders[filename] = None
+        elif holders != filename:
+            self.hash_files[content_hash] = {holders: None, filename: None}
+
+    def _drop_hash_file(self, content_hash, filename):
+        holders = self.hash_files[content_hash]
+        if isinstance(holders, dict):
+            del holders[filename]
+            if len(holders) == 1:
+                self.hash_files[content_hash] = next(iter(holders))
+        else:
+            del self.hash_files[content_hash]
+
+    # The version of a file most of its online publishers share. Returns (content hash or None,
+    # publisher records with that hash); publications without a hash count as a version of their own.
+    def live_version(self, filename):
+        with self.lock:
+            hashes = self.content_hashes.get(filename)
+            if hashes is not None:
+                hashes = dict(zip(self.files[filename], hashes))                   # Format: {peer id: content hash or None}
+
+            versions = {}                                                           # Format: {content hash or None: [record, ...]} in first-online order
+            for peer_id in self.live_publishers.get(filename, ()):
+                versions.setdefault(None if hashes is None else hashes[peer_id], []).append(self.peers.record(peer_id))
+
+            if not versions:
+                return None, []
+
+            return max(versions.items(), key=lambda version: len(version[1]))
+
+    # Files with an online publisher of the given content, under any name, in publication order
+    def files_with_hash(self, content_hash):
+        with self.lock:
+            holders = self.hash_files.get(content_hash, ())
+            return [filename for filename in ((holders,) if isinstance(holders, str) else holders)
+                    if self._has_live_copy(filename, content_hash)]
+
+    def _has_live_copy(self, filename, content_hash):
+        usernames = self.peers.usernames
+        return any(publication_hash == content_hash and usernames[peer_id] in self.live_users
+                   for peer_id, publication_hash in zip(self.files[filename], self.content_hashes[filename]))
+
+    # Publisher records for a file in publication order, [("username", ip, tcp_port), ...]
+    def publishers(self, filename):
+        with self.lock:
+            return list(map(self.peers.record, self.files.get(filename, ())))
+
+    # Records of the file's online publishers, in the order they came online
+    def live_publisher_records(self, filename):
+        with self.lock:
+            return list(map(self.peers.record, self.live_publishers.get(filename, ())))
+
+    # Number of online publishers of a file
+    def live_publisher_count(self, filename):
+        return len(self.live_publishers.get(filename, ()))
+
+    # O(1) check whether a user publishes a file
+    def is_published_by(self, filename, username):
+        return filename in self.user_files.get(username, ())
+
+    # Files published by a user, in publication order
+    def files_of(self, username):
+        with self.lock:
+            return list(self.user_files.get(username, ()))
+
+    # Filenames containing the substring, in the order they were first published
+    def search(self, substring):
+        with self.lock:
+            return self.search_index.search(substring)
@@ -0,0 +1,364 @@
+import gc
+import mmap
+import os
+import struct
+import sys
+import time
+import zlib
+from array import array
+from collections import Counter
+
+from peer_table import PeerTable
+
+# Directory holding the catalog snapshot and journal; empty disables persistence
+CATALOG_STATE_DIR = os.getenv("CATALOG_STATE_DIR", "catalog_state")
+
+# How often buffered journal records are flushed to the file - a crash loses at most this much
+JOURNAL_FLUSH_INTERVAL = 1.0
+
+# Compact the journal into a new snapshot once it grows past this many bytes...
+COMPACT_JOURNAL_BYTES = int(os.getenv("COMPACT_JOURNAL_BYTES", str(64 * 1024 * 1024)))
+
+# ...or once this many seconds have passed since the last snapshot and anything was journaled
+SNAPSHOT_INTERVAL = float(os.getenv("SNAPSHOT_INTERVAL", "600"))
+
+SNAPSHOT_NAME = "snapshot"
+JOURNAL_PREFIX = "journal."
+
+# Journal record types
+JOURNAL_PUBLISH = 1
+JOURNAL_UNPUBLISH = 2
+
+# Journal segment: a sequence of records, each a crc, a fixed header and the header's strings
+#   crc:     crc32 of the header and data (uint32)
+#   header:  record type (uint8), then the byte lengths of the filename (uint16), username (uint16)
+#            and ip (uint8), the tcp port (uint16) and the length of the raw content hash (uint8, 0 or 32)
+#   data:    filename, username and ip as UTF-8, then the content hash
+# A record cut short by a crash fails its length or crc check, and replay stops there.
+JOURNAL_CRC = struct.Struct("<I")
+JOURNAL_RECORD = struct.Struct("<BHHBHB")
+
+# Snapshot: a header, three string tables and five uint32 arrays, all little-endian, with no
+# padding. The file is written to a temporary name and renamed into place, so it is always complete.
+#   header:       magic b"BTSNAP01", first journal segment not covered by the snapshot, number of
+#                 users, endpoints, files, publications and content hashes (uint32 each), then the
+#                 byte lengths of the three string tables (uint64 each)
+#   usernames:    UTF-8, NUL-separated
+#   endpoints:    "<ip> <tcp port>" in UTF-8, NUL-separated
+#   filenames:    UTF-8, NUL-separated, in catalog order (the order SEARCH_FILES returns them)
+#   hashes:       32 bytes of raw SHA-256 per content hash
+#   publications: four arrays of one entry per publication, in catalog order and then publisher order:
+#                 file index, user index, endpoint index, content hash index (0xFFFFFFFF if none)
+#   user files:   the number of files of each user, in user table order, then the file indexes of
+#                 each user's files in the order they published them
+# `python catalog_store.py <snapshot>` prints a summary of a snapshot file.
+SNAPSHOT_MAGIC = b"BTSNAP01"
+SNAPSHOT_HEADER = struct.Struct("<8sIIIIIIQQQ")
+
+NO_HASH = 0xFFFFFFFF
+
+HASH_SIZE = 32
+
+
+# Durable copy of the catalog: every publish and unpublish is appended to a journal segment,
+# and the journal is periodically compacted into a snapshot. On startup the snapshot is
+# memory-mapped and loaded in bulk, then the segments written after it are replayed.
+#
+# Compaction starts a new segment and writes the snapshot from a forked child, which sees the
+# catalog exactly as it was at the switch while the server carries on; the old segments are
+# deleted once the snapshot is in place. Where fork is unavailable the snapshot is written
+# in-process under the catalog lock.
+class CatalogStore:
+    def __init__(self, directory=CATALOG_STATE_DIR):
+        self.directory = directory
+        self.segment = 0                                                            # Number of the journal segment being appended to
+        self._journal = None
+        self._journal_bytes = 0
+        self._last_snapshot = time.monotonic()
+
+    # Restore the catalog from disk and start journaling its mutations.
+    # Returns (publications loaded from the snapshot, journal records replayed).
+    def open(self, catalog):
+        os.makedirs(self.directory, exist_ok=True)
+        snapshot_path = os.path.join(self.directory, SNAPSHOT_NAME)
+        segments = self._segments()
+
+        # The restored objects live as long as the catalog, so the collector has nothing to find among them
+        gc.disable()
+        try:
+            loaded, first_segment = read_snapshot(snapshot_path, catalog) if os.path.exists(snapshot_path) else (0, 0)
+            replayed = sum(replay_journal(self._segment_path(segment), catalog)
+                           for segment in segments if segment >= first_segment)
+        finally:
+            gc.enable()
+        gc.freeze()
+
+        # Segments before the snapshot are left over from a compaction interrupted before it could delete them
+        self._remove_segments_before(first_segment)
+
+        self.segment = max(segments + [first_segment - 1]) + 1
+        self._open_segment()
+        catalog.journal = self
+        return loaded, replayed
+
+    # Journal records are encoded before the catalog is changed, so a change that cannot be journaled
+    # (a port or string too long for its field, a malformed hash) raises ValueError with the catalog
+    # untouched, and the record is appended once the change is made
+    def encode_publish(self, filename, record, content_hash):
+        return self._encode(JOURNAL_PUBLISH, filename, record, content_hash)
+
+    def encode_unpublish(self, filename, record):
+        return self._encode(JOURNAL_UNPUBLISH, filename, record, None)
+
+    def append(self, entry):
+        self._journal.write(entry)
+        self._journal_bytes += len(entry)
+
+    def flush(self):
+        if self._journal is not None:
+            self._journal.flush()
+
+    def close(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    # True once the journal is big or old enough to be worth folding into a snapshot
+    def needs_compaction(self):
+        return self._journal_bytes >= COMPACT_JOURNAL_BYTES or (
+            self._journal_bytes > 0 and time.monotonic() - self._last_snapshot >= SNAPSHOT_INTERVAL)
+
+    # Write a snapshot of the catalog and drop the journal segments it covers. Returns True on success.
+    def compact(self, catalog):
+        snapshot_path = os.path.join(self.directory, SNAPSHOT_NAME)
+        child = None
+
+        with catalog.lock:
+            # Everything journaled so far is in the catalog and will be in the snapshot
+            self._journal.close()
+            self.segment += 1
+            self._open_segment()
+            covered = self.segment
+
+            if hasattr(os, "fork"):
+                child = os.fork()
+                if child == 0:
+                    status = 1
+                    try:
+                        write_snapshot(catalog, snapshot_path, covered)
+                        status = 0
+                    finally:
+                        os._exit(status)
+            else:
+                write_snapshot(catalog, snapshot_path, covered)
+
+        if child is not None and os.waitpid(child, 0)[1] != 0:
+            return False
+
+        self._remove_segments_before(covered)
+        self._last_snapshot = time.monotonic()
+        return True
+
+    def _encode(self, kind, filename, record, content_hash):
+        filename, username, ip = filename.encode(), record[0].encode(), record[1].encode()
+        content_hash = bytes.fromhex(content_hash) if content_hash else b""
+
+        try:
+            header = JOURNAL_RECORD.pack(kind, len(filename), len(username), len(ip), record[2], len(content_hash))
+        except struct.error as e:
+            raise ValueError(f"cannot journal {record} publishing {filename[:64]!r}: {e}") from None
+
+        body = header + filename + username + ip + content_hash
+        return JOURNAL_CRC.pack(zlib.crc32(body)) + body
+
+    def _open_segment(self):
+        self._journal = open(self._segment_path(self.segment), "ab")
+        self._journal_bytes = 0
+
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, f"{JOURNAL_PREFIX}{segment:08d}")
+
+    # Numbers of the journal segments on disk, oldest first
+    def _segments(self):
+        return sorted(int(name[len(JOURNAL_PREFIX):]) for name in os.listdir(self.directory)
+                      if name.startswith(JOURNAL_PREFIX) and name[len(JOURNAL_PREFIX):].isdigit())
+
+    def _remove_segments_before(self, segment):
+        for old in self._segments():
+            if old < segment:
+                os.remove(self._segment_path(old))
+
+
+# Apply the records of one journal segment to the catalog. Returns the number of records applied.
+def replay_journal(path, catalog):
+    with open(path, "rb") as file:
+        data = file.read()
+
+    position = applied = 0
+    while position + JOURNAL_CRC.size + JOURNAL_RECORD.size <= len(data):
+        crc, = JOURNAL_CRC.unpack_from(data, position)
+        header = position + JOURNAL_CRC.size
+        kind, name_length, user_length, ip_length, tcp_port, hash_length = JOURNAL_RECORD.unpack_from(data, header)
+        start = header + JOURNAL_RECORD.size
+        end = start + name_length + user_length + ip_length + hash_length
+
+        # A torn or corrupt record ends the segment
+        if end > len(data) or zlib.crc32(data[header:end]) != crc:
+            break
+
+        filename = str(data[start:start + name_length], "utf-8")
+        start += name_length
+        username = str(data[start:start + user_length], "utf-8")
+        start += user_length
+        ip = str(data[start:start + ip_length], "utf-8")
+        content_hash = data[start + ip_length:end].hex() or None
+
+        if kind == JOURNAL_PUBLISH:
+            catalog.publish(filename, username, ip, tcp_port, content_hash)
+        elif kind == JOURNAL_UNPUBLISH:
+            catalog.unpublish(filename, username, ip, tcp_port)
+
+        position = end
+        applied += 1
+
+    return applied
+
+
+def write_snapshot(catalog, path, journal_segment):
+    users, endpoints, hashes = {}, {}, {}                                           # Format: {value: table index}
+    file_ids = {}                                                                   # Format: {filename: file index}
+    columns = [array("I") for _ in range(4)]                                        # file, user, endpoint and hash indexes
+
+    peer_columns = {}                                                               # Format: {peer id: (user index, endpoint index)}
+
+    for filename, peer_ids in catalog.files.items():
+        file_id = file_ids[filename] = len(file_ids)
+        file_hashes = catalog.content_hashes.get(filename) or (None,) * len(peer_ids)
+
+        for peer_id, content_hash in zip(peer_ids, file_hashes):
+            peer_column = peer_columns.get(peer_id)
+            if peer_column is None:
+                username, ip, tcp_port = catalog.peers.record(peer_id)
+                peer_column = peer_columns[peer_id] = (users.setdefault(username, len(users)),
+                                                       endpoints.setdefault(f"{ip} {tcp_port}", len(endpoints)))
+            columns[0].append(file_id)
+            columns[1].append(peer_column[0])
+            columns[2].append(peer_column[1])
+            columns[3].append(NO_HASH if content_hash is None else hashes.setdefault(content_hash, len(hashes)))
+
+    user_counts, user_file_ids = array("I"), array("I")
+    for username in users:
+        filenames = catalog.user_files.get(username, ())
+        user_counts.append(len(filenames))
+        user_file_ids.extend(file_ids[filename] for filename in filenames)
+
+    tables = ["\0".join(table).encode() for table in (users, endpoints, file_ids)]
+    arrays = [*columns, user_counts, user_file_ids]
+    if sys.byteorder == "big":
+        for column in arrays:
+            column.byteswap()
+
+    temporary = f"{path}.tmp"
+    with open(temporary, "wb") as file:
+        file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, journal_segment, len(users), len(endpoints), len(file_ids),
+                                        len(columns[0]), len(hashes), *map(len, tables)))
+        for table in tables:
+            file.write(table)
+        file.write(b"".join(bytes.fromhex(content_hash) for content_hash in hashes))
+        for column in arrays:
+            column.tofile(file)
+        file.flush()
+        os.fsync(file.fileno())
+
+    os.replace(temporary, path)
+
+
+# Load a snapshot into an empty catalog. Returns (number of publications, first journal segment to replay).
+def read_snapshot(path, catalog):
+    with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+        header = SNAPSHOT_HEADER.unpack_from(view)
+        if header[0] != SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is not a catalog snapshot")
+
+        _, journal_segment, user_count, endpoint_count, file_count, publication_count, hash_count, *table_sizes = header
+        position = SNAPSHOT_HEADER.size
+
+        tables = []
+        for size, count in zip(table_sizes, (user_count, endpoint_count, file_count)):
+            tables.append(str(view[position:position + size], "utf-8").split("\0") if count else [])
+            position += size
+        usernames, endpoints, filenames = tables
+
+        hex_hashes = view[position:position + hash_count * HASH_SIZE].hex()
+        hashes = [hex_hashes[offset:offset + 2 * HASH_SIZE] for offset in range(0, len(hex_hashes), 2 * HASH_SIZE)]
+        position += hash_count * HASH_SIZE
+
+        arrays = []
+        for count in (publication_count,) * 4 + (user_count, publication_count):
+            column = array("I")
+            column.frombytes(view[position:position + count * column.itemsize])
+            if sys.byteorder == "big":
+                column.byteswap()
+            arrays.append(column)
+            position += count * column.itemsize
+
+    file_ids, user_ids, endpoint_ids, hash_ids, user_counts, user_file_ids = arrays
+
+    # Strings are interned so later publications of the same names share them (see Catalog)
+    usernames = list(map(sys.intern, usernames))
+    filenames = list(map(sys.intern, filenames))
+    hashes = list(map(sys.intern, hashes))
+
+    # One peer id per (user, endpoint) pair, referenced by each of its publications
+    addresses = [endpoint.rsplit(" ", 1) for endpoint in endpoints]
+    peers, peer_ids = PeerTable(), {}                                               # Format: {(user index, endpoint index): peer id}
+    pairs = list(zip(user_ids, endpoint_ids))
+    for (user_id, endpoint_id), references in Counter(pairs).items():
+        ip, tcp_port = addresses[endpoint_id]
+        peer_ids[user_id, endpoint_id] = peers.acquire(usernames[user_id], ip, int(tcp_port), references)
+    publication_peers = list(map(peer_ids.__getitem__, pairs))
+
+    # Most files have a single publisher, and then the publications line up with the filenames
+    if publication_count == file_count:
+        files = {filename: (peer_id,) for filename, peer_id in zip(filenames, publication_peers)}
+    else:
+        grouped = {filename: [] for filename in filenames}
+        for file_id, peer_id in zip(file_ids, publication_peers):
+            grouped[filenames[file_id]].append(peer_id)
+        files = {filename: tuple(peer_list) for filename, peer_list in grouped.items()}
+
+    content_hashes = {}
+    if hashes:
+        grouped = {}
+        for file_id, hash_id in zip(file_ids, hash_ids):
+            grouped.setdefault(filenames[file_id], []).append(None if hash_id == NO_HASH else hashes[hash_id])
+        content_hashes = {filename: tuple(file_hashes) for filename, file_hashes in grouped.items()
+                          if any(content_hash is not None for content_hash in file_hashes)}
+
+    user_files, start = {}, 0
+    for username, count in zip(usernames, user_counts):
+        user_files[username] = dict.fromkeys(map(filenames.__getitem__, user_file_ids[start:start + count]))
+        start += count
+
+    catalog.restore(peers, files, user_files, content_hashes)
+    return publication_count, journal_segment
+
+
+# Print a summary of a snapshot file
+def main():
+    if len(sys.argv) != 2:
+        print("Usage: catalog_store.py <snapshot>")
+        sys.exit(1)
+
+    from catalog import Catalog
+
+    catalog = Catalog()
+    start = time.perf_counter()
+    publications, journal_segment = read_snapshot(sys.argv[1], catalog)
+    print(f"{len(catalog)} files, {len(catalog.user_files)} users, {publications} publications, "
+          f"{len(catalog.hash_files)} content hashes; replay journal from segment {journal_segment} "
+          f"(loaded in {time.perf_counter() - start:.3f}s)")
+
+
+if __name__ == "__main__":
+    main()
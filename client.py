@@ -1,7 +1,55 @@
+import glob
 import socket
 import time
 import sys
+import os
 import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import wire
+from client_transport import ClientTransport
+from content_store import CONTENT_STORE_DIR, ContentStore
+from manifest import ChunkMismatch, ManifestCache, VerifyingWriter, fetch_manifest, serve_manifest, verified_prefix
+from swarm import SEGMENT_SIZE, probe_size, swarm_download
+from transfer import (TRANSFER_TIMEOUT, TransferError, UploadMeter, describe_transfer, fetch_range, parse_encoded_range_request,
+                      parse_range_request, read_header, serve_range, stream_file)
+
+# Page size requested for list replies (the server caps it at a safe UDP payload)
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", "1400"))
+
+# Offer the binary wire protocol at login unless WIRE_PROTOCOL=text
+WIRE_PROTOCOL = os.getenv("WIRE_PROTOCOL", wire.PROTOCOL)
+
+# Bytes of filenames packed into each PUBLISH_BATCH / UNPUBLISH_BATCH request, keeping the datagram under a 1500 byte MTU
+BATCH_BYTES = int(os.getenv("BATCH_BYTES", "1200"))
+
+# Connections tried per download before leaving the partial file for a later resume
+DOWNLOAD_ATTEMPTS = 3
+
+# Listen backlog of the peer file server - connections beyond the queue below wait here in the kernel
+FILE_SERVER_BACKLOG = int(os.getenv("FILE_SERVER_BACKLOG", "64"))
+
+# Uploads served at once, and accepted connections allowed to wait for a free upload slot
+MAX_CONCURRENT_UPLOADS = int(os.getenv("MAX_CONCURRENT_UPLOADS", "8"))
+MAX_QUEUED_UPLOADS = int(os.getenv("MAX_QUEUED_UPLOADS", "16"))
+
+# Publish every verified download, so each peer that fetches a hot file becomes another source of it
+AUTO_SEED = os.getenv("AUTO_SEED", "0") == "1"
+
+# Upload capacity in KB/s reported (minus current usage) to the server for load balancing; 0 means unknown
+UPLOAD_BANDWIDTH_KBPS = int(os.getenv("UPLOAD_BANDWIDTH_KBPS", "0"))
+
+# Active uploads and recent upload throughput of this peer's file server
+upload_meter = UploadMeter()
+
+# Manifests of the files this peer publishes, reused while a file is unchanged
+manifest_cache = ManifestCache()
+
+# Verified downloads by content hash, so a repeated get needs no transfer
+content_store = ContentStore() if CONTENT_STORE_DIR else None
+
+# Seconds between heartbeats - the server may grant a longer renewal interval at login
+heartbeat_interval = 1.0
 
 # Function to get the server's address and port from the command line
 def get_server_info():
@@ -12,13 +60,9 @@ def get_server_info():
     # example: localhost 51000
     return sys.argv[1], int(sys.argv[2])  
 
-# Function to initialize the UDP socket
-def create_socket():
-    client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    # set a 5 second timeout
-    client_socket.settimeout(5)                                                     
-
-    return client_socket
+# Function to initialize the UDP channel to the server - requests are tagged, retransmitted and may be pipelined
+def create_transport(server_host, server_port):
+    return ClientTransport(server_host, server_port)
 
 # Function to take username and password input
 def get_user_credentials():
@@ -27,16 +71,24 @@ def get_user_credentials():
 
     return username, password
 
-# Function to authenticate the user by sending credentials to the server
-def authenticate_with_server(client_socket, server_host, server_port, username, password):
-    credentials = f"AUTH {username} {password}"
-    client_socket.sendto(credentials.encode(), (server_host, server_port))
+# Function to authenticate the user by sending credentials to the server. AUTHX also offers the
+# binary protocol, which the transport switches to if the server accepts it.
+def authenticate_with_server(transport, username, password):
+    global heartbeat_interval
 
     try:
-        response, _ = client_socket.recvfrom(1024)
-        response_message = response.decode()
+        if WIRE_PROTOCOL == wire.PROTOCOL:
+            response = transport.request("AUTHX", f"{wire.PROTOCOL},{wire.LEASE_CAPABILITY}", username, password)
+        else:
+            response = transport.request("AUTH", username, password)
+        response_message = response[0]
 
         if response_message == "AUTH_SUCCESS":
+            if len(response) > 1 and response[1].get("proto") == wire.PROTOCOL:
+                transport.protocol = wire.PROTOCOL
+            if len(response) > 1 and "renew" in response[1]:
+                heartbeat_interval = float(response[1]["renew"])
+
             print("Authentication successful!")
             return True
         
@@ -75,63 +127,164 @@ def get_tcp_port(username):
 
     return tcp_port
 
-# Start a TCP server to handle file upload requests
-def start_file_server(peer_tcp_port):
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as tcp_socket:
+# Start a TCP server to handle file upload requests. Uploads run on a fixed pool of worker threads;
+# at most max_queued accepted connections wait for a worker, and once that queue is full the server
+# stops accepting so further downloaders wait in the listen backlog instead of spawning threads.
+def start_file_server(peer_tcp_port, backlog=FILE_SERVER_BACKLOG, max_uploads=MAX_CONCURRENT_UPLOADS,
+                      max_queued=MAX_QUEUED_UPLOADS):
+    slots = threading.BoundedSemaphore(max_uploads + max_queued)
+
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as tcp_socket, \
+            ThreadPoolExecutor(max_workers=max_uploads, thread_name_prefix="upload") as pool:
+        tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         tcp_socket.bind(("", peer_tcp_port))
-        tcp_socket.listen(5)
+        tcp_socket.listen(backlog)
 
         # Debug statement
         # print(f"TCP File server started on port {peer_tcp_port}")
 
         while True:
-            conn, addr = tcp_socket.accept()
-            threading.Thread(target=send_file, args=(conn, addr)).start()
+            # Wait for an upload or queue slot before taking another connection off the backlog
+            slots.acquire()
+
+            try:
+                conn, addr = tcp_socket.accept()
+            except OSError:
+                slots.release()
+                continue
 
+            pool.submit(serve_upload, conn, addr, slots)
 
-# Send requested file over TCP to downloading peer
+
+# Worker entry point - serve one connection and free its slot however it ends
+def serve_upload(conn, addr, slots):
+    try:
+        send_file(conn, addr)
+    finally:
+        slots.release()
+
+
+# Send requested file over TCP to downloading peer. The connection is always closed, even on errors.
 def send_file(conn, addr):
+    upload_meter.started()
+
     try:
-        request = conn.recv(1024).decode()
-        if request.startswith("DOWNLOAD "):
-            filename = request.split(" ", 1)[1]
+        with conn:
+            conn.settimeout(TRANSFER_TIMEOUT)
+            request = conn.recv(1024)
+            start = time.perf_counter()
+
+            # Range request - length-delimited, so the downloader can resume
+            if request.startswith(b"DOWNLOAD_RANGE "):
+                header, _ = read_header(conn, request)
+                filename, offset, length = parse_range_request(header)
+                sent = serve_range(conn, local_path(filename), offset, length, upload_meter)
+                print(f"Sent {filename} [{offset}+] to {addr[0]}: {describe_transfer(sent, time.perf_counter() - start)}")
+
+            # Range request offering compressed encodings
+            elif request.startswith(b"DOWNLOAD_RANGE_ENC "):
+                header, _ = read_header(conn, request)
+                filename, offset, length, encodings = parse_encoded_range_request(header)
+                sent = serve_range(conn, local_path(filename), offset, length, upload_meter, encodings)
+                print(f"Sent {filename} [{offset}+] to {addr[0]}: {describe_transfer(sent, time.perf_counter() - start)}")
+
+            elif request.startswith(b"MANIFEST "):
+                header, _ = read_header(conn, request)
+                serve_manifest(conn, local_path(header.split(" ", 1)[1]), manifest_cache)
+
+            elif request.startswith(b"DOWNLOAD "):
+                filename = request.decode().split(" ", 1)[1]
             
-            # Open and send file in binary mode
-            with open(filename, "rb") as file:
-                while (chunk := file.read(1024)):
-                    conn.sendall(chunk)
-        conn.close()
+                # Open and send file in binary mode, zero-copy where the platform supports it
+                with open(local_path(filename), "rb") as file:
+                    sent = stream_file(conn, file, meter=upload_meter)
+
+                print(f"Sent {filename} to {addr[0]}: {describe_transfer(sent, time.perf_counter() - start)}")
 
     except Exception as e:
         print(f"Error sending file: {e}")
 
+    finally:
+        upload_meter.finished()
+
+
+# Local file to serve for a requested filename: the working copy, or else the content store's copy of it
+def local_path(filename):
+    if content_store is None or os.path.exists(filename):
+        return filename
+    return content_store.path_for_name(filename) or filename
+
+
+# Function to send ping requests to a server using UDP. Any request renews the lease, so a heartbeat
+# is only sent once nothing has gone to the server for heartbeat_interval, or when the upload load
+# reported in it has changed.
+def heart_beat_mechanism(username, transport):
+    reported = None
 
-# Function to send ping requests to a server using UDP
-def heart_beat_mechanism(username, client_socket, server_host, server_port):
     while True:
-        message = f"HEARTBEAT {username}"
-        client_socket.sendto(message.encode(), (server_host, server_port))
-        time.sleep(1)  # 1-second interval
+        # Report active uploads and free upload bandwidth so the server can spread downloads across peers
+        free_kbps = max(0, UPLOAD_BANDWIDTH_KBPS - int(upload_meter.rate() / 1024)) if UPLOAD_BANDWIDTH_KBPS else 0
+        load = (upload_meter.active, free_kbps)
+
+        if load != reported or time.monotonic() - transport.last_sent >= heartbeat_interval:
+            transport.send("HEARTBEAT", username, *load)
+            reported = load
+
+        time.sleep(min(1, heartbeat_interval))  # Check at least every second
+
+
+# Completion check for a paged burst: done once every page has arrived (retransmissions may
+# repeat some), or as soon as the server answers with anything other than a page
+def pages_complete(key):
+    def complete(replies):
+        if replies[0][0] != key:
+            return True
+
+        return len({reply[1] for reply in replies}) >= replies[0][2]
+
+    return complete
+
+
+# Function to send a list request in paged mode and reassemble the pages. Each page is
+# (key, seq, pages, total, next_cursor, items); bursts are requested from the continuation
+# cursor until it is None. Returns (items, None) on success, or (None, response key) if the
+# server answered with a single non-paged message such as a FAIL.
+def request_list(transport, command, fields, key):
+    items = []
+    cursor = 0
+
+    while cursor is not None:
+        # Lost pages are handled by the transport, which retransmits until the whole burst is in
+        replies = transport.request_pages(command, *fields, cursor, PAGE_SIZE, complete=pages_complete(key))
+        if replies[0][0] != key:
+            return None, replies[0][0]
+
+        pages = {}
+        for _, seq, _, _, next_cursor, page_items in replies:
+            pages[seq] = page_items
+
+        for seq in sorted(pages):
+            items.extend(pages[seq])
+        cursor = next_cursor
+
+    return items, None
 
 
 # Function to list activer users
-def list_of_active_users(username, client_socket, server_host, server_port):
-    # Create the message to request active peers
-    lap_message = f"ACTIVE_PEERS {username}"
-    client_socket.sendto(lap_message.encode(), (server_host, server_port))
+def list_of_active_users(username, transport):
+    # Request active peers and reassemble the paged response from the server
+    try:
+        active_peers_list, message = request_list(transport, "ACTIVE_PEERS", (username,), "ACTIVE_PEERS")
 
-    # Receive and decode response from the server
-    response, _ = client_socket.recvfrom(1024)
-    message = response.decode()
+    except socket.timeout:
+        print("Active peers request timed out.")
+        return
 
     # Handle the server's response
-    if message == "ACTIVE_PEERS_FAIL":
+    if active_peers_list is None:
         print("Active peers request unsuccessful.")
         return
 
-    # Parse the response to get the list of active peers
-    active_peers_list = message[len("ACTIVE_PEERS "):].split(", ")
-
     # Filter out the current user from the list
     active_peers_list = [peer for peer in active_peers_list if peer != username]
 
@@ -149,20 +302,24 @@ def list_of_active_users(username, client_socket, server_host, server_port):
         print("No active peers found.")
 
 
-# Publish function                                                                  
-def publish_file(username, client_socket, server_host, server_port, filename, tcp_port):
-    message = f"PUBLISH {username} {filename} {tcp_port}"
-    client_socket.sendto(message.encode(), (server_host, server_port))
+# Publish function. The file's manifest is computed (or taken from the cache) first, so the
+# server can index the file by its content hash.
+def publish_file(username, transport, filename, tcp_port):
+    try:
+        content_hash = manifest_cache.get(filename).content_hash
+        manifest_cache.save()
+    except OSError:
+        content_hash = ""
 
     try:
-        response, _ = client_socket.recvfrom(1024)
-        if response.decode() == "PUB_SUCCESS":
+        response = transport.request("PUBLISH", username, filename, tcp_port, content_hash)[0]
+        if response == "PUB_SUCCESS":
             print(f"File published successfully.")
 
-        elif response.decode() == "PUB_ALREADY":               
+        elif response == "PUB_ALREADY":               
             print(f"File published successfully.")
 
-        elif response.decode() == "PUB_FAIL":
+        elif response == "PUB_FAIL":
             print("File publish unsuccesful")
 
     except socket.timeout:
@@ -170,38 +327,127 @@ def publish_file(username, client_socket, server_host, server_port, filename, tc
 
 
 # Unpublish function
-def unpublish_file(username, client_socket, server_host, server_port, filename, tcp_port):
-    message = f"UNPUBLISH {username} {filename} {tcp_port}"
-    client_socket.sendto(message.encode(), (server_host, server_port))
-
+def unpublish_file(username, transport, filename, tcp_port):
     try:
-        response, _ = client_socket.recvfrom(1024)
-        if response.decode() == "UNPUB_SUCCESS":
+        response = transport.request("UNPUBLISH", username, filename, tcp_port)[0]
+        if response == "UNPUB_SUCCESS":
             print(f"File unpublished successfully.")
 
-        elif response.decode() == "UNPUB_FAIL":
+        elif response == "UNPUB_FAIL":
             print("File unpublishing failed")
 
     except socket.timeout:
         print("Publish request timed out.")
 
 
+# Expand a pub/unp argument into filenames: "-r <dir>" walks a directory tree and a glob pattern
+# such as "*.iso" matches local files. Returns None for a plain filename. Files are named by their
+# path relative to the working directory, so other users never see the layout above it; files
+# outside the working directory are skipped.
+def expand_file_argument(argument):
+    if argument.startswith("-r "):
+        directory = argument[3:].strip()
+        paths = [os.path.join(root, name) for root, _, names in os.walk(directory) for name in names]
+
+    # A file whose name merely contains glob characters is still published as itself
+    elif any(char in argument for char in "*?[") and not os.path.exists(argument):
+        paths = [path for path in glob.glob(argument, recursive=True) if os.path.isfile(path)]
+
+    else:
+        return None
+
+    names = [shared_name(path) for path in paths]
+    if None in names:
+        print(f"Skipped {names.count(None)} file(s) outside the working directory - only files under it can be shared.")
+
+    return sorted(name for name in names if name is not None)
+
+
+# Name a local file is shared under: its path relative to the working directory, or None if it lies outside it
+def shared_name(path):
+    try:
+        name = os.path.relpath(path)
+    except ValueError:
+        return None                                                                 # Another drive on Windows
+
+    return None if name == os.pardir or name.startswith(os.pardir + os.sep) else name
+
+
+# Split filenames into batches of at most budget bytes each
+def pack_batches(filenames, budget):
+    batch, batch_bytes = [], 0
+
+    for filename in filenames:
+        length = len(filename.encode()) + 1                                         # Separator
+
+        if batch and batch_bytes + length > budget:
+            yield batch
+            batch, batch_bytes = [], 0
+
+        batch.append(filename)
+        batch_bytes += length
+
+    if batch:
+        yield batch
+
+
+# Publish or unpublish many files (command is PUBLISH_BATCH or UNPUBLISH_BATCH). The names are
+# packed into batch requests which are pipelined, and the server answers each with one result per file.
+# Published files carry their content hashes, computed on several threads while earlier batches are in flight.
+def publish_batch(username, transport, command, filenames, tcp_port):
+    verb = "Published" if command == "PUBLISH_BATCH" else "Unpublished"
+
+    # Newlines and NULs separate filenames on the wire
+    failed = [filename for filename in filenames if "\n" in filename or "\0" in filename]
+    sendable = [filename for filename in filenames if "\n" not in filename and "\0" not in filename]
+
+    if command == "PUBLISH_BATCH":
+        # A hex content hash and its separator take 65 bytes per file
+        batches = list(pack_batches(sendable, (BATCH_BYTES - len(username.encode()) - 40) // 2))
+        futures = []
+        for batch in batches:
+            hashes = [manifest.content_hash if manifest else "" for manifest in manifest_cache.get_many(batch)]
+            futures.append(transport.submit(command, username, tcp_port, hashes, batch))
+        manifest_cache.save()
+
+    else:
+        batches = list(pack_batches(sendable, BATCH_BYTES - len(username.encode()) - 40))
+        futures = [transport.submit(command, username, tcp_port, batch) for batch in batches]
+
+    for batch, future in zip(batches, futures):
+        try:
+            response = future.result()[0]
+        except socket.timeout:
+            failed.extend(batch)
+            continue
+
+        results = response[1] if response[0] in ("PUB_BATCH", "UNPUB_BATCH") else ""
+        failed.extend(filename for filename, result in zip(batch, results.ljust(len(batch), "0")) if result != "1")
+
+    if not filenames:
+        print("No matching files.")
+    elif not failed:
+        print(f"{verb} {len(filenames)} files successfully.")
+    else:
+        print(f"{verb} {len(filenames) - len(failed)} of {len(filenames)} files. Failed:")
+        for filename in failed[:10]:
+            print(filename)
+        if len(failed) > 10:
+            print(f"... and {len(failed) - 10} more")
+
+
 # Listed published files function
-def listed_published_files(username, client_socket, server_host, server_port):
-    # Create the message to request the list of published files
-    request_message = f"LIST_FILES {username}"
-    client_socket.sendto(request_message.encode(), (server_host, server_port))
+def listed_published_files(username, transport):
+    # Request the list of published files and reassemble the paged response from the server
+    try:
+        file_names, message = request_list(transport, "LIST_FILES", (username,), "PUBLISHED_FILES")
 
-    # Receive response from the server
-    response, _ = client_socket.recvfrom(1024)
-    message = response.decode()
+    except socket.timeout:
+        print("List published files request timed out.")
+        return
 
     # Process the server's response
-    if message.startswith("PUBLISHED_FILES"):
-        # Extract the list of files from the message
-        files_list = message[len("PUBLISHED_FILES "):].strip()  # Remove any trailing whitespace
-        file_names = files_list.split(", ") if files_list else []  # Split into a list
-
+    if file_names is not None:
         number_of_uploads = len(file_names)
 
         if number_of_uploads == 1:
@@ -220,25 +466,39 @@ def listed_published_files(username, client_socket, server_host, server_port):
         print("No file published")
 
 
+# Function to show the server's counters, latency percentiles and index sizes
+def server_stats(username, transport):
+    try:
+        items, _ = request_list(transport, "STATS", (username,), "STATS")
+
+    except socket.timeout:
+        print("Stats request timed out.")
+        return
+
+    if items is None:
+        print("Stats request unsuccessful.")
+        return
+
+    for item in items:
+        name, _, value = item.partition("=")
+        print(f"{name:<48}{value:>12}")
+
+
 # Search for files published by active peers
-def query_active_peers_files(substring, username, client_socket, server_host, server_port):
-    # Create the message to request the list of files containing the substring
-    request_message = f"SEARCH_FILES {substring} {username}"
-    client_socket.sendto(request_message.encode(), (server_host, server_port))
+def query_active_peers_files(substring, username, transport):
+    # Request the list of files containing the substring and reassemble the paged response from the server
+    try:
+        file_names, message = request_list(transport, "SEARCH_FILES", (substring, username), "FOUND_FILES")
 
-    # Receive response from the server
-    response, _ = client_socket.recvfrom(1024)
-    message = response.decode()
+    except socket.timeout:
+        print("Search request timed out.")
+        return
 
     # Process the server's response
-    if message.startswith("FAIL"):
+    if file_names is None:
         print(f"No files found")
 
-    elif message.startswith("FOUND_FILES"):
-        # Extract the list of files from the message
-        files_list = message[len("FOUND_FILES "):].strip()
-        file_names = files_list.split(", ") if files_list else []
-
+    else:
         number_of_matches = len(file_names)
 
         if number_of_matches > 0:
@@ -247,22 +507,131 @@ def query_active_peers_files(substring, username, client_socket, server_host, se
                 print(name)
         else:
             print(f"No files found")
+
+
+# Whether a published filename is safe to use as a local path: relative, and never climbing out of
+# the working directory. Names are checked before anything is created or written for them.
+def is_safe_local_name(filename):
+    parts = filename.replace("\\", "/").split("/")
+    return bool(filename) and not os.path.isabs(filename) and not os.path.splitdrive(filename)[0] and ".." not in parts
+
+
+# Files shared with "pub -r" keep their relative directory, which is recreated on download
+def make_parent_directory(filename):
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+
+# Function to query the server for every active peer with a file and download it. Files larger than
+# one segment are fetched from all of them in parallel; otherwise the first peer serves the whole file.
+# When the publishers announced a content hash, the manifest matching it is fetched from a peer and
+# every chunk is verified as it arrives. Contents already in the content store are not downloaded again,
+# and verified downloads are added to it.
+def query_peer_for_file(filename, username, transport):
+    if not is_safe_local_name(filename):
+        print(f"Refusing to download {filename}: absolute paths and '..' would write outside the working directory.")
+        return
+
+    content = transport.submit("QUERY_CONTENT", filename, username)
+
+    try:
+        peers, message = request_list(transport, "QUERY_PEERS", (filename, username), "FILE_PEERS")
+
+    except socket.timeout:
+        # Older servers do not answer QUERY_PEERS - ask for a single peer instead
+        query_single_peer_for_file(filename, username, transport)
+        return
+
+    if peers is None:
+        print("File not found or no active peer available.")
+        return
+
+    peers = [(peer.rsplit(":", 1)[0], int(peer.rsplit(":", 1)[1])) for peer in peers]
+    make_parent_directory(filename)
+
+    try:
+        reply = content.result()[0]
+        content_hash = reply[1] if reply[0] == "CONTENT" and reply[1] else None
+    except socket.timeout:
+        content_hash = None
+
+    if content_hash is not None and content_store is not None and content_store.fetch(content_hash, filename):
+        print(f"{filename} is already in the local content store - nothing to download.")
+        if AUTO_SEED:
+            publish_file(username, transport, filename, get_tcp_port(username))
+        return
+
+    manifest = find_manifest(filename, peers, content_hash)
+    if manifest is not None:
+        if len(peers) > 1 and manifest.size > SEGMENT_SIZE:
+            done = swarm_download(filename, peers, manifest=manifest)
+        else:
+            done = any(download_file_from_peer(filename, peer_ip, peer_port, manifest) for peer_ip, peer_port in peers)
+
+        if done:
+            keep_download(filename, manifest, username, transport)
+        return
+
+    if content_hash is not None:
+        print(f"No peer could provide a manifest matching {filename} - not downloading unverified data.")
+        return
+
+    size = probe_size(filename, peers) if len(peers) > 1 else None
+
+    if size is not None and size > SEGMENT_SIZE:
+        swarm_download(filename, peers, size)
     else:
-        print(f"No files found")
+        download_file_from_peer(filename, *peers[0])
 
 
-# Function to query the server for an active peer with a file and download it
-def query_peer_for_file(filename, username, client_socket, server_host, server_port):
-    query_message = f"QUERY_FILE {filename} {username}"
-    client_socket.sendto(query_message.encode(), (server_host, server_port))
+# Keep a verified download in the content store, and with AUTO_SEED publish it so hot files gain a
+# replica with every download. Seeded files evicted from the store to make room are unpublished
+# unless their working copy is still there to serve.
+def keep_download(filename, manifest, username, transport):
+    evicted = []
+    manifest_cache.put(filename, manifest)
+
+    if content_store is not None:
+        try:
+            evicted = content_store.add(filename, manifest)
+            stored = content_store.path_for_name(filename)
+            if stored is not None:
+                manifest_cache.put(stored, manifest)
+        except OSError as e:
+            print(f"Could not keep {filename} in the content store: {e}")
+
+    manifest_cache.save()
+
+    if AUTO_SEED:
+        tcp_port = get_tcp_port(username)
+        publish_file(username, transport, filename, tcp_port)
+
+        gone = [name for name in evicted if not os.path.exists(name)]
+        if gone:
+            publish_batch(username, transport, "UNPUBLISH_BATCH", gone, tcp_port)
 
+
+# First manifest a peer offers for the file that matches the content hash; with no hash known,
+# the first manifest offered. None if no peer has one.
+def find_manifest(filename, peers, content_hash):
+    for peer_ip, peer_port in peers:
+        manifest = fetch_manifest(peer_ip, peer_port, filename)
+
+        if manifest is not None and content_hash in (None, manifest.content_hash):
+            return manifest
+
+    return None
+
+
+# Function to query the server for an active peer with a file and download it
+def query_single_peer_for_file(filename, username, transport):
     try:
-        response, _ = client_socket.recvfrom(1024)
-        response_message = response.decode()
+        response = transport.request("QUERY_FILE", filename, username)
 
-        if response_message.startswith("QUERY_SUCCESS"):
-            _, peer_ip, peer_port = response_message.split(" ")
-            peer_port = int(peer_port)
+        if response[0] == "QUERY_SUCCESS":
+            _, peer_ip, peer_port = response
+            make_parent_directory(filename)
 
             # download file from peer
             download_file_from_peer(filename, peer_ip, peer_port)
@@ -273,54 +642,100 @@ def query_peer_for_file(filename, username, client_socket, server_host, server_p
         print("Query request timed out.")
 
 
-# function do download file from peer
-def download_file_from_peer(filename, peer_ip, peer_port):
+# function do download file from peer. Data goes to <filename>.part, which is renamed once the
+# whole file has arrived; if the transfer is interrupted, the next get resumes from the end of the
+# partial file instead of starting over. With a manifest, the partial file is first cut back to its
+# last verified chunk and each chunk is checked on arrival. Returns True once the file is complete.
+def download_file_from_peer(filename, peer_ip, peer_port, manifest=None):
+    part_path = f"{filename}.part"
+    start = time.perf_counter()
+    received = 0
+
     try:
-        # Create a TCP socket to connect to the peer
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as tcp_socket:
-            # Connect to the peer
-            tcp_socket.connect((peer_ip, peer_port))
-
-            # Debug statement
-            # print(f"Connected to {peer_ip}:{peer_port}")
-
-            # Send the download request
-            request = f"DOWNLOAD {filename}"
-            tcp_socket.sendall(request.encode())
-
-            # Open a local file to save the downloaded data
-            with open(f"{filename}", "wb") as file:
-                # Debug statement
-                # print(f"Downloading {filename}...")
-                
-                # Receive the file data in chunks of 1024 bytes
-                while True:
-                    chunk = tcp_socket.recv(1024)
-                    
-                    if not chunk:  # If no more data, break out of the loop
-                        break
-
-                    file.write(chunk)  # Write the received chunk to the file
-
-            print(f"{filename} downloaded successfully.")
+        offset = verified_prefix(part_path, manifest) if manifest is not None else None
+
+        for attempt in range(DOWNLOAD_ATTEMPTS):
+            if manifest is None:
+                offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+
+            # Append to whatever has already been received
+            with open(part_path, "ab") as file:
+                output = file if manifest is None else VerifyingWriter(file, manifest, offset)
+                try:
+                    size, served_offset, written = fetch_range(peer_ip, peer_port, filename, offset, None, output)
+                finally:
+                    # Drop the unverified tail of an interrupted or rejected chunk
+                    if manifest is not None:
+                        file.truncate(output.verified)
+            received += written
+
+            # The partial file is longer than the peer's copy, so the file changed - start again
+            if served_offset != offset or (manifest is not None and size != manifest.size):
+                os.remove(part_path)
+                if manifest is not None:
+                    print(f"{peer_ip}:{peer_port} has a different version of {filename}.")
+                    return False
+                continue
+
+            if manifest is not None:
+                offset = output.verified
+
+            if (offset if manifest is not None else offset + written) == size:
+                os.replace(part_path, filename)
+                print(f"{filename} downloaded successfully ({describe_transfer(received, time.perf_counter() - start)}).")
+                return True
+
+        print(f"Download of {filename} interrupted at {os.path.getsize(part_path)} bytes - run get again to resume.")
+
+    except ChunkMismatch as e:
+        print(f"Rejected data from {peer_ip}:{peer_port}: {e}")
+
+    except TransferError as e:
+        # A peer running an older client closes range requests unanswered, so fall back to a whole-file download
+        # (unverified, so only when no manifest is expected)
+        if str(e) == "connection closed before header" and manifest is None:
+            download_whole_file(filename, peer_ip, peer_port)
+            return True
+        print(f"Error downloading file: {e}")
 
     except Exception as e:
         print(f"Error downloading file: {e}")
 
+    return False
+
+
+# Legacy download: the whole file over one connection, ending when the peer closes it
+def download_whole_file(filename, peer_ip, peer_port):
+    buffer = bytearray(1024 * 1024)
+
+    # Create a TCP socket to connect to the peer
+    with socket.create_connection((peer_ip, peer_port)) as tcp_socket:
+
+        # Send the download request
+        tcp_socket.sendall(f"DOWNLOAD {filename}".encode())
+
+        # Open a local file to save the downloaded data, replacing any partial range download
+        with open(f"{filename}.part", "wb") as file:
+            while (received := tcp_socket.recv_into(buffer)):
+                file.write(memoryview(buffer)[:received])
+
+    os.replace(f"{filename}.part", filename)
+    print(f"{filename} downloaded successfully.")
+
 
 # Main function to bring it all together
 def main():
 
     server_host, server_port = get_server_info()
     
-    client_socket = create_socket()
+    transport = create_transport(server_host, server_port)
 
     # Loop until successful authentication
     authenticated = False
     username, password = get_user_credentials()                                                     # yoda wise@!man, c3p0 droid#gold, chewy wookie+aaaawww
 
     while not authenticated:
-        if authenticate_with_server(client_socket, server_host, server_port, username, password):
+        if authenticate_with_server(transport, username, password):
             print("Welcome to BitTrickle!")
             authenticated = True  # Exit the loop on success
         else:
@@ -335,16 +750,16 @@ def main():
     tcp_server_thread.start()
 
     # Start the heartbeat mechanism in a separate thread
-    heartbeat_thread = threading.Thread(target=heart_beat_mechanism, args=(username, client_socket, server_host, server_port))
+    heartbeat_thread = threading.Thread(target=heart_beat_mechanism, args=(username, transport))
     heartbeat_thread.daemon = True  # Daemonize thread
     heartbeat_thread.start()
 
     # Command handling loop
-    print("Available commands are: get, lap, lpf, pub, sch, unp, xit")
+    print("Available commands are: get, lap, lpf, pub, sch, sts, unp, xit")
     while True:
         # Get user input
         command = input("> ").strip() 
-        if command in ['get', 'lap', 'lpf', 'sch', 'unp', 'xit'] or command.startswith("pub ") or command.startswith("unp ") or command.startswith("sch ") or command.startswith("get "):
+        if command in ['get', 'lap', 'lpf', 'sch', 'sts', 'unp', 'xit'] or command.startswith("pub ") or command.startswith("unp ") or command.startswith("sch ") or command.startswith("get "):
             
             # xit - Exit function
             if command == 'xit':
@@ -353,36 +768,48 @@ def main():
 
             # List of active users function
             if command == 'lap':
-                list_of_active_users(username, client_socket, server_host, server_port)
+                list_of_active_users(username, transport)
 
-            # Publish command
+            # Publish command - "pub <file>", "pub -r <dir>" or "pub <glob>"
             if command.startswith("pub "):
                 _, filename = command.split(maxsplit=1)
-                publish_file(username, client_socket, server_host, server_port, filename, tcp_port)
+                filenames = expand_file_argument(filename)
+                if filenames is None:
+                    publish_file(username, transport, filename, tcp_port)
+                else:
+                    publish_batch(username, transport, "PUBLISH_BATCH", filenames, tcp_port)
 
-            # Unpublish command
+            # Unpublish command - same forms as pub
             if command.startswith("unp "):
                 _, filename = command.split(maxsplit=1)
-                unpublish_file(username, client_socket, server_host, server_port, filename, tcp_port)
+                filenames = expand_file_argument(filename)
+                if filenames is None:
+                    unpublish_file(username, transport, filename, tcp_port)
+                else:
+                    publish_batch(username, transport, "UNPUBLISH_BATCH", filenames, tcp_port)
             
             # List of published files function
             if command == 'lpf':
-                listed_published_files(username, client_socket, server_host, server_port)
+                listed_published_files(username, transport)
+
+            # Server statistics
+            if command == 'sts':
+                server_stats(username, transport)
             
             # Search for files published by active peers
             if command.startswith("sch "):
                 _, substring = command.split(maxsplit=1)
-                query_active_peers_files(substring, username, client_socket, server_host, server_port)
+                query_active_peers_files(substring, username, transport)
             
             # Get a file command
             if command.startswith("get "):
                 _, filename = command.split(maxsplit=1)
-                query_peer_for_file(filename, username, client_socket, server_host, server_port)
+                query_peer_for_file(filename, username, transport)
 
         else:
-            print("Invalid command. Please enter one of: get, lap, lpf, pub, sch, unp, xit")
+            print("Invalid command. Please enter one of: get, lap, lpf, pub, sch, sts, unp, xit")
 
-    client_socket.close()
+    transport.close()
 
 # Run the main function
 if __name__ == "__main__":
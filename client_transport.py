@@ -0,0 +1,183 @@
+import heapq
+import itertools
+import socket
+import threading
+import time
+from concurrent.futures import Future
+
+import wire
+
+# Largest datagram the client will read
+MAX_DATAGRAM_SIZE = 65535
+
+# First retransmission timeout in seconds; it doubles on every retry
+INITIAL_RETRANSMIT_TIMEOUT = 0.5
+
+# Transmissions per request (the first send plus retries) before it fails with a timeout
+MAX_TRANSMISSIONS = 4
+
+# Requests allowed in flight at once; further submits wait for a slot
+MAX_IN_FLIGHT = 64
+
+# How often the receiver wakes up to check retransmission deadlines
+TICK = 0.05
+
+
+# State of one tagged request waiting for its replies
+class PendingRequest:
+    def __init__(self, datagram, complete):
+        self.datagram = datagram
+        self.complete = complete
+        self.replies = []
+        self.transmissions = 1
+        self.future = Future()
+
+
+# Client side of the UDP channel to the index server. Every request is tagged "#<id> <message>"
+# and the server echoes the tag on each reply datagram, so replies are matched to the request
+# that caused them even when several are in flight or a reply arrives late. Requests without a
+# reply are retransmitted with exponential backoff; the server answers a retransmission by
+# replaying its cached reply, so non-idempotent commands such as UNPUBLISH run only once.
+#
+# Requests are given as a command and its fields and replies come back as (key, *fields) tuples
+# (see wire.parse_text_reply). Both are sent as text until protocol is set to wire.PROTOCOL after
+# the server accepts it in AUTHX; from then on commands with a binary opcode go as binary frames,
+# with the request id in the frame header.
+class ClientTransport:
+    def __init__(self, server_host, server_port, max_in_flight=MAX_IN_FLIGHT):
+        self.server_address = (server_host, server_port)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.settimeout(TICK)
+
+        # "text", or wire.PROTOCOL once negotiated
+        self.protocol = "text"
+
+        # Monotonic time of the last datagram sent to the server
+        self.last_sent = 0.0
+
+        self._ids = itertools.count(1)
+        self._pending = {}                                                          # Format: {request id: PendingRequest}
+        self._deadlines = []                                                        # Format: [(retransmit time, request id, transmission), ...]
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._lock = threading.Lock()
+        self._closed = False
+
+        self._receiver = threading.Thread(target=self._receive_loop, daemon=True)
+        self._receiver.start()
+
+    # Send an untagged request that expects no reply, e.g. a heartbeat
+    def send(self, command, *fields):
+        self._send(self._encode(0, command, fields))
+
+    # Send a request and return a Future for its replies, a list of (key, *fields) tuples.
+    # complete(replies) decides when all replies have arrived; by default the first one is enough.
+    def submit(self, command, *fields, complete=None):
+        self._slots.acquire()
+        request_id = next(self._ids)
+        pending = PendingRequest(self._encode(request_id, command, fields), complete or (lambda replies: True))
+
+        with self._lock:
+            self._pending[request_id] = pending
+            heapq.heappush(self._deadlines, (time.monotonic() + INITIAL_RETRANSMIT_TIMEOUT, request_id, 1))
+
+        self._send(pending.datagram)
+        return pending.future
+
+    # Send a request and wait for its single reply. Raises socket.timeout if every retransmission goes unanswered.
+    def request(self, command, *fields):
+        return self.submit(command, *fields).result()[0]
+
+    # Send a request whose reply spans several datagrams and wait until complete(replies) is true
+    def request_pages(self, command, *fields, complete):
+        return self.submit(command, *fields, complete=complete).result()
+
+    def close(self):
+        self._closed = True
+        self._receiver.join()
+        self.socket.close()
+
+    # Request id 0 means untagged
+    def _encode(self, request_id, command, fields):
+        if self.protocol == wire.PROTOCOL and command in wire.REQUESTS:
+            return wire.encode_request(request_id, command, fields)
+
+        message = wire.format_text_request(command, fields)
+        return (f"#{request_id} {message}" if request_id else message).encode()
+
+    def _send(self, datagram):
+        self.socket.sendto(datagram, self.server_address)
+        self.last_sent = time.monotonic()
+
+    def _receive_loop(self):
+        while not self._closed:
+            try:
+                data, _ = self.socket.recvfrom(MAX_DATAGRAM_SIZE)
+                self._deliver(data)
+            except socket.timeout:
+                pass
+            except ValueError:
+                pass  # Malformed reply - treat it as lost
+            except OSError:
+                if self._closed:
+                    return
+
+            self._retransmit_due()
+
+    # Route a reply to its pending request; untagged replies and replies to finished requests are dropped
+    def _deliver(self, data):
+        if wire.is_binary(data):
+            request_id, reply = wire.decode_reply(data)
+
+        else:
+            text = data.decode()
+            if not text.startswith("#"):
+                return
+
+            request_id, _, text = text[1:].partition(" ")
+            request_id, reply = int(request_id), wire.parse_text_reply(text)
+
+        with self._lock:
+            pending = self._pending.get(request_id)
+            if pending is None:
+                return
+
+            pending.replies.append(reply)
+            if not pending.complete(pending.replies):
+                return
+
+            del self._pending[request_id]
+
+        self._slots.release()
+        pending.future.set_result(pending.replies)
+
+    def _retransmit_due(self):
+        now = time.monotonic()
+        resend, failed = [], []
+
+        with self._lock:
+            while self._deadlines and self._deadlines[0][0] <= now:
+                _, request_id, transmission = heapq.heappop(self._deadlines)
+                pending = self._pending.get(request_id)
+
+                # Skip requests that finished, or deadlines superseded by a later transmission
+                if pending is None or pending.transmissions != transmission:
+                    continue
+
+                if pending.transmissions >= MAX_TRANSMISSIONS:
+                    del self._pending[request_id]
+                    failed.append(pending)
+                    continue
+
+                # Replies from the earlier attempt may be partial - the server replays all of them
+                pending.replies = []
+                pending.transmissions += 1
+                backoff = INITIAL_RETRANSMIT_TIMEOUT * 2 ** (pending.transmissions - 1)
+                heapq.heappush(self._deadlines, (now + backoff, request_id, pending.transmissions))
+                resend.append(pending.datagram)
+
+        for datagram in resend:
+            self._send(datagram)
+
+        for pending in failed:
+            self._slots.release()
+            pending.future.set_exception(socket.timeout("request timed out"))
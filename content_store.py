@@ -0,0 +1,165 @@
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+# Directory of the client's content store; empty disables it
+CONTENT_STORE_DIR = os.getenv("CONTENT_STORE_DIR", ".bittrickle_store")
+
+# Bytes of content the store keeps before evicting the least recently used
+CONTENT_STORE_BYTES = int(os.getenv("CONTENT_STORE_BYTES", str(4 * 1024 * 1024 * 1024)))
+
+INDEX_NAME = "index.json"
+
+
+# Verified downloads kept by content hash, so a repeated get is answered from disk and the same
+# contents fetched under two names are stored once. Each object is a hard link to the downloaded
+# file, so keeping it costs no extra space while the working copy exists, and the peer can still
+# serve it after the working copy is deleted. Where hard links are not possible the file is copied.
+#
+# The store is bounded by max_bytes and evicts the least recently used contents first. An object
+# whose size or mtime changed (the working copy was edited in place) is dropped when next looked up.
+class ContentStore:
+    def __init__(self, directory=CONTENT_STORE_DIR, max_bytes=CONTENT_STORE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._entries = None                                                        # Format: {content hash: [size, mtime_ns, [filename, ...]]} - least recently used first
+        self._names = {}                                                            # Format: {filename: content hash}
+        self._lock = threading.Lock()
+
+    # Path of the stored object with the given contents, or None. Counts as a use for eviction.
+    def lookup(self, content_hash):
+        with self._lock:
+            entries = self._load_locked()
+            entry = entries.get(content_hash)
+            if entry is None:
+                return None
+
+            path = self._object_path(content_hash)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stat = None
+
+            if stat is None or [stat.st_size, stat.st_mtime_ns] != entry[:2]:
+                self._remove_locked(content_hash)
+                self._save_locked()
+                return None
+
+            entries.move_to_end(content_hash)
+            self._save_locked()
+            return path
+
+    # Put the stored contents at filename, if the store has them. Returns True if it did.
+    def fetch(self, content_hash, filename):
+        path = self.lookup(content_hash)
+        if path is None:
+            return False
+
+        link_or_copy(path, filename)
+
+        with self._lock:
+            entry = self._entries.get(content_hash)
+            if entry is not None and filename not in entry[2]:
+                entry[2].append(filename)
+                self._names[filename] = content_hash
+                self._save_locked()
+
+        return True
+
+    # Path of the object last stored under a filename, or None
+    def path_for_name(self, filename):
+        with self._lock:
+            self._load_locked()
+            content_hash = self._names.get(filename)
+            return None if content_hash is None else self._object_path(content_hash)
+
+    # Keep a verified download. Contents already stored are not kept twice: the downloaded file is
+    # replaced by a link to the stored object. Returns the filenames of the contents evicted to make room.
+    def add(self, filename, manifest):
+        content_hash = manifest.content_hash
+        if manifest.size > self.max_bytes:
+            return []
+
+        with self._lock:
+            entries = self._load_locked()
+            path = self._object_path(content_hash)
+            entry = entries.get(content_hash)
+
+            if entry is None:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                link_or_copy(filename, path)
+                stat = os.stat(path)
+                entry = entries[content_hash] = [stat.st_size, stat.st_mtime_ns, []]
+                self.bytes += entry[0]
+            else:
+                link_or_copy(path, filename)
+                entries.move_to_end(content_hash)
+
+            if filename not in entry[2]:
+                entry[2].append(filename)
+            self._names[filename] = content_hash
+
+            evicted = []
+            while self.bytes > self.max_bytes:
+                evicted.extend(self._remove_locked(next(iter(entries))))
+
+            self._save_locked()
+            return evicted
+
+    def _object_path(self, content_hash):
+        return os.path.join(self.directory, content_hash[:2], content_hash)
+
+    # Drop an entry and its object. Returns the filenames it was stored under.
+    def _remove_locked(self, content_hash):
+        size, _, filenames = self._entries.pop(content_hash)
+        self.bytes -= size
+        for filename in filenames:
+            if self._names.get(filename) == content_hash:
+                del self._names[filename]
+
+        path = self._object_path(content_hash)
+        try:
+            os.remove(path)
+            os.rmdir(os.path.dirname(path))                                         # Only succeeds once the directory is empty
+        except OSError:
+            pass
+
+        return filenames
+
+    def _load_locked(self):
+        if self._entries is None:
+            try:
+                with open(os.path.join(self.directory, INDEX_NAME)) as file:
+                    self._entries = OrderedDict(json.load(file))
+            except (OSError, ValueError):
+                self._entries = OrderedDict()
+
+            self.bytes = sum(entry[0] for entry in self._entries.values())
+            for content_hash, entry in self._entries.items():
+                self._names.update(dict.fromkeys(entry[2], content_hash))
+
+        return self._entries
+
+    def _save_locked(self):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, INDEX_NAME)
+        with open(f"{path}.tmp", "w") as file:
+            json.dump(self._entries, file)
+        os.replace(f"{path}.tmp", path)
+
+
+# Make target the same file as source: a hard link where possible, otherwise a copy. target is
+# replaced atomically, so a reader never sees it half written.
+def link_or_copy(source, target):
+    if os.path.exists(target) and os.path.samefile(source, target):
+        return
+
+    temporary = f"{target}.store"
+    try:
+        os.link(source, temporary)
+    except OSError:
+        shutil.copyfile(source, temporary)
+    os.replace(temporary, target)
@@ -0,0 +1,144 @@
+import hashlib
+import hmac
+import os
+import sys
+import threading
+import time
+
+# Prefix and default cost for stored password hashes
+HASH_SCHEME = "pbkdf2_sha256"
+HASH_ITERATIONS = 100_000
+
+# Minimum number of seconds between stat() calls on the credentials file
+RELOAD_CHECK_INTERVAL = 1.0
+
+
+# Hash a password for storage - format: pbkdf2_sha256$<iterations>$<salt hex>$<hash hex>
+def hash_password(password, salt=None, iterations=HASH_ITERATIONS):
+    salt = os.urandom(16) if salt is None else salt
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+    return f"{HASH_SCHEME}${iterations}${salt.hex()}${digest.hex()}"
+
+
+# Check a password against a stored entry, which is either a hash from hash_password or legacy plaintext
+def check_password(password, stored):
+    if stored.startswith(HASH_SCHEME + "$"):
+        try:
+            _, iterations, salt, expected = stored.split("$")
+            digest = hashlib.pbkdf2_hmac("sha256", password.encode(), bytes.fromhex(salt), int(iterations))
+        except ValueError:
+            return False
+        return hmac.compare_digest(digest.hex(), expected)
+
+    return hmac.compare_digest(password.encode(), stored.encode())
+
+
+# Parse "username password" lines into a dictionary, skipping blank or malformed lines
+def parse_credentials(lines):
+    credentials = {}                                                                # Format: {"username": "password or hash"}
+
+    for number, line in enumerate(lines, 1):
+        fields = line.split()
+        if not fields:
+            continue
+
+        if len(fields) != 2:
+            print(f"Skipping malformed credentials line {number}")
+            continue
+
+        credentials[fields[0]] = fields[1]
+
+    return credentials
+
+
+# In-memory view of the credentials file. The file is read once and only re-read when its
+# mtime, inode or size changes, and that check itself runs at most once per check interval.
+class CredentialStore:
+    def __init__(self, path, check_interval=RELOAD_CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self._credentials = {}
+        self._signature = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+
+    # Return True if the username exists and the password matches
+    def verify(self, username, password):
+        self._maybe_reload()
+
+        # Hash verification runs outside the lock so concurrent logins do not serialise
+        stored = self._credentials.get(username)
+        return stored is not None and check_password(password, stored)
+
+    # Re-read the file if it changed since the last load
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+
+        with self._lock:
+            if now < self._next_check:
+                return
+
+            # The next check is only scheduled once this one is done, so logins arriving meanwhile wait
+            # on the lock for the credentials instead of reading the previous (or empty) set
+            try:
+                self._reload_locked()
+            finally:
+                self._next_check = now + self.check_interval
+
+    def _reload_locked(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            if self._signature != "missing":
+                print("Credentials file not found.")
+            self._credentials, self._signature = {}, "missing"
+            return
+
+        signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if signature == self._signature:
+            return
+
+        try:
+            with open(self.path, "r") as file:
+                self._credentials = parse_credentials(file)
+            self._signature = signature
+
+        except Exception as e:
+            # Keep serving the previous credentials if the new file cannot be read
+            print(f"Error reading credentials file: {e}")
+
+
+# Rewrite a credentials file so every plaintext password is stored as a salted hash
+def upgrade_file(path):
+    with open(path, "r") as file:
+        credentials = parse_credentials(file)
+
+    lines = []
+    for username, stored in credentials.items():
+        if not stored.startswith(HASH_SCHEME + "$"):
+            stored = hash_password(stored)
+        lines.append(f"{username} {stored}\n")
+
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as file:
+        file.writelines(lines)
+    os.replace(temp_path, path)
+
+
+def main():
+    if len(sys.argv) == 3 and sys.argv[1] == "hash":
+        print(hash_password(sys.argv[2]))
+
+    elif len(sys.argv) == 3 and sys.argv[1] == "upgrade":
+        upgrade_file(sys.argv[2])
+        print(f"Hashed all plaintext passwords in {sys.argv[2]}")
+
+    else:
+        print("Usage: credentials.py hash <password> | credentials.py upgrade <credentials_file>")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import json
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+
+# Severity of each level; a line is written when its level is at least the log's threshold
+DEBUG, INFO, WARNING, ERROR, OFF = 10, 20, 30, 40, 100
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR, "off": OFF}
+
+# Lowest level written. "debug" adds a line per request (heartbeats included); "off" silences the log.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "info")
+
+# Lines per second each event may write; further lines are dropped and their count added to the next one written (0 = no limit)
+LOG_RATE_LIMIT = float(os.getenv("LOG_RATE_LIMIT", "50"))
+
+
+# Leveled, rate-limited log of "<time> <level> <event> key=value ..." lines. A call below the
+# threshold returns before formatting anything, so per-request debug lines cost one comparison when
+# they are switched off. Each event has its own token bucket, so a flood of one event (a peer
+# sending garbage, every peer's heartbeat) cannot drown out the others.
+class EventLog:
+    def __init__(self, level=LOG_LEVEL, rate_limit=LOG_RATE_LIMIT, stream=None):
+        self.threshold = LEVELS[level]
+        self.rate_limit = rate_limit
+        self.stream = stream
+        self.suppressed = 0                                                         # Lines dropped by the rate limit so far
+        self._buckets = {}                                                          # Format: {event: [tokens, last refill, lines dropped since the last one written]}
+        self._lock = threading.Lock()
+
+    def debug(self, event, **fields):
+        if self.threshold <= DEBUG:
+            self._write("debug", event, fields)
+
+    def info(self, event, **fields):
+        if self.threshold <= INFO:
+            self._write("info", event, fields)
+
+    def warning(self, event, **fields):
+        if self.threshold <= WARNING:
+            self._write("warning", event, fields)
+
+    def error(self, event, **fields):
+        if self.threshold <= ERROR:
+            self._write("error", event, fields)
+
+    def _write(self, level, event, fields):
+        if self.rate_limit:
+            now = time.monotonic()
+
+            with self._lock:
+                bucket = self._buckets.get(event)
+                if bucket is None:
+                    bucket = self._buckets[event] = [self.rate_limit, now, 0]
+
+                # Refill at rate_limit tokens per second, holding at most one second's worth
+                bucket[0] = min(self.rate_limit, bucket[0] + (now - bucket[1]) * self.rate_limit)
+                bucket[1] = now
+
+                if bucket[0] < 1:
+                    bucket[2] += 1
+                    self.suppressed += 1
+                    return
+
+                bucket[0] -= 1
+                if bucket[2]:
+                    fields["suppressed"], bucket[2] = bucket[2], 0
+
+        line = " ".join([datetime.now().isoformat(timespec="milliseconds"), level, event,
+                         *(f"{key}={format_value(value)}" for key, value in fields.items())])
+        print(line, file=self.stream or sys.stdout, flush=True)
+
+
+# A field value as written in a log line - addresses as "ip:port", quoted when it would otherwise be ambiguous
+def format_value(value):
+    text = ":".join(map(str, value)) if isinstance(value, tuple) else str(value)
+    if not text or any(character in text for character in ' ="\n'):
+        return json.dumps(text)
+    return text
@@ -0,0 +1,151 @@
+import heapq
+import threading
+import time
+
+# Fraction of a lease after which a renewal by touch() moves the deadline - more frequent touches are ignored
+TOUCH_GRANULARITY = 0.1
+
+
+# Tracks peer leases on monotonic time. Every renewal pushes a (deadline, username) entry onto a
+# min-heap; superseded entries are left in place and skipped when they surface, so expiry only
+# touches entries whose deadline has actually passed instead of scanning every peer.
+#
+# on_activate(username) and on_expire(username) are called under the tracker's lock whenever a
+# user gains or loses their lease, so listeners see transitions in the order they happened.
+#
+# Each user's lease lasts lease_seconds unless claim() granted them a different length, which is
+# kept for their renewals (and after an expiry, so a late heartbeat restores the same lease).
+class LeaseTracker:
+    def __init__(self, lease_seconds, on_activate=None, on_expire=None):
+        self.lease_seconds = lease_seconds
+        self.on_activate = on_activate
+        self.on_expire = on_expire
+        self._deadlines = {}                                                        # Format: {"username": deadline}
+        self._last_seen = {}                                                        # Format: {"username": monotonic time of last renewal}
+        self._leases = {}                                                           # Format: {"username": lease length granted at login}
+        self._heap = []                                                             # Format: [(deadline, "username"), ...]
+        self._lock = threading.Lock()
+
+    def __contains__(self, username):
+        with self._lock:
+            return username in self._deadlines
+
+    def __len__(self):
+        with self._lock:
+            return len(self._deadlines)
+
+    # Snapshot of the usernames holding a lease
+    def usernames(self):
+        with self._lock:
+            return list(self._deadlines)
+
+    # Extend (or create) the user's lease. Returns True if the user was not active before.
+    def renew(self, username, now=None):
+        now = time.monotonic() if now is None else now
+
+        with self._lock:
+            deadline = now + self._leases.get(username, self.lease_seconds)
+            is_new = username not in self._deadlines
+            self._deadlines[username] = deadline
+            self._last_seen[username] = now
+            heapq.heappush(self._heap, (deadline, username))
+            self._compact_locked()
+
+            if is_new and self.on_activate:
+                self.on_activate(username)
+
+        return is_new
+
+    # Extend the lease of a user who already holds one, as any request from them shows they are alive.
+    # Renewals within TOUCH_GRANULARITY of a lease since the last are skipped, so a busy peer's
+    # requests do not each push a heap entry. Returns False if the user holds no lease.
+    def touch(self, username, now=None):
+        now = time.monotonic() if now is None else now
+
+        with self._lock:
+            last_seen = self._last_seen.get(username)
+            if last_seen is None:
+                return False
+
+            lease = self._leases.get(username, self.lease_seconds)
+            if now - last_seen < lease * TOUCH_GRANULARITY:
+                return True
+
+            deadline = now + lease
+            self._deadlines[username] = deadline
+            self._last_seen[username] = now
+            heapq.heappush(self._heap, (deadline, username))
+            self._compact_locked()
+
+        return True
+
+    # Create a lease only if the user does not already hold one, lasting lease_seconds if given.
+    # Returns False if they do.
+    def claim(self, username, now=None, lease_seconds=None):
+        now = time.monotonic() if now is None else now
+
+        with self._lock:
+            if username in self._deadlines:
+                return False
+
+            if lease_seconds is not None:
+                self._leases[username] = lease_seconds
+
+            deadline = now + self._leases.get(username, self.lease_seconds)
+            self._deadlines[username] = deadline
+            self._last_seen[username] = now
+            heapq.heappush(self._heap, (deadline, username))
+            self._compact_locked()
+
+            if self.on_activate:
+                self.on_activate(username)
+
+        return True
+
+    # Drop the user's lease immediately. Their heap entry is discarded lazily.
+    def remove(self, username):
+        with self._lock:
+            self._last_seen.pop(username, None)
+            self._leases.pop(username, None)
+            if self._deadlines.pop(username, None) is None:
+                return False
+
+            if self.on_expire:
+                self.on_expire(username)
+            return True
+
+    # Pop every lease whose deadline has passed. Returns [(username, seconds since last renewal)].
+    def expire(self, now=None):
+        now = time.monotonic() if now is None else now
+        expired = []
+
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                deadline, username = heapq.heappop(self._heap)
+
+                # Skip entries that a later renewal has superseded
+                if self._deadlines.get(username) != deadline:
+                    continue
+
+                del self._deadlines[username]
+                expired.append((username, now - self._last_seen.pop(username)))
+
+                if self.on_expire:
+                    self.on_expire(username)
+
+        return expired
+
+    # Seconds until the earliest lease could expire, or None if nobody is active
+    def time_to_next_expiry(self, now=None):
+        now = time.monotonic() if now is None else now
+
+        with self._lock:
+            if not self._heap:
+                return None
+            return max(0.0, self._heap[0][0] - now)
+
+    # Rebuild the heap once stale entries outnumber live ones, keeping memory at O(active peers)
+    def _compact_locked(self):
+        if len(self._heap) > 4 * len(self._deadlines) + 64:
+            self._heap = [(deadline, username) for username, deadline in self._deadlines.items()]
+            heapq.heapify(self._heap)
@@ -0,0 +1,75 @@
+import threading
+
+# Round-robin state is dropped wholesale once this many files carry it
+MAX_ROUND_ROBIN_FILES = 100_000
+
+
+# Picks which publisher serves a download. Peers report their active upload count and free
+# upload bandwidth in heartbeats. When every candidate has reported, the least-loaded one wins
+# (fewest uploads, then most free bandwidth). Otherwise candidates are rotated with smooth
+# weighted round-robin, weighted by free bandwidth. Each assignment counts as one more upload
+# until the peer's next report, so a burst of queries does not all land on the same peer.
+class LoadBalancer:
+    def __init__(self):
+        self._loads = {}                                                            # Format: {"username": [active uploads, free bandwidth KB/s]}
+        self._round_robin = {}                                                      # Format: {filename: {"username": current weight}}
+        self._lock = threading.Lock()
+
+    # Record a load report from a heartbeat
+    def report(self, username, uploads, free_bandwidth):
+        with self._lock:
+            self._loads[username] = [uploads, free_bandwidth]
+
+    # Drop a peer's report, e.g. when it goes offline
+    def forget(self, username):
+        with self._lock:
+            self._loads.pop(username, None)
+
+    # Choose a publisher record ("username", ip, tcp_port) to serve the file
+    def choose(self, filename, publishers):
+        if len(publishers) == 1:
+            chosen = publishers[0]
+
+        else:
+            with self._lock:
+                if all(peer[0] in self._loads for peer in publishers):
+                    chosen = min(publishers, key=self._load_key)
+                else:
+                    chosen = self._weighted_round_robin(filename, publishers)
+
+        with self._lock:
+            load = self._loads.get(chosen[0])
+            if load is not None:
+                load[0] += 1
+
+        return chosen
+
+    # Publisher records ordered least-loaded first; peers without a report go last, in their original order
+    def rank(self, publishers):
+        with self._lock:
+            reported = sorted((peer for peer in publishers if peer[0] in self._loads), key=self._load_key)
+            return reported + [peer for peer in publishers if peer[0] not in self._loads]
+
+    def _load_key(self, peer):
+        uploads, free_bandwidth = self._loads[peer[0]]
+        return uploads, -free_bandwidth
+
+    # Smooth weighted round-robin: every pick adds each candidate's weight to its running total,
+    # takes the highest total and charges it the sum of the weights
+    def _weighted_round_robin(self, filename, publishers):
+        reported = [self._loads[peer[0]][1] for peer in publishers if peer[0] in self._loads]
+        default_weight = max(1, sum(reported) // len(reported)) if reported else 1
+        weights = {peer[0]: max(1, self._loads[peer[0]][1]) if peer[0] in self._loads else default_weight
+                   for peer in publishers}
+
+        if len(self._round_robin) > MAX_ROUND_ROBIN_FILES:
+            self._round_robin.clear()
+
+        previous = self._round_robin.get(filename, {})
+        current = {username: previous.get(username, 0) + weight for username, weight in weights.items()}
+
+        chosen = max(publishers, key=lambda peer: current[peer[0]])
+        current[chosen[0]] -= sum(weights.values())
+        self._round_robin[filename] = current
+
+        return chosen
@@ -0,0 +1,300 @@
+import hashlib
+import json
+import os
+import socket
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from transfer import TRANSFER_TIMEOUT, TransferError, read_header
+
+# Files are hashed in chunks of this size; downloads are verified one chunk at a time
+CHUNK_SIZE = 1024 * 1024
+
+# Files at least this large are hashed across the process pool, a slice of chunks per worker
+PARALLEL_HASH_THRESHOLD = 64 * 1024 * 1024
+
+# Hashing processes; 1 hashes everything in the calling thread
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", str(os.cpu_count() or 1)))
+
+# Where computed manifests are kept between runs, so republishing an unchanged file does not rehash it
+MANIFEST_CACHE_PATH = os.getenv("MANIFEST_CACHE", ".bittrickle_manifests.json")
+
+# Size of a SHA-256 digest
+DIGEST_SIZE = 32
+
+# Largest chunk size and digest list accepted in a peer's manifest - 1 MB chunks of a 1 TB file
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+MAX_MANIFEST_BYTES = 1024 * 1024 * DIGEST_SIZE
+
+
+# Chunked SHA-256 manifest of a file: the digest of every CHUNK_SIZE chunk, plus a content hash
+# over the size, chunk size and chunk digests that identifies the file's contents as a whole.
+#
+# Manifest transfer protocol (on the peer file server, one request per connection):
+#   request:  MANIFEST <filename>\n
+#   response: MANIFEST_OK <file size> <chunk size> <content hash>\n followed by the chunk digests (32 bytes each)
+#             FILE_ERR <reason>\n if the file cannot be served
+class Manifest:
+    def __init__(self, size, chunk_size, digests):
+        self.size = size
+        self.chunk_size = chunk_size
+        self.digests = digests
+        self.content_hash = hashlib.sha256(f"{size}:{chunk_size}:".encode() + b"".join(digests)).hexdigest()
+
+    # (offset, length) of a chunk
+    def chunk_range(self, index):
+        offset = index * self.chunk_size
+        return offset, min(self.chunk_size, self.size - offset)
+
+    def chunk_count(self):
+        return len(self.digests)
+
+
+# Raised when a chunk received from a peer does not match the manifest
+class ChunkMismatch(TransferError):
+    pass
+
+
+# Hash count chunks of a file starting at chunk first. Runs in the process pool for large files.
+def hash_chunks(path, first, count, chunk_size=CHUNK_SIZE):
+    digests = []
+    buffer = bytearray(chunk_size)
+
+    with open(path, "rb") as file:
+        file.seek(first * chunk_size)
+        for _ in range(count):
+            read = file.readinto(buffer)
+            if not read:
+                break
+            digests.append(hashlib.sha256(memoryview(buffer)[:read]).digest())
+
+    return digests
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _hash_pool():
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=HASH_WORKERS)
+        return _pool
+
+
+# Compute a file's manifest. Large files are split into one contiguous slice of chunks per worker.
+def compute_manifest(path, chunk_size=CHUNK_SIZE):
+    size = os.path.getsize(path)
+    chunk_count = (size + chunk_size - 1) // chunk_size
+
+    if size < PARALLEL_HASH_THRESHOLD or HASH_WORKERS < 2:
+        return Manifest(size, chunk_size, hash_chunks(path, 0, chunk_count, chunk_size))
+
+    per_worker = (chunk_count + HASH_WORKERS - 1) // HASH_WORKERS
+    slices = [_hash_pool().submit(hash_chunks, path, first, per_worker, chunk_size)
+              for first in range(0, chunk_count, per_worker)]
+
+    return Manifest(size, chunk_size, [digest for piece in slices for digest in piece.result()])
+
+
+# Manifests of local files, keyed by real path and reused while the file's size, mtime and inode are
+# unchanged. The cache is written to disk by save(), so it also survives restarts.
+class ManifestCache:
+    def __init__(self, path=MANIFEST_CACHE_PATH):
+        self.path = path
+        self._entries = None                                                        # Format: {real path: [size, mtime_ns, inode, chunk_size, hex digests]}
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    # Manifest of a local file, computed only if the file changed since it was last hashed. Raises OSError if it cannot be read.
+    def get(self, filename):
+        path = os.path.realpath(filename)
+        stat = os.stat(path)
+        key = [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+        with self._lock:
+            entry = self._load_locked().get(path)
+
+        if entry is not None and entry[:3] == key:
+            digests = bytes.fromhex(entry[4])
+            return Manifest(entry[0], entry[3], [digests[i:i + DIGEST_SIZE] for i in range(0, len(digests), DIGEST_SIZE)])
+
+        manifest = compute_manifest(path)
+
+        with self._lock:
+            self._load_locked()[path] = key + [manifest.chunk_size, b"".join(manifest.digests).hex()]
+            self._dirty = True
+
+        return manifest
+
+    # Remember the manifest of a local file known by other means (a verified download), so it is not hashed again
+    def put(self, filename, manifest):
+        path = os.path.realpath(filename)
+        stat = os.stat(path)
+
+        with self._lock:
+            self._load_locked()[path] = [stat.st_size, stat.st_mtime_ns, stat.st_ino, manifest.chunk_size,
+                                         b"".join(manifest.digests).hex()]
+            self._dirty = True
+
+    # Manifests for many files (None for files that cannot be read). Files are hashed on several
+    # threads at once - hashlib releases the GIL while hashing, and large files still go to the process pool.
+    def get_many(self, filenames):
+        if HASH_WORKERS < 2:
+            return [self._get_or_none(filename) for filename in filenames]
+
+        with ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="hash") as threads:
+            return list(threads.map(self._get_or_none, filenames))
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+
+            temporary = f"{self.path}.tmp"
+            with open(temporary, "w") as file:
+                json.dump(self._entries, file)
+            os.replace(temporary, self.path)
+            self._dirty = False
+
+    def _get_or_none(self, filename):
+        try:
+            return self.get(filename)
+        except OSError:
+            return None
+
+    def _load_locked(self):
+        if self._entries is None:
+            try:
+                with open(self.path) as file:
+                    self._entries = json.load(file)
+            except (OSError, ValueError):
+                self._entries = {}
+        return self._entries
+
+
+# File-like wrapper that hashes data on its way to disk and checks every chunk against the
+# manifest as soon as its last byte arrives. Writing must start on a chunk boundary. Raises
+# ChunkMismatch on the first bad chunk; verified is the end of the data known to be good.
+class VerifyingWriter:
+    def __init__(self, file, manifest, offset):
+        self.file = file
+        self.manifest = manifest
+        self.position = offset
+        self.verified = offset
+        self._hasher = hashlib.sha256()
+
+    def write(self, data):
+        view = memoryview(data)
+
+        while view:
+            index = self.position // self.manifest.chunk_size
+            if index >= self.manifest.chunk_count():
+                raise ChunkMismatch("data past the end of the file")
+
+            chunk_offset, chunk_length = self.manifest.chunk_range(index)
+            piece = view[:chunk_offset + chunk_length - self.position]
+
+            self._hasher.update(piece)
+            self.file.write(piece)
+            self.position += len(piece)
+            view = view[len(piece):]
+
+            if self.position == chunk_offset + chunk_length:
+                if self._hasher.digest() != self.manifest.digests[index]:
+                    raise ChunkMismatch(f"chunk {index} does not match the manifest")
+                self.verified = self.position
+                self._hasher = hashlib.sha256()
+
+        return len(data)
+
+
+# Indexes of the chunks of a local (possibly partial) file that match the manifest
+def verified_chunks(path, manifest):
+    good = set()
+
+    try:
+        with open(path, "rb") as file:
+            buffer = bytearray(manifest.chunk_size)
+            for index, digest in enumerate(manifest.digests):
+                offset, length = manifest.chunk_range(index)
+                file.seek(offset)
+                read = file.readinto(memoryview(buffer)[:length])
+                if read == length and hashlib.sha256(memoryview(buffer)[:read]).digest() == digest:
+                    good.add(index)
+    except OSError:
+        pass
+
+    return good
+
+
+# Length of the leading run of chunks of a partial file that match the manifest. The file is
+# truncated to that length, so a download can resume from the last verified chunk.
+def verified_prefix(path, manifest):
+    if not os.path.exists(path):
+        return 0
+
+    verified = 0
+    buffer = bytearray(manifest.chunk_size)
+
+    with open(path, "r+b") as file:
+        for index, digest in enumerate(manifest.digests):
+            offset, length = manifest.chunk_range(index)
+            read = file.readinto(memoryview(buffer)[:length])
+            if read != length or hashlib.sha256(memoryview(buffer)[:read]).digest() != digest:
+                break
+            verified = offset + length
+
+        file.truncate(verified)
+
+    return verified
+
+
+# Ask a peer for its manifest of a file. Returns None if the peer cannot provide one, e.g. it runs
+# an older client (which closes the connection without answering) or no longer has the file, or if
+# the header it sends is malformed or out of bounds.
+def fetch_manifest(peer_ip, peer_port, filename):
+    try:
+        with socket.create_connection((peer_ip, peer_port), timeout=TRANSFER_TIMEOUT) as conn:
+            conn.sendall(f"MANIFEST {filename}\n".encode())
+
+            header, data = read_header(conn)
+            if not header.startswith("MANIFEST_OK "):
+                return None
+
+            _, size, chunk_size, content_hash = header.split(" ")
+            size, chunk_size = int(size), int(chunk_size)
+            if size < 0 or not 0 < chunk_size <= MAX_CHUNK_SIZE:
+                raise ValueError(f"bad manifest header {header!r}")
+
+            expected = (size + chunk_size - 1) // chunk_size * DIGEST_SIZE
+            if expected > MAX_MANIFEST_BYTES:
+                raise ValueError(f"manifest of {expected} bytes is too large")
+
+            while len(data) < expected:
+                received = conn.recv(expected - len(data))
+                if not received:
+                    return None
+                data += received
+
+    except (OSError, TransferError, ValueError):
+        return None
+
+    manifest = Manifest(size, chunk_size, [data[i:i + DIGEST_SIZE] for i in range(0, expected, DIGEST_SIZE)])
+
+    # The digests must add up to the hash the peer announced
+    return manifest if manifest.content_hash == content_hash else None
+
+
+# Serve one manifest request from the local cache
+def serve_manifest(conn, filename, cache):
+    try:
+        manifest = cache.get(filename)
+    except OSError:
+        conn.sendall(b"FILE_ERR not_found\n")
+        return
+
+    conn.sendall(f"MANIFEST_OK {manifest.size} {manifest.chunk_size} {manifest.content_hash}\n".encode()
+                 + b"".join(manifest.digests))
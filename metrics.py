@@ -0,0 +1,183 @@
+import bisect
+import os
+import threading
+import time
+
+# Upper bounds in seconds of the request latency histogram buckets; slower requests fall in a final +Inf bucket
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# File the Prometheus text dump is written to (e.g. for node_exporter's textfile collector); empty disables the dump
+METRICS_PATH = os.getenv("METRICS_PATH", "")
+
+# Seconds between Prometheus dumps
+METRICS_DUMP_INTERVAL = float(os.getenv("METRICS_DUMP_INTERVAL", "15"))
+
+# Prefix of every Prometheus metric name
+PROMETHEUS_PREFIX = "bittrickle_"
+
+
+# Latency histogram with fixed buckets, cheap enough to update on every request
+class Histogram:
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)                                       # Last entry is the +Inf bucket
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+        if value > self.maximum:
+            self.maximum = value
+
+    def count(self):
+        return sum(self.counts)
+
+    # Estimate the q-quantile by linear interpolation within its bucket, the way Prometheus'
+    # histogram_quantile does. Values past the last bound are reported as the largest one seen.
+    def quantile(self, q):
+        count = self.count()
+        if not count:
+            return 0.0
+
+        rank = q * count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            if seen + bucket_count >= rank and bucket_count:
+                if index == len(self.bounds):
+                    return self.maximum
+                lower = self.bounds[index - 1] if index else 0.0
+                return min(lower + (self.bounds[index] - lower) * (rank - seen) / bucket_count, self.maximum)
+            seen += bucket_count
+
+        return self.maximum
+
+
+# In-process counters, per-command latency histograms and gauges, reported by the STATS command
+# and dumped in the Prometheus text format. Counters are (name, label) pairs, where the label is
+# usually a command. Gauges are functions read when a report is made, so index sizes cost nothing
+# between reports; a gauge returning None is left out.
+class Metrics:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.labels = {}                                                            # Format: {label: value} - added to every metric, e.g. the shard
+        self._counters = {}                                                         # Format: {(name, label or None): count}
+        self._latencies = {}                                                        # Format: {command: Histogram}
+        self._gauges = {}                                                           # Format: {name: function returning the current value}
+        self._lock = threading.Lock()
+
+    def count(self, name, label=None, amount=1):
+        key = (name, label)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def counter(self, name, label=None):
+        return self._counters.get((name, label), 0)
+
+    # Record how long a request took, from receiving its datagram to sending its reply
+    def observe(self, command, seconds):
+        with self._lock:
+            histogram = self._latencies.get(command)
+            if histogram is None:
+                histogram = self._latencies[command] = Histogram()
+            histogram.observe(seconds)
+
+    def gauge(self, name, function):
+        self._gauges[name] = function
+
+    # Report as "name=value" items, for the STATS reply: uptime, requests and latency percentiles per
+    # command, then counters and gauges. Items are prefixed with the labels, e.g. "shard0.".
+    def items(self):
+        prefix = "".join(f"{label}{value}." for label, value in self.labels.items())
+        items = [f"uptime_s={time.monotonic() - self.started:.0f}"]
+
+        with self._lock:
+            latencies = sorted(self._latencies.items())
+            counters = sorted(self._counters.items(), key=lambda entry: (entry[0][0], entry[0][1] or ""))
+
+            for command, histogram in latencies:
+                items.append(f"requests.{command}={histogram.count()}")
+                for name, q in (("p50", 0.5), ("p99", 0.99)):
+                    items.append(f"latency_ms.{command}.{name}={histogram.quantile(q) * 1000:.3f}")
+                items.append(f"latency_ms.{command}.max={histogram.maximum * 1000:.3f}")
+
+        for (name, label), value in counters:
+            items.append(f"{name}={value}" if label is None else f"{name}.{label}={value}")
+
+        for name, value in self.read_gauges():
+            items.append(f"{name}={value}")
+
+        return [prefix + item for item in items]
+
+    # Report in the Prometheus text exposition format
+    def prometheus(self):
+        lines = []
+
+        with self._lock:
+            latencies = sorted(self._latencies.items())
+            counters = sorted(self._counters.items(), key=lambda entry: (entry[0][0], entry[0][1] or ""))
+
+            name = PROMETHEUS_PREFIX + "request_seconds"
+            lines.append(f"# TYPE {name} histogram")
+            for command, histogram in latencies:
+                cumulative = 0
+                for bound, bucket_count in zip([*histogram.bounds, "+Inf"], histogram.counts):
+                    cumulative += bucket_count
+                    lines.append(f"{name}_bucket{self._labels(command=command, le=bound)} {cumulative}")
+                lines.append(f"{name}_sum{self._labels(command=command)} {histogram.total}")
+                lines.append(f"{name}_count{self._labels(command=command)} {cumulative}")
+
+        typed = set()
+        for (counter_name, label), value in counters:
+            name = f"{PROMETHEUS_PREFIX}{counter_name}_total"
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{self._labels() if label is None else self._labels(command=label)} {value}")
+
+        lines.append(f"# TYPE {PROMETHEUS_PREFIX}uptime_seconds gauge")
+        lines.append(f"{PROMETHEUS_PREFIX}uptime_seconds{self._labels()} {time.monotonic() - self.started:.3f}")
+        for gauge_name, value in self.read_gauges():
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}{gauge_name} gauge")
+            lines.append(f"{PROMETHEUS_PREFIX}{gauge_name}{self._labels()} {value}")
+
+        return "\n".join(lines) + "\n"
+
+    # Write the Prometheus dump to a file, replacing it atomically so a scraper never reads half of one
+    def dump(self, path):
+        with open(path + ".tmp", "w") as file:
+            file.write(self.prometheus())
+        os.replace(path + ".tmp", path)
+
+    # Current (name, value) of every gauge that has a value
+    def read_gauges(self):
+        readings = []
+        for name, function in sorted(self._gauges.items()):
+            value = function()
+            if value is not None:
+                readings.append((name, value))
+        return readings
+
+    def _labels(self, **extra):
+        labels = {**self.labels, **extra}
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{label}="{value}"' for label, value in labels.items()) + "}"
+
+
+# Receive queue length in bytes and the kernel's drop count for a UDP socket, read from /proc/net/udp by the
+# socket's inode. Returns None where that is not available (not Linux, or the socket is gone).
+def udp_socket_stats(sock):
+    try:
+        inode = str(os.fstat(sock.fileno()).st_ino)
+        for table in ("/proc/net/udp", "/proc/net/udp6"):
+            with open(table) as file:
+                next(file)                                                          # Column headings
+                for line in file:
+                    fields = line.split()
+                    if fields[9] == inode:
+                        return int(fields[4].split(":")[1], 16), int(fields[12])
+    except (OSError, IndexError, ValueError):
+        pass
+
+    return None
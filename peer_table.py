@@ -0,0 +1,102 @@
+import socket
+import sys
+from array import array
+
+# Set in a packed address whose ip is not IPv4; the ip is then kept aside and only the port is packed
+OTHER_HOST = 1 << 48
+
+MAX_PORT = 0xFFFF
+
+
+# Pack an IPv4 address and TCP port into one integer, ip << 16 | port. Returns None for anything
+# else (IPv6, host names, a port outside 0-65535 that would spill into the address bits), which
+# PeerTable stores unpacked.
+def pack_address(ip, tcp_port):
+    if not 0 <= tcp_port <= MAX_PORT:
+        return None
+
+    try:
+        return int.from_bytes(socket.inet_pton(socket.AF_INET, ip), "big") << 16 | tcp_port
+    except (OSError, TypeError):
+        return None
+
+
+# Peer records - ("username", ip, tcp_port) - stored once each and referred to by integer peer ids.
+# A catalog of millions of publications then holds one small id per publication instead of a
+# tuple with its own copies of the ip and port. Usernames are interned, and an IPv4 address and
+# port are packed into a single integer in an array. Ids are reference counted by the publications
+# that use them, and the id of a record nobody uses any more is reused.
+class PeerTable:
+    def __init__(self):
+        self.usernames = []                                                         # Format: ["username" or None for a free id] by peer id
+        self.addresses = array("Q")                                                 # Format: ip << 16 | tcp_port by peer id, see pack_address
+        self.references = array("I")                                                # Format: publications using each peer id
+        self._ids = {}                                                              # Format: {("username", packed address, or ip and tcp_port when unpacked): peer id}
+        self._other_hosts = {}                                                      # Format: {peer id: ip} - peers whose ip could not be packed
+        self._free = []                                                             # Peer ids to reuse
+
+    # Number of peer records in use
+    def __len__(self):
+        return len(self._ids)
+
+    # Id of a peer record, or None if no publication uses it
+    def find(self, username, ip, tcp_port):
+        return self._ids.get(self._key(username, ip, tcp_port))
+
+    # Id of a peer record, created if needed, with its reference count raised by references.
+    # Raises ValueError for a port outside 0-65535.
+    def acquire(self, username, ip, tcp_port, references=1):
+        if not 0 <= tcp_port <= MAX_PORT:
+            raise ValueError(f"tcp port {tcp_port} out of range")
+
+        key = self._key(username, ip, tcp_port)
+        peer_id = self._ids.get(key)
+        if peer_id is not None:
+            self.references[peer_id] += references
+            return peer_id
+
+        username = sys.intern(username)
+        packed = key[1] if len(key) == 2 else None
+        address = OTHER_HOST | tcp_port if packed is None else packed
+
+        if self._free:
+            peer_id = self._free.pop()
+            self.usernames[peer_id] = username
+            self.addresses[peer_id] = address
+            self.references[peer_id] = references
+        else:
+            peer_id = len(self.usernames)
+            self.usernames.append(username)
+            self.addresses.append(address)
+            self.references.append(references)
+
+        if packed is None:
+            self._other_hosts[peer_id] = ip
+
+        self._ids[(username, *key[1:])] = peer_id
+        return peer_id
+
+    # Drop one reference to a peer id, freeing it when it was the last
+    def release(self, peer_id):
+        self.references[peer_id] -= 1
+        if self.references[peer_id]:
+            return
+
+        del self._ids[self._key(*self.record(peer_id))]
+        self._other_hosts.pop(peer_id, None)
+        self.usernames[peer_id] = None
+        self._free.append(peer_id)
+
+    # The ("username", ip, tcp_port) record of a peer id
+    def record(self, peer_id):
+        address = self.addresses[peer_id]
+        if address & OTHER_HOST:
+            ip = self._other_hosts[peer_id]
+        else:
+            ip = socket.inet_ntop(socket.AF_INET, (address >> 16).to_bytes(4, "big"))
+        return self.usernames[peer_id], ip, address & 0xFFFF
+
+    @staticmethod
+    def _key(username, ip, tcp_port):
+        packed = pack_address(ip, tcp_port)
+        return (username, ip, tcp_port) if packed is None else (username, packed)
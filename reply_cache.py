@@ -0,0 +1,49 @@
+import threading
+import time
+from collections import OrderedDict
+
+# Seconds a tagged request's replies are kept for answering retransmissions
+REPLY_CACHE_TTL = 30.0
+
+# Most tagged requests remembered at once; the oldest are dropped first
+MAX_CACHED_REQUESTS = 20_000
+
+
+# Remembers the reply datagrams sent for each tagged request, keyed on (client address, tag), so a
+# retransmitted request is answered by replaying them instead of running the command again. An entry
+# exists from the moment the request starts, so a duplicate that arrives while it is still being
+# handled (e.g. an AUTH waiting on the worker pool) is dropped rather than executed twice.
+class ReplyCache:
+    def __init__(self, ttl=REPLY_CACHE_TTL, max_requests=MAX_CACHED_REQUESTS):
+        self.ttl = ttl
+        self.max_requests = max_requests
+        self._entries = OrderedDict()                                               # Format: {(address, tag): (created, [datagram, ...])}
+        self._lock = threading.Lock()
+
+    # Start a request. Returns (replies, is_new): for a new request, replies is the list its reply
+    # datagrams are recorded into; for a duplicate, it is a copy of the datagrams already sent.
+    def begin(self, address, tag, now=None):
+        now = time.monotonic() if now is None else now
+        key = (address, tag)
+
+        with self._lock:
+            self._evict_locked(now)
+
+            entry = self._entries.get(key)
+            if entry is not None:
+                return list(entry[1]), False
+
+            replies = []
+            self._entries[key] = (now, replies)
+            return replies, True
+
+    def __len__(self):
+        return len(self._entries)
+
+    # Entries are in creation order, so expired ones are always at the front
+    def _evict_locked(self, now):
+        while self._entries:
+            _, (created, _) = next(iter(self._entries.items()))
+            if now - created < self.ttl and len(self._entries) < self.max_requests:
+                break
+            self._entries.popitem(last=False)
@@ -0,0 +1,75 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Most results kept at once, and the most bytes of filenames and addresses they may hold; the least recently used go first
+RESULT_CACHE_ENTRIES = int(os.getenv("RESULT_CACHE_ENTRIES", "10000"))
+RESULT_CACHE_BYTES = int(os.getenv("RESULT_CACHE_BYTES", str(32 * 1024 * 1024)))
+
+# Seconds a result may still be served after the catalog has changed under it. 0 (the default) serves only
+# exact results, so any change invalidates; a longer window trades freshness for fewer index lookups.
+RESULT_CACHE_STALENESS = float(os.getenv("RESULT_CACHE_STALENESS", "0"))
+
+# Bytes charged per entry and per item on top of the item's own length, roughly the objects holding them
+ENTRY_OVERHEAD = 200
+ITEM_OVERHEAD = 60
+
+
+# LRU cache of computed results (search matches, a file's live publishers) tagged with the catalog
+# generation they were computed at. The catalog bumps its generation on every change, so a result
+# with the current generation is exact. With a staleness window, one from an older generation is
+# still served while it is younger than staleness seconds, which keeps hot queries off the index
+# while the catalog churns; after that it is dropped and recomputed. Compare the generation read before computing a result,
+# so a change made meanwhile makes it stale rather than current.
+class ResultCache:
+    def __init__(self, max_entries=RESULT_CACHE_ENTRIES, max_bytes=RESULT_CACHE_BYTES, staleness=RESULT_CACHE_STALENESS):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.staleness = staleness
+        self.bytes = 0
+        self._entries = OrderedDict()                                               # Format: {key: (generation, computed at, result, size)} - least recently used first
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    # Cached result for key, or None when it must be computed. Returns (result, exact), where exact
+    # is False for a result served from an older generation.
+    def get(self, key, generation, now=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None, False
+
+            if entry[0] == generation:
+                self._entries.move_to_end(key)
+                return entry[2], True
+
+            now = time.monotonic() if now is None else now
+            if now - entry[1] < self.staleness:
+                self._entries.move_to_end(key)
+                return entry[2], False
+
+            del self._entries[key]
+            self.bytes -= entry[3]
+            return None, False
+
+    # Remember a result computed at generation. Results too big for the cache are not kept.
+    def put(self, key, generation, result, now=None):
+        now = time.monotonic() if now is None else now
+        size = ENTRY_OVERHEAD + sum(ITEM_OVERHEAD + len(str(item)) for item in result)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous[3]
+
+            self._entries[key] = (generation, now, result, size)
+            self.bytes += size
+
+            while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+                _, (_, _, _, evicted_size) = self._entries.popitem(last=False)
+                self.bytes -= evicted_size
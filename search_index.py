@@ -0,0 +1,114 @@
+# Length of the n-grams used as index keys
+GRAM_SIZE = 3
+
+# Fall back to a full scan when the rarest query trigram covers more than 1/SCAN_FRACTION of the catalog
+SCAN_FRACTION = 8
+
+
+# Set of distinct trigrams in a string
+def trigrams(text):
+    return {text[i:i + GRAM_SIZE] for i in range(len(text) - GRAM_SIZE + 1)}
+
+
+# Trigram inverted index over filenames for substring search. A filename can only contain the
+# query if it contains every trigram of the query, so the posting set of the query's rarest
+# trigram is a small candidate list that is then confirmed with a plain `in` check. Results
+# come back in the order filenames were first added, matching iteration over published_files.
+class TrigramIndex:
+    def __init__(self):
+        self._postings = {}                                                         # Format: {"gram": {filename, ...}}
+        self._order = {}                                                            # Format: {filename: insertion sequence}
+        self._sequence = 0
+        self._unindexed = {}                                                        # Format: {filename: None} - added, trigrams not posted yet
+
+    def __len__(self):
+        return len(self._order)
+
+    def __contains__(self, filename):
+        return filename in self._order
+
+    # Index a filename (no-op if it is already indexed). While deferred filenames are waiting to be
+    # indexed, new ones join them.
+    def add(self, filename):
+        if filename in self._order:
+            return
+
+        self._sequence += 1
+        self._order[filename] = self._sequence
+
+        if self._unindexed:
+            self._unindexed[filename] = None
+        else:
+            self._post(filename)
+
+    # Add many filenames in order, deferring their trigrams until index_pending() posts them. Searches
+    # check deferred filenames directly, so they are found straight away. Used to load a large catalog quickly.
+    def add_many(self, filenames):
+        added = [filename for filename in dict.fromkeys(filenames) if filename not in self._order] if self._order else list(filenames)
+        self._order.update(zip(added, range(self._sequence + 1, self._sequence + 1 + len(added))))
+        self._sequence += len(added)
+        self._unindexed.update(dict.fromkeys(added))
+
+    # Post the trigrams of up to limit deferred filenames (all of them by default). Returns how many are left.
+    def index_pending(self, limit=None):
+        count = len(self._unindexed) if limit is None else min(limit, len(self._unindexed))
+
+        for _ in range(count):
+            self._post(self._unindexed.popitem()[0])
+
+        return len(self._unindexed)
+
+    # Number of deferred filenames whose trigrams are not posted yet
+    def pending(self):
+        return len(self._unindexed)
+
+    # Remove a filename from the index (no-op if it is not indexed)
+    def remove(self, filename):
+        if self._order.pop(filename, None) is None:
+            return
+
+        # A deferred filename has no postings yet
+        if filename in self._unindexed:
+            del self._unindexed[filename]
+            return
+
+        for gram in trigrams(filename):
+            postings = self._postings[gram]
+            postings.discard(filename)
+            if not postings:
+                del self._postings[gram]
+
+    # Every indexed filename containing the substring, in insertion order
+    def search(self, substring):
+        # Queries shorter than a trigram have no key to look up, so check every filename
+        if len(substring) < GRAM_SIZE:
+            return [filename for filename in self._order if substring in filename]
+
+        smallest = None
+        for gram in trigrams(substring):
+            postings = self._postings.get(gram)
+            if not postings:
+                smallest = ()
+                break
+            if smallest is None or len(postings) < len(smallest):
+                smallest = postings
+
+        # An unselective query matches a large share of the catalog anyway, and a scan in
+        # insertion order is cheaper than verifying and re-sorting that many candidates
+        if len(smallest) * SCAN_FRACTION > len(self._order):
+            return [filename for filename in self._order if substring in filename]
+
+        # Candidates come from the rarest trigram, plus any deferred filenames; the `in` check confirms the full substring
+        matches = [filename for filename in smallest if substring in filename]
+        if self._unindexed:
+            matches.extend(filename for filename in self._unindexed if substring in filename)
+        matches.sort(key=self._order.__getitem__)
+        return matches
+
+    def _post(self, filename):
+        for gram in trigrams(filename):
+            postings = self._postings.get(gram)
+            if postings is None:
+                self._postings[gram] = {filename}
+            else:
+                postings.add(filename)
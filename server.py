@@ -1,365 +1,951 @@
+import signal
 import socket
 import sys
 import os
-from datetime import datetime, timedelta
+from datetime import timedelta
 import time
 import threading
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from catalog import Catalog
+from catalog_store import CATALOG_STATE_DIR, JOURNAL_FLUSH_INTERVAL, CatalogStore
+from credentials import CredentialStore
+from event_log import EventLog
+from liveness import LeaseTracker
+from load_balancing import LoadBalancer
+from peer_table import MAX_PORT
+from metrics import METRICS_DUMP_INTERVAL, METRICS_PATH, Metrics, udp_socket_stats
+from reply_cache import ReplyCache
+from result_cache import ResultCache
+import sharding
+import wire
+
+# Set the allowed heartbeat interval - the lease of clients that do not negotiate one
+HEARTBEAT_INTERVAL = timedelta(seconds=3)  
 
-# Dictionary to store active peers and their last heartbeat time
-active_peers = {}                                                                   # Format: {"username": last_heartbeat}
+# Renewal interval suggested to clients that negotiate a lease: it grows with the number of active
+# peers so their heartbeats stay near HEARTBEAT_BUDGET per second in total, between these bounds
+MIN_RENEW_INTERVAL = 1.0
+MAX_RENEW_INTERVAL = float(os.getenv("MAX_RENEW_INTERVAL", "10"))
+HEARTBEAT_BUDGET = int(os.getenv("HEARTBEAT_BUDGET", "1000"))
 
-# Dictionary to store published files for each user
-published_files = {}                                                                # Format: {filename: {“username”: datetime.datetime(YYYY, MM, DD, MM, SS, ..}
+# A granted lease lasts this many renewal intervals, so a lost heartbeat or two never evicts a peer
+LEASE_RENEWALS = 3
 
-# Set the allowed heartbeat interval
-HEARTBEAT_INTERVAL = timedelta(seconds=3)  
+# Minimum seconds between forwarding a user's request-driven lease renewal to their home shard
+TOUCH_FORWARD_INTERVAL = 1.0
+
+# Position of the username among each command's arguments, for renewing the lease of the peer sending it
+USERNAME_ARGUMENTS = {
+    "ACTIVE_PEERS": 0,
+    "PUBLISH": 0,
+    "UNPUBLISH": 0,
+    "LIST_FILES": 0,
+    "SEARCH_FILES": 1,
+    "QUERY_FILE": 1,
+    "QUERY_PEERS": 1,
+    "PUBLISH_BATCH": 0,
+    "UNPUBLISH_BATCH": 0,
+    "QUERY_CONTENT": 1,
+    "QUERY_HASH": 1,
+    "STATS": 0,
+}
+
+# Published files, indexed by filename, by publisher and by trigram
+catalog = Catalog()                                                                 # Format: {filename: (peer id, ...)} - see catalog.py
+
+# Snapshot and journal the catalog is restored from on startup, so clients need not republish after a restart
+catalog_store = CatalogStore(CATALOG_STATE_DIR) if CATALOG_STATE_DIR else None
+
+# Upload load reported by peers in their heartbeats, used to pick which publisher serves a download
+load_balancer = LoadBalancer()
+
+
+# Called when a peer goes offline - its files lose a live publisher and its load report is stale
+def peer_offline(username):
+    catalog.peer_offline(username)
+    load_balancer.forget(username)
+
+
+# Lease tracker for active peers, expired on monotonic deadlines. Lease changes keep the catalog's live publisher sets current.
+active_peers = LeaseTracker(HEARTBEAT_INTERVAL.total_seconds(),                     # Format: {"username": heartbeat deadline}
+                            on_activate=catalog.peer_online, on_expire=peer_offline)
+
+# Credentials are loaded once and reloaded only when the file changes. Set the default credentials path which is in the working directory
+credential_store = CredentialStore(os.getenv("CREDENTIALS_PATH", "./credentials.txt"))
+
+# Replies sent to tagged requests, replayed when a client retransmits instead of running the command again
+reply_cache = ReplyCache()
+
+# Recent SEARCH_FILES and QUERY_FILE results, tagged with the catalog generation they were computed at
+result_cache = ResultCache()
+
+# Request counters, latency histograms and gauges, reported by STATS and the Prometheus dump
+metrics = Metrics()
+
+# Leveled, rate-limited server log - per-request lines are debug level, so they are off unless LOG_LEVEL=debug
+log = EventLog()
+
+# Commands whose handlers do blocking work (credential reloads, password hashing) and must not run on the request loop
+BLOCKING_COMMANDS = {"AUTH", "AUTHX"}
+
+# Channel to the other worker processes when running sharded, else None
+shard_channel = None
+
+# Last load report shared with the other shards for each user homed on this one
+shared_loads = {}                                                                   # Format: {"username": (active uploads, free bandwidth)}
+
+# When a request-driven lease renewal was last forwarded to each user's home shard
+forwarded_touches = {}                                                              # Format: {"username": monotonic time}
+
+# Number of worker threads used for blocking handlers
+BLOCKING_WORKERS = int(os.getenv("BLOCKING_WORKERS", "4"))
+
+# Largest datagram the server will read
+MAX_DATAGRAM_SIZE = 65535
+
+# Receive buffer asked for on the UDP socket, so a burst of requests (a crowd of peers logging in at
+# once) queues instead of being dropped by the kernel. Linux caps it at net.core.rmem_max.
+UDP_RECEIVE_BUFFER = int(os.getenv("UDP_RECEIVE_BUFFER", str(4 * 1024 * 1024)))
+
+# Bounds for the page size a client may ask for - the upper bound fits a 1500 byte Ethernet MTU without IP fragmentation
+MIN_PAGE_SIZE = 256
+MAX_PAGE_SIZE = 1472
+
+# Pages sent per paged reply before the client has to follow the continuation cursor
+MAX_PAGES_PER_REPLY = 32
+
+# Largest legacy (un-paged) list reply - an IPv4 UDP payload less room for the request tag. Longer lists are truncated.
+MAX_LEGACY_REPLY_SIZE = 65507 - 64
+
+# Characters of a hex content hash
+HEX_DIGITS = set("0123456789abcdef")
 
 # Function to handle incoming requests from clients (UDP)
-def handle_request(server_socket):
+def handle_request(server_socket, executor):
 
     # Receive request data and client address
-    request, client_address = server_socket.recvfrom(1024)
-    message = request.decode()
+    data, client_address = server_socket.recvfrom(MAX_DATAGRAM_SIZE)
+    received = time.perf_counter()
 
-    # User authenticaion function
-    if message.startswith("AUTH "):
-        handle_authentication(server_socket, message, client_address)
+    request = read_datagram(data, client_address)
+    if request is None:
+        return
 
-    # Heartbeat function
-    elif message.startswith("HEARTBEAT "):
-        handle_heartbeat(client_address, message)
+    # Blocking commands go to the worker pool so a burst of logins cannot starve heartbeats
+    if request[1] in BLOCKING_COMMANDS:
+        metrics.count("blocking_submitted")
+        executor.submit(run_blocking, dispatch_request, server_socket, request, client_address, received)
+    else:
+        dispatch_request(server_socket, request, client_address, received)
 
-    # Active peers function
-    elif message.startswith("ACTIVE_PEERS"):
-        send_active_peers_list(server_socket, message, client_address)
-    
-    # Publish files function
-    elif message.startswith("PUBLISH"):
-        handle_published_files(server_socket, message, client_address)
 
-    # Unpublish files function
-    elif message.startswith("UNPUBLISH"):  
-        handle_unpublish_file(server_socket, message, client_address)
+# Read a datagram as a request (see read_request), or count and log it and return None if it is malformed
+def read_datagram(data, client_address):
+    try:
+        return read_request(data)
+    except ValueError as e:
+        metrics.count("malformed_datagrams")
+        log.warning("malformed_datagram", client=client_address, error=e)
+        return None
 
-    # list of published files function
-    elif message.startswith("LIST_FILES"):  
-        handle_list_published_files(server_socket, message, client_address)
 
-    # Search for files published by active users
-    elif message.startswith("SEARCH_FILES"):  
-        handle_search_files(server_socket, message, client_address)
-    
-    # Query and Download file in TCP
-    elif message.startswith("QUERY_FILE"):
-       handle_query_file(server_socket, message, client_address)
+# Run a blocking command's work on the worker pool, counted so STATS shows the pool's backlog
+def run_blocking(function, *args):
+    try:
+        return function(*args)
+    finally:
+        metrics.count("blocking_completed")
+
+
+# Split an optional "#<id>" tag off a text request. Returns (tag or None, message).
+def split_tag(message):
+    if message.startswith("#"):
+        tag, _, message = message.partition(" ")
+        return tag, message
+
+    return None, message
+
+
+# Read a datagram as (tag or None, command, body, binary). Text bodies are the request string with the
+# "#<id>" tag removed; binary bodies are the decoded fields, tagged with the header's request id.
+# Raises ValueError for undecodable datagrams.
+def read_request(data):
+    if wire.is_binary(data):
+        request_id, command, fields = wire.decode_request(data)
+        return request_id or None, command, fields, True
+
+    tag, message = split_tag(data.decode())
+    return tag, message.split(" ", 1)[0], message, False
+
+
+# Stand-in for the socket when answering a tagged request: every reply datagram is recorded in
+# the reply cache, and text replies are prefixed with the request's tag so the client can match them
+# (binary replies carry the request id in their header instead)
+class TaggedSender:
+    def __init__(self, sender, prefix, replies):
+        self.sender = sender
+        self.prefix = prefix
+        self.replies = replies
+
+    def sendto(self, data, address):
+        data = self.prefix + data
+        self.replies.append(data)
+        self.sender.sendto(data, address)
+
+
+# Function to route a request to its handler using the command dispatch table. Each command is
+# parsed into arguments first (from text, or straight from the binary fields), then executed; the
+# handler's reply is serialized in the protocol the request came in. Tagged requests get tagged
+# replies, and a retransmitted tag is answered from the reply cache. received is the perf_counter()
+# time the datagram arrived, so the command's latency includes any time spent queued.
+def dispatch_request(server_socket, request, client_address, received):
+    prepared = prepare_request(server_socket, request, client_address, received)
+
+    if prepared is not None:
+        renew_lease(prepared.command, prepared.args)
+        prepared.respond(run_handler(prepared.command, prepared.args, client_address))
+
+
+# A request that has been parsed and is waiting for its handler's reply
+class PreparedRequest:
+    def __init__(self, sender, client_address, command, args, paging, binary, request_id, received):
+        self.sender = sender
+        self.client_address = client_address
+        self.command = command
+        self.args = args
+        self.paging = paging
+        self.binary = binary
+        self.request_id = request_id
+        self.received = received
+
+    # Send the handler's reply in the protocol the request came in (nothing for None), and record the command's latency.
+    # A reply that cannot be sent is counted and logged like a handler error, so it never takes the server loop down.
+    def respond(self, reply):
+        if reply is not None:
+            try:
+                send_reply(self.sender, self.client_address, reply, self.paging, self.binary, self.request_id)
+            except OSError as e:
+                metrics.count("send_errors", self.command)
+                log.error("send_error", command=self.command, client=self.client_address, error=e)
+
+        metrics.observe(self.command, time.perf_counter() - self.received)
+
+
+# Parse a request and claim its slot in the reply cache. Returns a PreparedRequest, or None if the request
+# needs no handler: it is unknown, malformed (answered with the command's failure reply) or a duplicate
+# of a tagged request (answered from the reply cache).
+def prepare_request(server_socket, request, client_address, received):
+    tag, command, body, binary = request
+    entry = COMMAND_HANDLERS.get(command)
 
     # If any weird values occur in the handle request portion
+    if entry is None:
+        metrics.count("unknown_commands")
+        log.warning("unknown_command", client=client_address, message=body)
+        return None
+
+    parse, _, failure = entry
+
+    if tag is not None:
+        replies, is_new = reply_cache.begin(client_address, tag)
+
+        # Duplicate - resend what the first copy produced (nothing yet if it is still running)
+        if not is_new:
+            metrics.count("retransmits_replayed", command)
+            for datagram in replies:
+                server_socket.sendto(datagram, client_address)
+            return None
+
+        server_socket = TaggedSender(server_socket, b"" if binary else f"{tag} ".encode(), replies)
+
+    request_id = tag if binary and tag else 0
+    paging = None
+
+    # A malformed request must never take the server loop down with it
+    try:
+        if binary:
+            args = body
+            if command in wire.PAGED_COMMANDS:
+                args, paging = body[:-2], clamp_paging(*body[-2:])
+        else:
+            message = body
+            if command in wire.PAGED_COMMANDS:
+                message, paging = split_paging(message)
+            args = parse(message)
+
+    except Exception as e:
+        metrics.count("malformed_requests", command)
+        log.warning("malformed_request", command=command, client=client_address, error=e)
+        if failure is not None:
+            send_reply(server_socket, client_address, failure, paging, binary, request_id)
+        return None
+
+    return PreparedRequest(server_socket, client_address, command, args, paging, binary, request_id, received)
+
+
+# Run a command's handler and return its reply - the command's failure reply if the handler raises
+def run_handler(command, args, client_address):
+    _, handler, failure = COMMAND_HANDLERS[command]
+
+    try:
+        return handler(client_address, *args)
+
+    except Exception as e:
+        metrics.count("handler_errors", command)
+        log.error("handler_error", command=command, client=client_address, error=e)
+        return failure
+
+
+# Clamp a requested page size to a safe UDP payload. Returns (cursor, page_size).
+def clamp_paging(cursor, page_size):
+    return cursor, min(max(page_size, MIN_PAGE_SIZE), MAX_PAGE_SIZE)
+
+
+# Split an optional trailing "PAGE <cursor> <page_size>" off a request. Returns (message, paging) where
+# paging is None for legacy single-datagram replies, or (cursor, page_size) with page_size clamped to a safe UDP payload.
+def split_paging(message):
+    parts = message.rsplit(" ", 3)
+
+    if len(parts) == 4 and parts[1] == "PAGE" and parts[2].isdigit() and parts[3].isdigit():
+        return parts[0], clamp_paging(int(parts[2]), int(parts[3]))
+
+    return message, None
+
+
+# Send a handler's reply, (key, *fields) or (key, items) for list replies, as text or binary
+def send_reply(server_socket, client_address, reply, paging, binary, request_id):
+    key = reply[0]
+
+    if key in wire.LIST_REPLIES:
+        send_list_response(server_socket, client_address, key, reply[1], paging, binary, request_id)
+    elif binary:
+        server_socket.sendto(wire.encode_reply(request_id, key, reply[1:]), client_address)
     else:
-        print(f"Received unrecognized message from {client_address}: {message}")
+        server_socket.sendto(" ".join(str(field) for field in reply).encode(), client_address)
 
 
-# Function to handle authentication requests - Helper function for authenticate user funcyoon.
-def handle_authentication(server_socket, message, client_address):
+# Pack the items from the cursor onwards into page bodies of at most page_size bytes, up to
+# MAX_PAGES_PER_REPLY pages. Returns (pages, position of the first item left out).
+def paginate(key, items, cursor, page_size):
+    body_budget = page_size - len(key) - 48                                         # Room for the page header
+
+    # Greedily pack whole items into page bodies
+    pages = []
+    body, position = [], cursor
+    body_length = 0
+
+    while position < len(items) and len(pages) < MAX_PAGES_PER_REPLY:
+        item_length = len(items[position].encode()) + 2                             # ", " separator or binary length prefix
+
+        # Start a new page when this item does not fit - an oversized item still gets a page to itself
+        if body and body_length + item_length > body_budget:
+            pages.append(body)
+            body, body_length = [], 0
+            continue
+
+        body.append(items[position])
+        body_length += item_length
+        position += 1
+
+    if body or not pages:
+        pages.append(body)
+
+    return pages, position
+
+
+# A legacy list reply, "<key> a, b, c", cut after the last whole item that fits in MAX_LEGACY_REPLY_SIZE bytes
+def legacy_list_datagram(key, items):
+    datagram = f"{key} {', '.join(items)}".encode()
+    if len(datagram) <= MAX_LEGACY_REPLY_SIZE:
+        return datagram
+
+    metrics.count("truncated_replies", key)
+    length = len(key) + 1
+    for count, item in enumerate(items):
+        length += len(item.encode()) + (2 if count else 0)
+        if length > MAX_LEGACY_REPLY_SIZE:
+            return f"{key} {', '.join(items[:count])}".encode()
 
-    # extract username and password
+    return datagram
+
+
+# Function to send a list reply. Legacy replies are one datagram "<key> a, b, c". Paged replies pack the items from the
+# cursor onwards into datagrams of at most page_size bytes, "<key> PAGE <seq> <pages> <total> <next_cursor> a, b, c", sending up
+# to MAX_PAGES_PER_REPLY pages. next_cursor is the item offset to request next, or "-" once the list is complete.
+# Binary replies are always paged, with the same fields.
+def send_list_response(server_socket, client_address, key, items, paging, binary=False, request_id=0):
+    if paging is None:
+        server_socket.sendto(legacy_list_datagram(key, items), client_address)
+        return
+
+    pages, position = paginate(key, items, *paging)
+    complete = position >= len(items)
+
+    for seq, body in enumerate(pages, 1):
+        if binary:
+            fields = (seq, len(pages), len(items), wire.NO_CURSOR if complete else position, body)
+            server_socket.sendto(wire.encode_reply(request_id, key, fields), client_address)
+            continue
+
+        page = f"{key} PAGE {seq} {len(pages)} {len(items)} {'-' if complete else position}"
+        if body:
+            page += " " + ", ".join(body)
+        server_socket.sendto(page.encode(), client_address)
+
+
+# Text request parsers - each turns a request (tag and paging already removed) into its handler's arguments
+
+def parse_auth(message):
     _, username, password = message.split(" ", 2)
-    
-    print(f"Received AUTH request from {username}")
+    return username, password
+
+
+# "AUTHX <capabilities> <username> <password>" - AUTH that also offers comma-separated protocol capabilities
+def parse_authx(message):
+    _, capabilities, username, password = message.split(" ", 3)
+    return username, password, capabilities.split(",")
+
+
+# "HEARTBEAT <username>", optionally followed by the peer's active upload count and free upload bandwidth in KB/s
+def parse_heartbeat(message):
+    fields = message.split(" ")
+    if len(fields) == 4:
+        return fields[1], int(fields[2]), int(fields[3])
+    return fields[1], None, None
+
+
+# "<command> <username>"
+def parse_username(message):
+    _, username = message.split(" ", 1)
+    return (username,)
+
+
+# A TCP port field - ValueError unless it is a number in 0-65535
+def parse_port(value):
+    tcp_port = int(value)
+    if not 0 <= tcp_port <= MAX_PORT:
+        raise ValueError(f"tcp port {tcp_port} out of range")
+    return tcp_port
+
+
+# "<command> <username> <filename> <tcp_port>" - the filename is taken from between the username and the port, as for PUBLISH
+def parse_publication(message):
+    _, username, rest = message.split(" ", 2)
+    filename, tcp_port = rest.rsplit(" ", 1)
+    return username, filename, parse_port(tcp_port)
+
+
+# "PUBLISH <username> <filename> <tcp_port> [<content hash>]" - the filename is taken from between the
+# username and the port, so it may contain spaces; the hash may be empty if the client could not compute one
+def parse_publish(message):
+    _, username, rest = message.split(" ", 2)
+    content_hash = None
+
+    head, _, last = rest.rpartition(" ")
+    if not last.isdigit():
+        rest, content_hash = head, last
+
+    filename, tcp_port = rest.rsplit(" ", 1)
+    return username, filename, parse_port(tcp_port), content_hash
+
+
+# "PUBLISH_BATCH <username> <tcp_port> <hash>\n<hash>... <filename>\n<filename>..." - one content hash per
+# filename (empty if unknown). Filenames are newline-separated and last, so they may contain spaces.
+def parse_publish_batch(message):
+    _, username, tcp_port, content_hashes, filenames = message.split(" ", 4)
+    return username, parse_port(tcp_port), content_hashes.split("\n"), filenames.split("\n")
+
+
+# "UNPUBLISH_BATCH <username> <tcp_port> <filename>\n<filename>..."
+def parse_batch(message):
+    _, username, tcp_port, filenames = message.split(" ", 3)
+    return username, parse_port(tcp_port), filenames.split("\n")
+
+
+# "<command> <substring or filename> <username>" - the username is last, so the filename may contain spaces
+def parse_query(message):
+    _, rest = message.split(" ", 1)
+    subject, username = rest.rsplit(" ", 1)
+    return subject, username
+
+
+# Function to handle authentication requests - Helper function for authenticate user funcyoon.
+# Capabilities come from AUTHX; the reply lists the ones accepted, e.g. "AUTH_SUCCESS proto=bin1".
+# A client offering the lease capability is granted a lease sized to the current load and told
+# when to renew it: "lease=<seconds> renew=<seconds>".
+def handle_authentication(client_address, username, password, capabilities=()):
 
     # Authenticate the user
     auth_response = authenticate_user(username, password)
 
-    # Send the appropriate response to the client
-    if auth_response == "AUTH_SUCCESS":
+    renew = lease = None
+    if wire.LEASE_CAPABILITY in capabilities:
+        renew = renewal_interval()
+        lease = renew * LEASE_RENEWALS
+
+    # Add the user to the active peers if authentication is successful. The claim is atomic, so
+    # two concurrent logins for the same account cannot both succeed.
+    if auth_response == "AUTH_SUCCESS" and not active_peers.claim(username, lease_seconds=lease):
+        auth_response = "AUTH_ALREADY_ACTIVE"
 
-        # Add the user to the active peers list if authentication is successful
-        active_peers[username] = client_address
-        server_socket.sendto("AUTH_SUCCESS".encode(), client_address)
-        print(f"Sent AUTH_SUCCESS to {username}")
+    log.info("auth", user=username, client=client_address, result=auth_response, lease=lease)
 
+    # Send the appropriate response to the client
+    if auth_response == "AUTH_SUCCESS":
+        settings = [f"proto={wire.PROTOCOL}"] if wire.PROTOCOL in capabilities else []
+        if lease is not None:
+            settings += [f"lease={lease:g}", f"renew={renew:g}"]
+        return ("AUTH_SUCCESS", *settings)
 
         # If user is already active
     elif auth_response == "AUTH_ALREADY_ACTIVE":
-        server_socket.sendto("AUTH_ALREADY_ACTIVE".encode(), client_address)
-        print(f"Sent AUTH_ALREADY_ACTIVE to {username}")
+        return ("AUTH_ALREADY_ACTIVE",)
 
     else:
-        server_socket.sendto("AUTH_FAILED".encode(), client_address)
-        print(f"Sent AUTH_FAILED to {username}")
+        return ("AUTH_FAILED",)
+
+
+# Renewal interval to suggest at login: enough for the active peers' heartbeats to stay within
+# HEARTBEAT_BUDGET per second. When sharded, the shard's peers stand for an equal share of all of them.
+def renewal_interval():
+    peers = len(active_peers) * (shard_channel.shards if shard_channel is not None else 1)
+    return round(min(max(peers / HEARTBEAT_BUDGET, MIN_RENEW_INTERVAL), MAX_RENEW_INTERVAL), 1)
+
+
+# Any request naming a logged-in peer renews their lease, so busy peers need not heartbeat. When
+# sharded, the lease lives on the user's home shard, so renewals for other shards' users are
+# forwarded there, at most once per TOUCH_FORWARD_INTERVAL per user.
+def renew_lease(command, args):
+    position = USERNAME_ARGUMENTS.get(command)
+    if position is None:
+        return
+
+    username = args[position]
+    if shard_channel is None:
+        active_peers.touch(username)
+        return
+
+    home = sharding.shard_of(username, shard_channel.shards)
+    if home == shard_channel.shard:
+        active_peers.touch(username)
+        return
+
+    now = time.monotonic()
+    if now - forwarded_touches.get(username, 0.0) >= TOUCH_FORWARD_INTERVAL:
+        forwarded_touches[username] = now
+        shard_channel.send(home, ("touch", username))
 
 
 # Function to authenticate user from credentials file and check if they have already logged in
 def authenticate_user(username, password):
 
-    # Set the default credentials path which is in the working directory                   
-    credentials_file = os.getenv("CREDENTIALS_PATH", "./credentials.txt")
-
     # Check if the user is already active
     if username in active_peers:
-        print(f"Authentication failed: {username} is already logged in.")
         return "AUTH_ALREADY_ACTIVE"
 
-    # Validate credentials from the credentials file
-    try:
-        with open(credentials_file, "r") as file:
-            for line in file:
-                stored_username, stored_password = line.strip().split()
-                if username == stored_username and password == stored_password:
-                    return "AUTH_SUCCESS"
-                
-    except FileNotFoundError:
-        print("Credentials file not found.")
+    # Validate credentials against the in-memory credential store
+    if credential_store.verify(username, password):
+        return "AUTH_SUCCESS"
 
-    except Exception as e:
-        print(f"Error reading credentials file: {e}")
-    
     return "AUTH_FAILED"
 
 
 # Function to send the list of active peers to the client
-def send_active_peers_list(server_socket, message, client_address):
-    try:
-        # Get the username out of the message.
-        key, username = message.split(" ", 1)
-    
-        # Extract the usernames of active peers
-        active_usernames = list(active_peers.keys())
+def send_active_peers_list(client_address, username):
+    # Extract the usernames of active peers
+    active_usernames = active_peers.usernames()
 
-        # Format the list as a comma-separated string with active peers
-        active_list_message = "ACTIVE_PEERS " + ", ".join(active_usernames)
-    
-        # Send the message back to the client
-        server_socket.sendto(active_list_message.encode(), client_address)
-    
-        print(f"Sent OK to {username}")
-    
-    except Exception as e:
-        # Handle any error that occurs
-        print(f"Sent Error to {username}")
-        message = "ACTIVE_PEERS_FAIL"
+    log.debug("active_peers", user=username, peers=len(active_usernames))
 
-         # Send the message back to the client
-        server_socket.sendto(active_list_message.encode(), client_address)
+    # The list of active peers is sent back to the client
+    return "ACTIVE_PEERS", active_usernames
 
 
-# Function to publish a file
-def handle_published_files(server_socket, message, client_address):
-    try:
-        # Extract username, filename and TCP port from the message
-        _, username, filename, tcp_port = message.split(" ")
+# A content hash as sent by a client, or None if it is missing or not a hex SHA-256 digest
+def valid_content_hash(value):
+    return value if value and len(value) == 64 and set(value) <= HEX_DIGITS else None
 
-        # Check if the file is already published
-        if filename in published_files:
 
-            # Check if this specific peer has already published the file
-            if any(peer[0] == username for peer in published_files[filename]):                                                 
-                response = "PUB_SUCCESS"
-            
-            else:
-                # Add the peer's information to the list for this file
-                published_files[filename].append((username, client_address[0], tcp_port))
-                response = "PUB_SUCCESS"
+# Function to publish a file, optionally with the content hash of its chunk manifest
+def handle_published_files(client_address, username, filename, tcp_port, content_hash=None):
+    # Add the peer's information for this file - republishing a file the peer already shares also succeeds
+    catalog.publish(filename, username, client_address[0], tcp_port, valid_content_hash(content_hash))
 
-        else:
-            # Create a new entry for the file with the current peer as the first entry
-            published_files[filename] = [(username, client_address[0], tcp_port)]
-            response = "PUB_SUCCESS"
+    log.debug("publish", user=username, file=filename)
 
-        print(f"Sent OK to {username}")
+    return ("PUB_SUCCESS",)
 
-    except Exception as e:
-        print(f"Sent Error to {username}: {e}")
-        response = "PUB_FAIL"
 
-    # Send response to the client
-    server_socket.sendto(response.encode(), client_address)
+# Function to unpublish a file
+def handle_unpublish_file(client_address, username, filename, tcp_port):
+    # Check if the filename exists in the catalog
+    if filename in catalog:
 
+        # Only the entry where username, client address and port all match is removed
+        if catalog.unpublish(filename, username, client_address[0], tcp_port):
+            response = "UNPUB_SUCCESS"
 
-# Function to unpublish a file
-def handle_unpublish_file(server_socket, message, client_address):
-    try:
-        # Extract username and filename from the message
-        _, username, filename, tcp_port = message.split(" ")
-
-        # Check if the filename exists in published_files
-        if filename in published_files:
-
-            # Filter out only the entries where both username and client address match
-            initial_length = len(published_files[filename])
-            
-            published_files[filename] = [
-                peer for peer in published_files[filename]
-                if not (peer[0] == username and peer[1] == client_address[0] and peer[2] == tcp_port)
-            ]
-
-            # If an entry was removed (meaning unpublish was successful)
-            if len(published_files[filename]) < initial_length:
-                
-                # If the list becomes empty, remove the filename from the dictionary
-                if not published_files[filename]:
-                    del published_files[filename]
-                
-                response = "UNPUB_SUCCESS"
-                print(f"Sent OK to {username} for unpublishing {filename}")
-            
-            else:
-                response = "UNPUB_FAIL"
-                print(f"Sent Error to {username}: not authorized to unpublish {filename}.")
-        
         else:
-            response = "UNPUB_FAIL"
-            print(f"Sent Error to {username}: file not found or not published.")
-    
+            response = "UNPUB_FAIL"                                                 # Not authorized to unpublish
 
-    except Exception as e:
-        print(f"Sent Error to {username}: {e}")
-        response = "UNPUB_FAIL"
+    else:
+        response = "UNPUB_FAIL"                                                     # File not found or not published
 
-    # Send response back to the client
-    server_socket.sendto(response.encode(), client_address)
+    log.debug("unpublish", user=username, file=filename, result=response)
+    return (response,)
+
+
+# Function to publish a batch of files in one catalog update. The reply has one result per file,
+# "1" or "0", in request order - republishing a file counts as success, as it does for PUBLISH.
+def handle_publish_batch(client_address, username, tcp_port, content_hashes, filenames):
+    if len(content_hashes) != len(filenames):
+        content_hashes = [None] * len(filenames)
+
+    valid = [(filename, valid_content_hash(content_hash)) for filename, content_hash in zip(filenames, content_hashes) if filename]
+    catalog.publish_many([filename for filename, _ in valid], username, client_address[0], tcp_port,
+                         [content_hash for _, content_hash in valid])
+
+    log.debug("publish_batch", user=username, files=len(valid))
+
+    return "PUB_BATCH", "".join("1" if filename else "0" for filename in filenames)
+
+
+# Function to unpublish a batch of files in one catalog update, with one result per file like PUBLISH_BATCH
+def handle_unpublish_batch(client_address, username, tcp_port, filenames):
+    results = catalog.unpublish_many(filenames, username, client_address[0], tcp_port)
+
+    log.debug("unpublish_batch", user=username, files=len(filenames), removed=sum(results))
+
+    return "UNPUB_BATCH", "".join("1" if removed else "0" for removed in results)
 
 
 # Function to handle requests for listing published files
-def handle_list_published_files(server_socket, message, client_address):
-    try:
-        # Extract key and username
-        _, username = message.split(" ", 1)
+def handle_list_published_files(client_address, username):
+    # Gather all files published by the requesting user from the per-user index
+    user_files = catalog.files_of(username)
 
-        # Gather all files published by the requesting user
-        user_files = [
-            filename for filename, peers in published_files.items()
-            if any(peer[0] == username for peer in peers)  # Check if username is in the list of peers
-        ]
+    log.debug("list_files", user=username, files=len(user_files))
 
-        if user_files:
-            # Join the list of published files into a comma-separated string
-            files_list = ", ".join(user_files)
-            response = f"PUBLISHED_FILES {files_list}"
-            print(f"Sent OK to {username}")
+    if user_files:
+        # The list of published files is sent comma-separated
+        return "PUBLISHED_FILES", user_files
 
-        else:
-            # If no files are published by the user
-            response = "FAIL_PUBLISHED_FILES"
-            print(f"Sent Error to {username}: no published files found.")
+    # If no files are published by the user
+    return ("FAIL_PUBLISHED_FILES",)
 
-    except Exception as e:
-        print(f"Sent Error to {username}: {e}")
-        response = "FAIL_PUBLISHED_FILES"
 
-    # Send response to the client
-    server_socket.sendto(response.encode(), client_address)
+# Result of compute() from the result cache, computed and cached on a miss. Hits, stale hits and misses are counted per command.
+# With exact_only, a result from an older generation is recomputed even inside the staleness window.
+def cached_result(command, key, compute, exact_only=False):
+    generation = catalog.generation
+    result, exact = result_cache.get(key, generation)
+    if result is not None and (exact or not exact_only):
+        metrics.count("result_cache_hits" if exact else "result_cache_stale_hits", command)
+        return result
 
+    metrics.count("result_cache_misses", command)
+    result = compute()
+    result_cache.put(key, generation, result)
+    return result
 
-#Search for files published by active users, using parts of a string 
-def handle_search_files(server_socket, message, client_address):
-    try:
-        # extract substring and username
-        _, substring, username = message.split(" ", 2)
 
-        # Gather files published by active peers excluding the requesting user
-        matching_files = []
+# Share of SEARCH_FILES and QUERY_FILE requests answered from the result cache, stale hits included
+def result_cache_hit_ratio():
+    hits = sum(metrics.counter(name, command) for name in ("result_cache_hits", "result_cache_stale_hits")
+               for command in ("SEARCH_FILES", "QUERY_FILE"))
+    lookups = hits + sum(metrics.counter("result_cache_misses", command) for command in ("SEARCH_FILES", "QUERY_FILE"))
+    return round(hits / lookups, 4) if lookups else None
 
-        # Loop through published files to find matches
-        for filename, peers in published_files.items():
 
-            # Check if the file matches the substring i.e. "."
-            if substring in filename:
+#Search for files published by active users, using parts of a string. Repeated searches are answered from the result cache.
+def handle_search_files(client_address, substring, username):
+    matching_files = cached_result("SEARCH_FILES", ("SEARCH_FILES", substring, username),
+                                   lambda: search_active_files(substring, username))
 
-                # Exclude files if the requesting user has published them
-                if any(peer[0] == username for peer in peers):
-                    continue  # Skip this file if the requester has published it
+    log.debug("search", user=username, substring=substring, matches=len(matching_files))
 
-                # Check if there is any active peer (other than the requester) who published the file
-                if any(peer[0] in active_peers for peer in peers):
-                    matching_files.append(filename)
+    # If search criteria finds relevant files
+    if matching_files:
+        # The matching files are sent comma-separated
+        return "FOUND_FILES", matching_files
 
-        # If search criteria finds relevant files
-        if matching_files:
-            files_list = ", ".join(matching_files)
-            response = f"FOUND_FILES {files_list}"
-            print(f"Sent OK to {username} with matching files: {files_list}")
+    return ("FAIL_FOUND_FILES",)
 
-        else:
-            response = "FAIL_FOUND_FILES"
-            print(f"Sent OK to {username}: no matching files found.")
 
-    except Exception as e:
-        print(f"Sent Error to {username}: {e}")  
-        response = "FAIL_FOUND_FILES"
+# Files matching the substring with an active publisher, leaving out the user's own
+def search_active_files(substring, username):
+    # Gather files published by active peers excluding the requesting user
+    matching_files = []
+
+    # Loop through the published files that match the substring i.e. "." - the index only yields real matches
+    for filename in catalog.search(substring):
+
+        # Exclude files if the requesting user has published them
+        if catalog.is_published_by(filename, username):
+            continue  # Skip this file if the requester has published it
 
-    # Send response to the client
-    server_socket.sendto(response.encode(), client_address)
+        # Check if there is any active peer (other than the requester) who published the file, without walking its peer list
+        if catalog.live_publisher_count(filename) > 0:
+            matching_files.append(filename)
+
+    return matching_files
 
 
 # Function to handle file query requests
-def handle_query_file(server_socket, message, client_address):
+def handle_query_file(client_address, filename, username):
+    # Check if the file is published and find an active peer; the peer is chosen afresh even when the list is cached.
+    # The list is only reused while the catalog is unchanged, so a peer that has just left is never handed out.
+    if filename in catalog:
+        live_peers = cached_result("QUERY_FILE", ("QUERY_FILE", filename),
+                                   lambda: catalog.live_publisher_records(filename), exact_only=True)
+
+        if live_peers:
+            # Sends the least-loaded Peer's IP and port number to client.                           
+            _, peer_ip, peer_port = load_balancer.choose(filename, live_peers)
+            log.debug("query", user=username, file=filename, peer=f"{peer_ip}:{peer_port}")
+            return "QUERY_SUCCESS", peer_ip, peer_port
+
+        log.debug("query", user=username, file=filename, error="no active peer")
+
+    else:
+        log.debug("query", user=username, file=filename, error="not found")
+
+    return ("QUERY_FAIL",)
+
+
+# Function to list the active publishers of a file as "ip:port" items, for multi-source downloads. When
+# publishers disagree on the contents, only those with the version most of them share are listed.
+def handle_query_peers(client_address, filename, username):
+    _, publishers = catalog.live_version(filename)
+
+    # Least-loaded peers first, so swarm downloads start with the best sources
+    live_peers = [f"{peer[1]}:{peer[2]}" for peer in load_balancer.rank(publishers)]
+
+    log.debug("query_peers", user=username, file=filename, peers=len(live_peers))
+
+    if live_peers:
+        return "FILE_PEERS", live_peers
+
+    return ("QUERY_FAIL",)
+
+
+# Function to send the content hash of the version of a file QUERY_PEERS lists, so the downloader can check the peers' manifests
+def handle_query_content(client_address, filename, username):
+    content_hash, publishers = catalog.live_version(filename)
+
+    log.debug("query_content", user=username, file=filename, peers=len(publishers))
+
+    if not publishers:
+        return ("QUERY_FAIL",)
+
+    return "CONTENT", content_hash or ""
+
+
+# Function to find the files with an active publisher of the given contents, under any name
+def handle_query_hash(client_address, content_hash, username):
+    matching_files = catalog.files_with_hash(content_hash)
+
+    log.debug("query_hash", user=username, hash=content_hash, matches=len(matching_files))
+
+    if matching_files:
+        return "FOUND_FILES", matching_files
+
+    return ("FAIL_FOUND_FILES",)
+
+
+# Function to report the server's request counts, latency percentiles, drop counters and index sizes as "name=value" items
+def handle_stats(client_address, username):
+    log.debug("stats", user=username)
+    return "STATS", metrics.items()
+
+
+# Ask for a UDP_RECEIVE_BUFFER receive buffer; the server still runs, with the default buffer, if it is refused
+def size_receive_buffer(server_socket):
     try:
-        # extract file name and username from message
-        _, filename, username = message.split(" ", 2)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_RECEIVE_BUFFER)
+    except OSError as e:
+        log.warning("receive_buffer_refused", size=UDP_RECEIVE_BUFFER, error=e)
+
+
+# Gauges read when STATS or the Prometheus dump reports, for the server's socket (or transport)
+def register_gauges(server_socket):
+    metrics.gauge("catalog_files", lambda: len(catalog))
+    metrics.gauge("catalog_content_hashes", lambda: len(catalog.hash_files))
+    metrics.gauge("search_index_pending", catalog.search_index.pending)
+    metrics.gauge("active_peers", lambda: len(active_peers))
+    metrics.gauge("reply_cache_entries", lambda: len(reply_cache))
+    metrics.gauge("result_cache_entries", lambda: len(result_cache))
+    metrics.gauge("result_cache_bytes", lambda: result_cache.bytes)
+    metrics.gauge("result_cache_hit_ratio", result_cache_hit_ratio)
+    metrics.gauge("blocking_in_flight", lambda: metrics.counter("blocking_submitted") - metrics.counter("blocking_completed"))
+    metrics.gauge("log_lines_suppressed", lambda: log.suppressed)
+
+    # Datagrams waiting in the socket and dropped by the kernel because the receive buffer was full
+    metrics.gauge("udp_receive_buffer_bytes", lambda: server_socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF))
+    metrics.gauge("udp_receive_queue_bytes", lambda: (udp_socket_stats(server_socket) or (None, None))[0])
+    metrics.gauge("udp_receive_drops", lambda: (udp_socket_stats(server_socket) or (None, None))[1])
+
+    if shard_channel is not None:
+        metrics.gauge("shard_calls_in_flight", shard_channel.pending)
+
+
+# Background function to write the Prometheus dump every METRICS_DUMP_INTERVAL seconds
+def dump_metrics(path):
+    while True:
+        time.sleep(METRICS_DUMP_INTERVAL)
 
-        # Check if the file is published and find an active peer
-        if filename in published_files:
-            for peer in published_files[filename]:
+        try:
+            metrics.dump(path)
+        except OSError as e:
+            log.error("metrics_dump_failed", path=path, error=e)
 
-                # Check if the peer is active
-                if peer[0] in active_peers:     
-                    # Sends Peer's IP and port number to client.                           
-                    peer_ip, peer_port = peer[1], peer[2]  
-                    response = f"QUERY_SUCCESS {peer_ip} {peer_port}"
-                    print(f"Sent OK to {username}")
-                    break
 
-            else:
-                response = "QUERY_FAIL"  
-                print(f"Sent Error to {username}, no active peer for given file")  
-                
-        else:
-            response = "QUERY_FAIL"  
-            print(f"Sent Error to {username}, file not found")  
+# Start the Prometheus dump thread if METRICS_PATH is set. Sharded workers each write their own file, with the shard in its name.
+def start_metrics_dump(shard=None):
+    if not METRICS_PATH:
+        return
 
-    except Exception as e:
-        print(f"Sent Error to {username}")
-        response = "QUERY_FAIL"
+    path = METRICS_PATH
+    if shard is not None:
+        root, extension = os.path.splitext(METRICS_PATH)
+        path = f"{root}.shard{shard}{extension}"
 
-    server_socket.sendto(response.encode(), client_address)
+    threading.Thread(target=dump_metrics, args=(path,), daemon=True).start()
 
 
 # Background function to check for inactive peers 
 def monitor_peers():
+    max_sleep = HEARTBEAT_INTERVAL.total_seconds() / 2                             # Check at least twice within the interval
+
     while True:
-        current_time = datetime.now()
+        # Only leases whose deadline has passed are touched, not every active peer
+        for username, silence in active_peers.expire():
+            metrics.count("leases_expired")
+            log.info("lease_expired", user=username, silence=f"{silence:.1f}")
 
-        # Hearbeat interval set at 3 seconds
-        inactive_peers = [username for username, last_heartbeat in active_peers.items()
-                          if current_time - last_heartbeat > HEARTBEAT_INTERVAL]
+        # Wait until the next lease is due, or half an interval if nobody is active
+        next_expiry = active_peers.time_to_next_expiry()
+        time.sleep(max_sleep if next_expiry is None else min(max_sleep, next_expiry + 0.01))
 
-        # Remove inactive peers and log them
-        for username in inactive_peers:
-            print(f"{current_time}: {username} is inactive (last heartbeat at {active_peers[username]})")
-            del active_peers[username]
 
-        # Wait before checking again
-        time.sleep(HEARTBEAT_INTERVAL.total_seconds() / 2)  # Check twice within the interval
+# Restore the published files from the catalog store and start the threads that keep it current
+def restore_catalog():
+    if catalog_store is None:
+        return
 
+    start = time.perf_counter()
+    loaded, replayed = catalog_store.open(catalog)
+    log.info("catalog_restored", files=len(catalog), snapshot_publications=loaded, journal_records=replayed,
+             seconds=f"{time.perf_counter() - start:.2f}")
 
-# Function to handle heartbeat messages
-def handle_heartbeat(client_address, message):
-    _, username = message.split(" ", 1)
-    current_time = datetime.now()
-    
-    # Update peer's last heartbeat time
-    active_peers[username] = current_time  
+    threading.Thread(target=catalog.warm_search_index, daemon=True).start()
+    threading.Thread(target=persist_catalog, daemon=True).start()
+
+
+# Background function to flush the catalog journal and fold it into a new snapshot once it grows
+def persist_catalog():
+    while True:
+        time.sleep(JOURNAL_FLUSH_INTERVAL)
+        catalog_store.flush()
+
+        if catalog_store.needs_compaction():
+            start = time.perf_counter()
+            if catalog_store.compact(catalog):
+                log.info("catalog_snapshot", seconds=f"{time.perf_counter() - start:.2f}")
+            else:
+                log.error("catalog_snapshot_failed", action="keeping the journal")
+
+
+# Function to handle heartbeat messages. Upload load is None when the peer does not report it.
+def handle_heartbeat(client_address, username, uploads=None, free_bandwidth=None):
+    # Extend the peer's lease
+    active_peers.renew(username)
+
+    # Record the peer's load for QUERY_FILE peer selection
+    if uploads is not None:
+        load_balancer.report(username, uploads, free_bandwidth)
+
+        # When sharded, the peer's files are ranked on other shards too - tell them when the load changes
+        if shard_channel is not None and shared_loads.get(username) != (uploads, free_bandwidth):
+            shared_loads[username] = (uploads, free_bandwidth)
+            shard_channel.broadcast(("load", username, uploads, free_bandwidth))
     
     # print(active_peers)
-    # print(published_files)
+    # print(catalog.files)
+
+    log.debug("heartbeat", user=username, client=client_address)
+
+
+# Command dispatch table, keyed on the first word of each request (or the binary opcode's command).
+# Format: {command: (text parser, handler, reply sent when the request fails)}
+COMMAND_HANDLERS = {
+    "AUTH": (parse_auth, handle_authentication, None),                              # User authenticaion function
+    "AUTHX": (parse_authx, handle_authentication, None),                            # Authentication with protocol negotiation
+    "HEARTBEAT": (parse_heartbeat, handle_heartbeat, None),
+    "ACTIVE_PEERS": (parse_username, send_active_peers_list, ("ACTIVE_PEERS_FAIL",)),   # Active peers function
+    "PUBLISH": (parse_publish, handle_published_files, ("PUB_FAIL",)),              # Publish files function
+    "UNPUBLISH": (parse_publication, handle_unpublish_file, ("UNPUB_FAIL",)),       # Unpublish files function
+    "LIST_FILES": (parse_username, handle_list_published_files, ("FAIL_PUBLISHED_FILES",)),  # list of published files function
+    "SEARCH_FILES": (parse_query, handle_search_files, ("FAIL_FOUND_FILES",)),      # Search for files published by active users
+    "QUERY_FILE": (parse_query, handle_query_file, ("QUERY_FAIL",)),                # Query and Download file in TCP
+    "QUERY_PEERS": (parse_query, handle_query_peers, ("QUERY_FAIL",)),              # All active publishers, for swarm downloads
+    "PUBLISH_BATCH": (parse_publish_batch, handle_publish_batch, ("PUB_FAIL",)),    # Publish many files in one request
+    "UNPUBLISH_BATCH": (parse_batch, handle_unpublish_batch, ("UNPUB_FAIL",)),      # Unpublish many files in one request
+    "QUERY_CONTENT": (parse_query, handle_query_content, ("QUERY_FAIL",)),          # Content hash of the version QUERY_PEERS serves
+    "QUERY_HASH": (parse_query, handle_query_hash, ("FAIL_FOUND_FILES",)),          # Files with the given contents, under any name
+    "STATS": (parse_username, handle_stats, ("STATS_FAIL",)),                       # Counters, latency percentiles and index sizes
+}
+
+
+# Thread-safe stand-in for the transport so executor threads can reply through the event loop
+class LoopSender:
+    def __init__(self, loop, transport):
+        self.loop = loop
+        self.transport = transport
+
+    def sendto(self, data, address):
+        self.loop.call_soon_threadsafe(self.transport.sendto, data, address)
+
+
+# asyncio protocol - fast commands run inline on the loop, blocking ones are handed to the executor
+class BitTrickleProtocol(asyncio.DatagramProtocol):
+    def __init__(self, executor):
+        self.executor = executor
+        self.transport = None
+        self.loop = None
+        self.executor_sender = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.loop = asyncio.get_running_loop()
+        self.executor_sender = LoopSender(self.loop, transport)
+
+    def datagram_received(self, data, client_address):
+        received = time.perf_counter()
+        request = read_datagram(data, client_address)
+        if request is None:
+            return
+
+        if request[1] in BLOCKING_COMMANDS:
+            metrics.count("blocking_submitted")
+            self.loop.run_in_executor(self.executor, run_blocking, dispatch_request, self.executor_sender, request,
+                                      client_address, received)
+        else:
+            dispatch_request(self.transport, request, client_address, received)
 
-    print(f"{current_time}: ({client_address}) Received HEARTBEAT from {username}")
+    def error_received(self, exc):
+        metrics.count("udp_errors")
+        log.warning("udp_error", error=exc)
 
 
 # Function to start the UDP server
 def start_server(port):
     with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as server_socket:
         server_socket.bind(("", port))
+        size_receive_buffer(server_socket)
+        register_gauges(server_socket)
 
         # Debug statement for UDP server
         # print(f"Ping Server running on port {port}")
@@ -369,22 +955,232 @@ def start_server(port):
         monitor_thread.start()
 
         # Run server loop to handle requests continuously
-        while True:
-            handle_request(server_socket)
+        with ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix="blocking") as executor:
+            while True:
+                handle_request(server_socket, executor)
+
+
+# Coroutine that serves the UDP endpoint until cancelled
+async def serve_async(port):
+    loop = asyncio.get_running_loop()
+
+    with ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix="blocking") as executor:
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: BitTrickleProtocol(executor), local_addr=("0.0.0.0", port))
+        size_receive_buffer(transport.get_extra_info("socket"))
+        register_gauges(transport.get_extra_info("socket"))
+
+        try:
+            await asyncio.Future()  # Run until cancelled
+        finally:
+            transport.close()
+
+
+# Run a command's handler on this process, on the blocking pool if the command needs it
+async def execute_command(executor, command, args, client_address):
+    if command in BLOCKING_COMMANDS:
+        metrics.count("blocking_submitted")
+        return await asyncio.get_running_loop().run_in_executor(executor, run_blocking, run_handler, command, args,
+                                                                client_address)
+
+    return run_handler(command, args, client_address)
+
+
+# asyncio protocol for one worker of a sharded server. Every worker receives datagrams on the shared
+# port; the request is parsed (and its reply cache slot claimed) where it arrives, then its handler
+# runs on the shard that holds the state it needs (see sharding.ROUTES) and the merged reply is sent
+# from here.
+class ShardedProtocol(BitTrickleProtocol):
+    def __init__(self, executor, channel):
+        super().__init__(executor)
+        self.channel = channel
+
+    def datagram_received(self, data, client_address):
+        received = time.perf_counter()
+        request = read_datagram(data, client_address)
+        if request is None:
+            return
+
+        prepared = prepare_request(self.transport, request, client_address, received)
+        if prepared is None:
+            return
+
+        renew_lease(prepared.command, prepared.args)
+        calls, merge = sharding.plan(prepared.command, prepared.args, self.channel.shards)
+
+        # Requests for this shard's own state that need no thread are answered inline, as in async mode
+        if len(calls) == 1 and calls[0][0] == self.channel.shard and prepared.command not in BLOCKING_COMMANDS:
+            prepared.respond(run_handler(prepared.command, calls[0][1], client_address))
+        elif len(calls) == 1 and prepared.command in sharding.NO_REPLY_COMMANDS:
+            self.channel.post(calls[0][0], prepared.command, calls[0][1], client_address)
+            prepared.respond(None)
+        else:
+            asyncio.ensure_future(self.gather(prepared, calls, merge))
+
+    async def gather(self, prepared, calls, merge):
+        replies = await asyncio.gather(*(self.call(shard, prepared.command, args, prepared.client_address)
+                                         for shard, args in calls))
+        prepared.respond(merge(replies))
+
+    async def call(self, shard, command, args, client_address):
+        if shard == self.channel.shard:
+            return await execute_command(self.executor, command, args, client_address)
+
+        try:
+            return await self.channel.call(shard, command, args, client_address)
+        except asyncio.TimeoutError:
+            metrics.count("shard_timeouts", command)
+            log.warning("shard_timeout", shard=shard, command=command, client=client_address)
+            return COMMAND_HANDLERS[command][2]
+
+
+# Lease changes on this shard, shared with the others so every shard knows who is online
+def shard_peer_online(username):
+    catalog.peer_online(username)
+    shard_channel.broadcast(("online", username))
+
+
+def shard_peer_offline(username):
+    peer_offline(username)
+    shared_loads.pop(username, None)
+    shard_channel.broadcast(("offline", username))
+
+
+# Notices from other shards about the users homed there
+def handle_shard_notice(message):
+    if message[0] == "online":
+        catalog.peer_online(message[1])
+    elif message[0] == "offline":
+        peer_offline(message[1])
+        forwarded_touches.pop(message[1], None)
+    elif message[0] == "load":
+        load_balancer.report(*message[1:])
+    elif message[0] == "touch":
+        active_peers.touch(message[1])
+
+
+# Coroutine that serves one worker of a sharded server until cancelled
+async def serve_shard(port, shard, shards, sockets):
+    global shard_channel
+    loop = asyncio.get_running_loop()
+
+    with ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix="blocking") as executor:
+        shard_channel = sharding.ShardChannel(shard, shards, sockets,
+                                              lambda *call: execute_command(executor, *call), handle_shard_notice)
+        await shard_channel.start()
+
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: ShardedProtocol(executor, shard_channel), local_addr=("0.0.0.0", port), reuse_port=True)
+        size_receive_buffer(transport.get_extra_info("socket"))
+        register_gauges(transport.get_extra_info("socket"))
+
+        # Run until the parent stops the server
+        stopped = loop.create_future()
+        loop.add_signal_handler(signal.SIGTERM, stopped.set_result, None)
+        try:
+            await stopped
+        finally:
+            transport.close()
+
+
+# Entry point of a worker process: this shard's catalog, leases of the users homed here, and the event
+# loop. sockets are this worker's ends of the channel to the others (see sharding.channel_sockets).
+def run_shard(port, shard, shards, sockets):
+    global catalog_store
+
+    if CATALOG_STATE_DIR:
+        catalog_store = CatalogStore(os.path.join(CATALOG_STATE_DIR, f"shard{shard}-of-{shards}"))
+
+    active_peers.on_activate = shard_peer_online
+    active_peers.on_expire = shard_peer_offline
+    metrics.labels["shard"] = shard
+
+    restore_catalog()
+    threading.Thread(target=monitor_peers, daemon=True).start()
+    start_metrics_dump(shard)
+
+    try:
+        asyncio.run(serve_shard(port, shard, shards, sockets))
+    finally:
+        if catalog_store is not None:
+            catalog_store.close()
+
+
+# Function to start a sharded server: one worker process per shard, all bound to the port with SO_REUSEPORT
+# so the kernel spreads clients across them. Published files are partitioned by filename and user state
+# by username (see sharding.py). If any worker exits, the rest are stopped.
+def start_sharded_server(port, shards):
+    sockets = sharding.channel_sockets(shards)
+    workers = []
+
+    # Stop cleanly on SIGTERM, so the workers are stopped too and flush their journals
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        for shard in range(shards):
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    sharding.close_sockets(sockets, keep=shard)
+                    run_shard(port, shard, shards, sockets[shard])
+                    status = 0
+                finally:
+                    os._exit(status)
+            workers.append(pid)
+
+        # The workers hold their own ends of the channel now
+        sharding.close_sockets(sockets)
+
+        pid, status = os.wait()
+        log.error("worker_exited", pid=pid, status=status, action="stopping the server")
+
+    finally:
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+
+# Function to start the asyncio UDP server
+def start_async_server(port):
+    # Peer monitoring stays on its own thread so it never competes with the event loop
+    monitor_thread = threading.Thread(target=monitor_peers, daemon=True)
+    monitor_thread.start()
+
+    asyncio.run(serve_async(port))
 
 
 # Main function to get the port from command line arguments and start the server
 def main():
-    # User input for port number
-    if len(sys.argv) != 2:
-        print("Usage: PingServer.py <port>")
+    # User input for port number, optional server mode and, for sharded mode, the number of worker processes
+    if (len(sys.argv) not in (2, 3, 4) or (len(sys.argv) >= 3 and sys.argv[2] not in ("sync", "async", "sharded"))
+            or (len(sys.argv) == 4 and (sys.argv[2] != "sharded" or not sys.argv[3].isdigit()))):
+        print("Usage: PingServer.py <port> [sync|async|sharded [workers]]")
         sys.exit(1)
 
     port = int(sys.argv[1])
+    mode = sys.argv[2] if len(sys.argv) >= 3 else "sync"
+
+    # Each worker restores and persists its own shard of the catalog
+    if mode == "sharded":
+        start_sharded_server(port, int(sys.argv[3]) if len(sys.argv) == 4 else os.cpu_count() or 1)
+        return
+
+    restore_catalog()
+    start_metrics_dump()
 
     # start server function
-    start_server(port)
+    try:
+        if mode == "async":
+            start_async_server(port)
+        else:
+            start_server(port)
+    finally:
+        if catalog_store is not None:
+            catalog_store.close()
 
 # Run the main function
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
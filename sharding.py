@@ -0,0 +1,213 @@
+import asyncio
+import itertools
+import json
+import socket
+import struct
+import zlib
+
+import wire
+
+# Seconds a worker waits for another shard to answer a call before failing the request
+SHARD_CALL_TIMEOUT = 2.0
+
+# Length prefix of a channel message
+FRAME = struct.Struct("!I")
+
+# How each command is spread over the shards in sharded mode.
+#   ("key", n):  run on the shard owning argument n - the username for user state (logins, leases),
+#                the filename for a publication
+#   ("all",):    run on every shard and concatenate the list replies
+#   ("split",):  split the batch's filenames by owning shard and reassemble the per-file results
+# Format: {command: route}
+ROUTES = {
+    "AUTH": ("key", 0),
+    "AUTHX": ("key", 0),
+    "HEARTBEAT": ("key", 0),
+    "ACTIVE_PEERS": ("all",),
+    "PUBLISH": ("key", 1),
+    "UNPUBLISH": ("key", 1),
+    "LIST_FILES": ("all",),
+    "SEARCH_FILES": ("all",),
+    "QUERY_FILE": ("key", 0),
+    "QUERY_PEERS": ("key", 0),
+    "PUBLISH_BATCH": ("split",),
+    "UNPUBLISH_BATCH": ("split",),
+    "QUERY_CONTENT": ("key", 0),
+    "QUERY_HASH": ("all",),
+    "STATS": ("all",),
+}
+
+# Commands the client expects no reply to, so they are passed on without waiting for the other shard
+NO_REPLY_COMMANDS = {"HEARTBEAT"}
+
+
+# Shard owning a filename or username. crc32 rather than hash(), which differs between processes.
+def shard_of(key, shards):
+    return zlib.crc32(key.encode()) % shards
+
+
+# Connect every pair of workers with a Unix socket pair. Created by the parent before it forks the
+# workers, so the channel has no name on the filesystem and no other process can reach it.
+# Returns [{other shard: socket}, ...] indexed by shard.
+def channel_sockets(shards):
+    sockets = [{} for _ in range(shards)]
+    for shard in range(shards):
+        for other in range(shard + 1, shards):
+            sockets[shard][other], sockets[other][shard] = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    return sockets
+
+
+# Close the channel sockets of every shard but keep (all of them if keep is None)
+def close_sockets(sockets, keep=None):
+    for shard, ends in enumerate(sockets):
+        if shard != keep:
+            for end in ends.values():
+                end.close()
+
+
+# Work out where a command runs. Returns (calls, merge): calls is [(shard, args), ...] and
+# merge(replies) combines the replies of the calls, in the same order, into the client's reply.
+def plan(command, args, shards):
+    route = ROUTES[command]
+
+    if route[0] == "key":
+        return [(shard_of(args[route[1]], shards), args)], first_reply
+
+    if route[0] == "all":
+        return [(shard, args) for shard in range(shards)], merge_lists
+
+    # Batch: the filenames are the last argument, and list arguments of the same length (content hashes) go with them
+    filenames = args[-1]
+    positions = {}                                                                  # Format: {shard: [index into the batch, ...]}
+    for index, filename in enumerate(filenames):
+        positions.setdefault(shard_of(filename, shards), []).append(index)
+
+    if not positions:
+        return [(0, args)], first_reply
+
+    calls = [(shard, [[arg[i] for i in indexes] if isinstance(arg, list) and len(arg) == len(filenames) else arg
+                      for arg in args])
+             for shard, indexes in positions.items()]
+
+    def merge(replies):
+        return merge_batch(replies, list(positions.values()), len(filenames))
+
+    return calls, merge
+
+
+def first_reply(replies):
+    return replies[0]
+
+
+# Concatenate list replies in shard order. If no shard has a list, the first shard's failure stands.
+def merge_lists(replies):
+    lists = [reply for reply in replies if reply is not None and reply[0] in wire.LIST_REPLIES]
+    if not lists:
+        return replies[0]
+
+    return lists[0][0], [item for reply in lists for item in reply[1]]
+
+
+# Put per-file batch results ("1"/"0" strings) back in request order. A shard that failed outright counts as "0" for its files.
+def merge_batch(replies, positions, count):
+    keys = [reply[0] for reply in replies if reply is not None and len(reply) == 2]
+    if not keys:
+        return replies[0]
+
+    results = ["0"] * count
+    for reply, indexes in zip(replies, positions):
+        if reply is not None and len(reply) == 2:
+            for index, result in zip(indexes, reply[1]):
+                results[index] = result
+
+    return keys[0], "".join(results)
+
+
+# Channel between the worker processes of a sharded server: length-prefixed JSON messages over the
+# Unix socket pairs made by channel_sockets, one to each other worker. JSON rather than pickle, so a
+# message can only ever carry data. Messages are lists (JSON has no tuples):
+#   ["call", source shard, call id, command, args, client address]   run a handler, answer with "result"
+#   ["result", call id, reply]
+#   ["run", command, args, client address]                           run a handler, no answer
+#   anything else                                                    a notice, passed to on_notice
+# execute(command, args, client_address) is a coroutine function that runs a handler on this worker.
+class ShardChannel:
+    def __init__(self, shard, shards, sockets, execute, on_notice):
+        self.shard = shard
+        self.shards = shards
+        self.sockets = sockets                                                      # Format: {shard: socket} - see channel_sockets
+        self.execute = execute
+        self.on_notice = on_notice
+        self.loop = None
+        self._writers = {}                                                          # Format: {shard: StreamWriter}
+        self._readers = []                                                          # Tasks reading each other worker's messages
+        self._calls = {}                                                            # Format: {call id: Future}
+        self._ids = itertools.count(1)
+
+    # Start exchanging messages with the other workers over this worker's ends of the socket pairs
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+
+        for shard, end in self.sockets.items():
+            reader, self._writers[shard] = await asyncio.open_unix_connection(sock=end)
+            self._readers.append(asyncio.ensure_future(self._serve(reader, self._writers[shard])))
+
+    # Run a handler on another shard and return its reply. Raises asyncio.TimeoutError if the shard does not answer.
+    async def call(self, shard, command, args, client_address):
+        call_id = next(self._ids)
+        future = self._calls[call_id] = self.loop.create_future()
+        self.send(shard, ("call", self.shard, call_id, command, args, client_address))
+
+        try:
+            return await asyncio.wait_for(future, SHARD_CALL_TIMEOUT)
+        finally:
+            self._calls.pop(call_id, None)
+
+    # Number of calls to other shards waiting for their answer
+    def pending(self):
+        return len(self._calls)
+
+    # Run a handler on another shard without waiting for it
+    def post(self, shard, command, args, client_address):
+        self.send(shard, ("run", command, args, client_address))
+
+    def send(self, shard, message):
+        data = json.dumps(message, separators=(",", ":")).encode()
+        self._writers[shard].write(FRAME.pack(len(data)) + data)
+
+    # Send a notice to every other shard. Safe to call from any thread.
+    def broadcast(self, message):
+        self.loop.call_soon_threadsafe(self._broadcast, message)
+
+    def _broadcast(self, message):
+        for shard in self._writers:
+            self.send(shard, message)
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                length, = FRAME.unpack(await reader.readexactly(FRAME.size))
+                self._receive(json.loads(await reader.readexactly(length)))
+        except asyncio.IncompleteReadError:
+            pass  # The other worker closed its end
+        except asyncio.CancelledError:
+            pass  # This worker is stopping
+        finally:
+            writer.close()
+
+    def _receive(self, message):
+        kind = message[0]
+
+        if kind == "call":
+            asyncio.ensure_future(self._answer(*message[1:]))
+        elif kind == "result":
+            future = self._calls.get(message[1])
+            if future is not None and not future.done():
+                future.set_result(message[2])
+        elif kind == "run":
+            asyncio.ensure_future(self.execute(message[1], message[2], tuple(message[3])))
+        else:
+            self.on_notice(message)
+
+    async def _answer(self, source, call_id, command, args, client_address):
+        self.send(source, ("result", call_id, await self.execute(command, args, tuple(client_address))))
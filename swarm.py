@@ -0,0 +1,291 @@
+import os
+import threading
+import time
+
+from manifest import ChunkMismatch, VerifyingWriter, verified_chunks
+from transfer import RECEIVE_BUFFER_SIZE, TransferError, describe_transfer, fetch_range
+
+# Size of the byte ranges a file is split into for multi-source downloads
+SEGMENT_SIZE = 4 * 1024 * 1024
+
+# Most peers fetched from in parallel
+MAX_SWARM_PEERS = 8
+
+# Failed segments after which a peer is dropped from the swarm
+PEER_MAX_FAILURES = 2
+
+# Times segments that fail the final check against the manifest are fetched again before giving up
+MAX_VERIFY_ROUNDS = 3
+
+
+# Raised by a SegmentWriter once its segment was cancelled or finished by another peer
+class SegmentCancelled(TransferError):
+    pass
+
+
+# Hands segments to per-peer workers. Pending segments are served in order, so faster peers
+# naturally take more of them. Failed segments go back on the queue for another peer, and once
+# the queue is empty an idle peer may duplicate an in-flight segment if its measured rate
+# says it would finish first (the slower fetch is then cancelled).
+class SegmentScheduler:
+    def __init__(self, size, segment_size=SEGMENT_SIZE, done=()):
+        self.segments = [(offset, min(segment_size, size - offset)) for offset in range(0, size, segment_size)]
+        self.done = set(done)
+        self.pending = [segment for segment in range(len(self.segments)) if segment not in self.done]
+        self.pending.reverse()                                                      # pop() from the end takes the lowest offset
+        self.in_flight = {}                                                         # Format: {segment: {worker: (start time, cancel event)}}
+        self.rates = {}                                                             # Format: {worker: bytes per second}
+        self.rejected = set()                                                       # Workers dropped for sending bad data
+        self.condition = threading.Condition()
+        self.write_lock = threading.Lock()                                          # Held while writing to a segment and while marking one done
+
+    def finished(self):
+        return len(self.done) == len(self.segments)
+
+    # Next segment for a worker, blocking while there is nothing useful to do. Returns None when finished.
+    def next_segment(self, worker):
+        with self.condition:
+            while not self.finished():
+                if self.pending:
+                    segment = self.pending.pop()
+                else:
+                    segment = self._steal(worker)
+
+                if segment is not None:
+                    cancel = threading.Event()
+                    self.in_flight.setdefault(segment, {})[worker] = (time.perf_counter(), cancel)
+                    return segment, cancel
+
+                # Nothing to take over yet - wake up when a segment finishes or fails
+                self.condition.wait(timeout=0.5)
+
+            return None
+
+    # Pick the in-flight segment this worker is expected to finish soonest relative to its current holder
+    def _steal(self, worker):
+        rate = self.rates.get(worker)
+        if not rate:
+            return None
+
+        now = time.perf_counter()
+        best, best_gain = None, 0.0
+
+        for segment, fetchers in self.in_flight.items():
+            if worker in fetchers or len(fetchers) > 1:
+                continue
+
+            (holder, (started, _)), = fetchers.items()
+            length = self.segments[segment][1]
+            holder_rate = self.rates.get(holder)
+
+            # Estimated time left for the holder versus a fresh fetch by this worker
+            holder_left = (length / holder_rate - (now - started)) if holder_rate else float("inf")
+            gain = holder_left - length / rate
+            if gain > best_gain:
+                best, best_gain = segment, gain
+
+        return best
+
+    def complete(self, segment, worker, elapsed):
+        with self.condition:
+            length = self.segments[segment][1]
+            self.rates[worker] = length / max(elapsed, 1e-6)
+
+            fetchers = self.in_flight.pop(segment, {})
+            if segment not in self.done:
+                # Cancel anyone still fetching the same bytes; under the write lock, so none of them writes after this
+                with self.write_lock:
+                    self.done.add(segment)
+                    for other, (_, cancel) in fetchers.items():
+                        if other != worker:
+                            cancel.set()
+
+            self.condition.notify_all()
+
+    def fail(self, segment, worker):
+        with self.condition:
+            fetchers = self.in_flight.get(segment, {})
+            fetchers.pop(worker, None)
+
+            # Requeue the segment unless it finished elsewhere or another peer is still on it
+            if not fetchers:
+                self.in_flight.pop(segment, None)
+                if segment not in self.done:
+                    self.pending.append(segment)
+
+            self.condition.notify_all()
+
+    # Drop a worker that sent bad data, giving its segment back
+    def reject(self, segment, worker):
+        with self.condition:
+            self.rejected.add(worker)
+        self.fail(segment, worker)
+
+    # Fetch finished segments again, e.g. after they failed the final check against the manifest
+    def requeue(self, segments):
+        with self.condition:
+            self.done.difference_update(segments)
+            self.pending = sorted(set(self.pending) | set(segments), reverse=True)
+            self.condition.notify_all()
+
+
+# File-like guard around the shared output file for one fetch of a segment: once the fetch is
+# cancelled or another peer has finished the segment, further writes raise SegmentCancelled
+# instead of overwriting bytes that are already done.
+class SegmentWriter:
+    def __init__(self, file, scheduler, segment, cancel):
+        self.file = file
+        self.scheduler = scheduler
+        self.segment = segment
+        self.cancel = cancel
+
+    def write(self, data):
+        with self.scheduler.write_lock:
+            if self.cancel.is_set() or self.segment in self.scheduler.done:
+                raise SegmentCancelled(f"segment {self.segment} was cancelled")
+            return self.file.write(data)
+
+
+# Segments of an earlier partial download whose chunks all match the manifest
+def resumable_segments(part_path, manifest, segment_size):
+    if not os.path.exists(part_path) or os.path.getsize(part_path) != manifest.size:
+        return set()
+
+    good = verified_chunks(part_path, manifest)
+    chunks_per_segment = segment_size // manifest.chunk_size
+    segment_count = (manifest.chunk_count() + chunks_per_segment - 1) // chunks_per_segment
+
+    return {segment for segment in range(segment_count)
+            if all(chunk in good for chunk in range(segment * chunks_per_segment,
+                                                     min((segment + 1) * chunks_per_segment, manifest.chunk_count())))}
+
+
+# Ask peers for the file size with an empty range request. Returns the size or None.
+def probe_size(filename, peers):
+    for peer_ip, peer_port in peers:
+        try:
+            size, _, _ = fetch_range(peer_ip, peer_port, filename, 0, 0, None)
+            return size
+        except (OSError, TransferError, ValueError):
+            continue
+    return None
+
+
+# Download loop for one peer: fetch segments into the shared output file until none are left. With a
+# manifest every chunk is verified as it arrives, and a peer that sends bad data is dropped at once.
+def swarm_worker(scheduler, peer, filename, output_path, size, stats, manifest=None):
+    peer_ip, peer_port = peer
+    buffer = bytearray(RECEIVE_BUFFER_SIZE)
+    failures = 0
+
+    with open(output_path, "r+b") as file:
+        while failures < PEER_MAX_FAILURES:
+            assignment = scheduler.next_segment(peer)
+            if assignment is None:
+                return
+
+            segment, cancel = assignment
+            offset, length = scheduler.segments[segment]
+            start = time.perf_counter()
+
+            try:
+                file.seek(offset)
+                output = SegmentWriter(file, scheduler, segment, cancel)
+                output = output if manifest is None else VerifyingWriter(output, manifest, offset)
+                peer_size, served_offset, written = fetch_range(peer_ip, peer_port, filename, offset, length, output,
+                                                                buffer, cancel)
+                file.flush()
+                ok = peer_size == size and served_offset == offset and written == length
+
+            except ChunkMismatch as e:
+                print(f"Rejected data from {peer_ip}:{peer_port}: {e}")
+                scheduler.reject(segment, peer)
+                return
+
+            except (OSError, TransferError, ValueError):
+                ok = False
+
+            if ok:
+                scheduler.complete(segment, peer, time.perf_counter() - start)
+                stats[peer] = stats.get(peer, 0) + length
+
+            elif cancel.is_set():
+                continue  # Another peer finished this segment first
+
+            else:
+                failures += 1
+                scheduler.fail(segment, peer)
+
+
+# Run one worker per peer until the scheduler has no segments left for them
+def run_swarm(scheduler, peers, filename, part_path, size, stats, manifest):
+    workers = [threading.Thread(target=swarm_worker, args=(scheduler, peer, filename, part_path, size, stats, manifest),
+                                daemon=True)
+               for peer in peers]
+
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+# Download a file in segments from several peers at once, assembling it in place in
+# <filename>.part. Returns True once every segment has arrived and the file is renamed.
+# With a manifest, segments are whole chunks, every chunk is verified on arrival, and segments
+# already verified in a .part file left by an earlier attempt are kept instead of fetched again.
+# The whole file is checked once more before the rename; segments that fail (overwritten by a
+# peer whose bad data was caught too late) are fetched again from the peers not rejected.
+def swarm_download(filename, peers, size=None, manifest=None):
+    peers = peers[:MAX_SWARM_PEERS]
+    part_path = f"{filename}.part"
+    start = time.perf_counter()
+    segment_size = SEGMENT_SIZE
+    done = set()
+
+    if manifest is not None:
+        size = manifest.size
+        segment_size = max(1, SEGMENT_SIZE // manifest.chunk_size) * manifest.chunk_size
+        done = resumable_segments(part_path, manifest, segment_size)
+
+    size = probe_size(filename, peers) if size is None else size
+    if size is None:
+        print(f"No peer could serve {filename}.")
+        return False
+
+    # Reserve the whole file up front so segments can be written at their offsets
+    if not done:
+        with open(part_path, "wb") as file:
+            if size and hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(file.fileno(), 0, size)
+            else:
+                file.truncate(size)
+
+    scheduler = SegmentScheduler(size, segment_size, done)
+    stats = {}                                                                      # Format: {(ip, port): bytes delivered}
+
+    for _ in range(MAX_VERIFY_ROUNDS):
+        run_swarm(scheduler, [peer for peer in peers if peer not in scheduler.rejected], filename, part_path, size,
+                  stats, manifest)
+        if not scheduler.finished() or manifest is None:
+            break
+
+        bad = set(range(len(scheduler.segments))) - resumable_segments(part_path, manifest, segment_size)
+        if not bad:
+            break
+
+        print(f"{len(bad)} segments of {filename} do not match the manifest - fetching them again.")
+        scheduler.requeue(bad)                                                      # Left unfinished if this was the last round
+
+    if not scheduler.finished():
+        # Without a manifest the output has holes that cannot be told apart from data, so it is not kept
+        if manifest is None:
+            os.remove(part_path)
+        print(f"Download of {filename} failed - not enough peers could serve it.")
+        return False
+
+    os.replace(part_path, filename)
+    print(f"{filename} downloaded successfully from {len(stats)} peers ({describe_transfer(size, time.perf_counter() - start)}).")
+    for (peer_ip, peer_port), delivered in sorted(stats.items(), key=lambda item: -item[1]):
+        print(f"  {peer_ip}:{peer_port} sent {delivered} bytes")
+
+    return True
@@ -0,0 +1,371 @@
+import os
+import socket
+import threading
+import time
+import zlib
+from collections import deque
+
+# Use kernel zero-copy (sendfile) for uploads unless ZERO_COPY=0
+ZERO_COPY = os.getenv("ZERO_COPY", "1") != "0"
+
+# Buffer size for the copy loop used when zero-copy is unavailable
+COPY_BUFFER_SIZE = 256 * 1024
+
+# Bytes per send call when an upload is metered, so throughput is sampled during long uploads
+METER_SLICE = 4 * 1024 * 1024
+
+# Size of the reusable buffer downloads receive into
+RECEIVE_BUFFER_SIZE = 1024 * 1024
+
+# Longest request or response header line accepted on a transfer connection
+MAX_HEADER_SIZE = 4096
+
+# Seconds a transfer connection may sit idle before it is treated as interrupted
+TRANSFER_TIMEOUT = 30
+
+# Encodings offered when downloading; TRANSFER_COMPRESSION=none asks peers for raw bytes only
+TRANSFER_ENCODINGS = () if os.getenv("TRANSFER_COMPRESSION", "zlib") == "none" else ("zlib",)
+
+# zlib level of compressed uploads - the fastest level still shrinks text and logs several times over
+COMPRESSION_LEVEL = int(os.getenv("COMPRESSION_LEVEL", "1"))
+
+# Before compressing a range, this many bytes are compressed from each of a few spots across it...
+COMPRESSION_SAMPLE_SIZE = 64 * 1024
+COMPRESSION_SAMPLES = 3
+
+# ...and the range is only compressed if the samples shrank to at most this fraction of their size
+MAX_COMPRESSION_RATIO = 0.9
+
+# Seconds a peer found not to understand DOWNLOAD_RANGE_ENC is sent plain range requests before compression is offered again
+PLAIN_PEER_TTL = float(os.getenv("PLAIN_PEER_TTL", "600"))
+
+
+# Copy count bytes (or to end of file) from an open binary file to a socket through one reusable buffer
+def copy_file_buffered(conn, file, offset=0, count=None):
+    file.seek(offset)
+    buffer = bytearray(COPY_BUFFER_SIZE)
+    view = memoryview(buffer)
+    sent = 0
+
+    while count is None or sent < count:
+        wanted = COPY_BUFFER_SIZE if count is None else min(COPY_BUFFER_SIZE, count - sent)
+        read = file.readinto(view[:wanted])
+        if not read:
+            break
+
+        conn.sendall(view[:read])
+        sent += read
+
+    return sent
+
+
+# Stream count bytes (or to end of file) from an open binary file to a socket. The data goes
+# through os.sendfile, so it is copied from the page cache to the socket inside the kernel; the
+# buffered loop is used where sendfile is unavailable or disabled. With a meter the file is sent
+# in METER_SLICE pieces and each one is recorded. Returns the bytes sent.
+def stream_file(conn, file, offset=0, count=None, meter=None):
+    send = conn.sendfile if ZERO_COPY and hasattr(os, "sendfile") else (
+        lambda file, offset, count: copy_file_buffered(conn, file, offset, count))
+
+    if meter is None:
+        return send(file, offset, count)
+
+    sent = 0
+    while count is None or sent < count:
+        wanted = METER_SLICE if count is None else min(METER_SLICE, count - sent)
+        piece = send(file, offset + sent, wanted)
+        if not piece:
+            break
+
+        sent += piece
+        meter.add(piece)
+
+    return sent
+
+
+# Compress count bytes of an open binary file from offset and stream them to a socket, one buffer
+# at a time, so memory stays bounded whatever the file size. The meter records bytes as sent on the
+# wire. Returns the bytes of the file sent.
+def stream_compressed(conn, file, offset, count, meter=None):
+    compressor = zlib.compressobj(COMPRESSION_LEVEL)
+    buffer = bytearray(COPY_BUFFER_SIZE)
+    view = memoryview(buffer)
+    file.seek(offset)
+    sent = 0
+
+    while sent < count:
+        read = file.readinto(view[:min(COPY_BUFFER_SIZE, count - sent)])
+        if not read:
+            break
+
+        sent += read
+        send_counted(conn, compressor.compress(view[:read]), meter)
+
+    send_counted(conn, compressor.flush(), meter)
+    return sent
+
+
+def send_counted(conn, data, meter):
+    if data:
+        conn.sendall(data)
+        if meter is not None:
+            meter.add(len(data))
+
+
+# Whether a range is worth compressing: samples from its start, middle and end are compressed, and
+# content that is already compressed (archives, media) barely shrinks and is sent as it is
+def worth_compressing(file, offset, count):
+    step = max(count - COMPRESSION_SAMPLE_SIZE, 0) // (COMPRESSION_SAMPLES - 1)
+    raw = compressed = 0
+
+    for spot in sorted({offset + index * step for index in range(COMPRESSION_SAMPLES)}):
+        file.seek(spot)
+        sample = file.read(min(COMPRESSION_SAMPLE_SIZE, count))
+        raw += len(sample)
+        compressed += len(zlib.compress(sample, COMPRESSION_LEVEL))
+
+    return raw > 0 and compressed <= raw * MAX_COMPRESSION_RATIO
+
+
+# Counts active uploads and the bytes sent over a sliding window, so a peer can report its
+# upload load and free bandwidth to the server in heartbeats
+class UploadMeter:
+    def __init__(self, window=5.0):
+        self.window = window
+        self.active = 0
+        self._samples = deque()                                                     # Format: [(monotonic time, bytes), ...]
+        self._lock = threading.Lock()
+
+    def started(self):
+        with self._lock:
+            self.active += 1
+
+    def finished(self):
+        with self._lock:
+            self.active -= 1
+
+    def add(self, byte_count):
+        with self._lock:
+            self._samples.append((time.monotonic(), byte_count))
+
+    # Upload rate over the window in bytes per second
+    def rate(self):
+        cutoff = time.monotonic() - self.window
+
+        with self._lock:
+            while self._samples and self._samples[0][0] < cutoff:
+                self._samples.popleft()
+            return sum(byte_count for _, byte_count in self._samples) / self.window
+
+
+# Human readable summary of a finished transfer
+def describe_transfer(byte_count, elapsed):
+    rate = byte_count / elapsed / (1024 * 1024) if elapsed > 0 else float("inf")
+    return f"{byte_count} bytes in {elapsed:.2f}s ({rate:.1f} MB/s)"
+
+
+
+# Range transfer protocol (one request per TCP connection):
+#   request:  DOWNLOAD_RANGE <offset> <length or -> <filename>\n
+#   response: FILE_OK <file size> <offset> <length>\n followed by exactly <length> bytes of the file
+#             FILE_ERR <reason>\n if the file cannot be served
+# The length header is the end-of-transfer signal: the download is complete when <length> bytes
+# have arrived, and the connection closing before that means the transfer was interrupted.
+#
+# A downloader that can decompress offers its encodings, comma-separated:
+#   request:  DOWNLOAD_RANGE_ENC <encodings> <offset> <length or -> <filename>\n
+#   response: FILE_OK <file size> <offset> <length> <encoding>\n followed by the range in that encoding
+# The encoding is "identity" (raw bytes, as above) or "zlib": one zlib stream that decompresses to
+# the <length> bytes. Peers that predate the request close the connection without a header, and
+# the downloader then falls back to DOWNLOAD_RANGE.
+# The legacy "DOWNLOAD <filename>" request (no newline, whole file, ends at close) is still served.
+
+
+# Raised when a peer refuses a range request or breaks the protocol
+class TransferError(Exception):
+    pass
+
+
+# Read one "\n"-terminated header line. Returns (line, bytes received after it).
+def read_header(conn, initial=b""):
+    data = initial
+
+    while b"\n" not in data:
+        if len(data) > MAX_HEADER_SIZE:
+            raise TransferError("header too long")
+
+        chunk = conn.recv(MAX_HEADER_SIZE)
+        if not chunk:
+            raise TransferError("connection closed before header")
+        data += chunk
+
+    line, rest = data.split(b"\n", 1)
+    return line.decode(), rest
+
+
+# Parse "DOWNLOAD_RANGE <offset> <length or -> <filename>" into (filename, offset, length or None)
+def parse_range_request(line):
+    _, offset, length, filename = line.split(" ", 3)
+    return filename, int(offset), None if length == "-" else int(length)
+
+
+# Parse "DOWNLOAD_RANGE_ENC <encodings> <offset> <length or -> <filename>" into (filename, offset, length or None, [encoding, ...])
+def parse_encoded_range_request(line):
+    _, encodings, offset, length, filename = line.split(" ", 4)
+    return filename, int(offset), None if length == "-" else int(length), encodings.split(",")
+
+
+# Serve one range request: header, then the requested bytes. With encodings (the downloader's
+# DOWNLOAD_RANGE_ENC offer) the range is compressed when "zlib" is offered and the data shrinks,
+# and the header names the encoding used. Returns the number of bytes of the file sent.
+def serve_range(conn, filename, offset, length, meter=None, encodings=None):
+    try:
+        file = open(filename, "rb")
+    except OSError:
+        conn.sendall(b"FILE_ERR not_found\n")
+        return 0
+
+    with file:
+        size = os.fstat(file.fileno()).st_size
+        offset = min(offset, size)
+        length = size - offset if length is None else min(length, size - offset)
+
+        if encodings is None:
+            conn.sendall(f"FILE_OK {size} {offset} {length}\n".encode())
+            return stream_file(conn, file, offset, length, meter) if length else 0
+
+        if length and "zlib" in encodings and worth_compressing(file, offset, length):
+            conn.sendall(f"FILE_OK {size} {offset} {length} zlib\n".encode())
+            return stream_compressed(conn, file, offset, length, meter)
+
+        conn.sendall(f"FILE_OK {size} {offset} {length} identity\n".encode())
+        return stream_file(conn, file, offset, length, meter) if length else 0
+
+
+# Peers found not to understand DOWNLOAD_RANGE_ENC, mapped to the time.monotonic() until which they are sent plain range requests
+plain_peers = {}
+
+
+# Whether a peer is still marked as not understanding DOWNLOAD_RANGE_ENC; an expired mark is dropped
+def is_plain_peer(peer):
+    until = plain_peers.get(peer)
+    if until is not None and until <= time.monotonic():
+        plain_peers.pop(peer, None)
+        return False
+    return until is not None
+
+
+# Fetch a byte range of a peer's file and write it to an open binary file at its current position.
+# Data is received with recv_into a single reusable buffer instead of a new bytes object per call.
+# Returns (file size, offset served, bytes written); fewer bytes than requested means the transfer
+# was interrupted (or cancelled through the optional event) and can be resumed from offset + bytes written.
+# The encodings are offered to the peer, which may send the range compressed; what is written is
+# always the file's own bytes. A peer that closes the connection without answering the offer is asked
+# again with a plain request, and only if that one is answered is it marked for PLAIN_PEER_TTL seconds;
+# a connection dropped for any other reason fails the fetch as before.
+def fetch_range(peer_ip, peer_port, filename, offset, length, file, buffer=None, cancel=None, encodings=TRANSFER_ENCODINGS):
+    peer = (peer_ip, peer_port)
+    if not encodings or is_plain_peer(peer):
+        return _fetch_range(peer_ip, peer_port, filename, offset, length, file, buffer, cancel, None)
+
+    try:
+        return _fetch_range(peer_ip, peer_port, filename, offset, length, file, buffer, cancel, encodings)
+    except TransferError as e:
+        if str(e) != "connection closed before header":
+            raise
+
+    result = _fetch_range(peer_ip, peer_port, filename, offset, length, file, buffer, cancel, None)
+    plain_peers[peer] = time.monotonic() + PLAIN_PEER_TTL
+    return result
+
+
+def _fetch_range(peer_ip, peer_port, filename, offset, length, file, buffer, cancel, encodings):
+    buffer = bytearray(RECEIVE_BUFFER_SIZE) if buffer is None else buffer
+    view = memoryview(buffer)
+    length_field = "-" if length is None else length
+
+    with socket.create_connection((peer_ip, peer_port), timeout=TRANSFER_TIMEOUT) as conn:
+        if encodings:
+            conn.sendall(f"DOWNLOAD_RANGE_ENC {','.join(encodings)} {offset} {length_field} {filename}\n".encode())
+        else:
+            conn.sendall(f"DOWNLOAD_RANGE {offset} {length_field} {filename}\n".encode())
+
+        header, rest = read_header(conn)
+        if not header.startswith("FILE_OK "):
+            raise TransferError(header or "no response")
+
+        fields = header.split(" ")
+        size, served_offset, remaining = int(fields[1]), int(fields[2]), int(fields[3])
+        encoding = fields[4] if len(fields) > 4 else "identity"
+
+        if encoding == "zlib":
+            return size, served_offset, receive_compressed(conn, rest, remaining, file, view, cancel)
+        if encoding != "identity":
+            raise TransferError(f"unknown encoding {encoding}")
+
+        # Bytes that arrived together with the header
+        rest = rest[:remaining]
+        if rest:
+            file.write(rest)
+        written = len(rest)
+        remaining -= written
+
+        try:
+            while remaining > 0 and not (cancel and cancel.is_set()):
+                received = conn.recv_into(view[:min(remaining, len(view))])
+                if not received:
+                    break  # Interrupted - the caller can resume from here
+
+                file.write(view[:received])
+                written += received
+                remaining -= received
+
+        except OSError:
+            pass  # Timeouts and resets are interruptions too
+
+    return size, served_offset, written
+
+
+# Receive a zlib-compressed range and write it decompressed, never holding more than one buffer of
+# output at a time. Returns the bytes written; a stream cut short leaves a valid prefix to resume from.
+def receive_compressed(conn, rest, remaining, file, view, cancel=None):
+    decompressor = zlib.decompressobj()
+    written = 0
+
+    try:
+        written += write_decompressed(decompressor, rest, file, len(view), remaining)
+
+        while not decompressor.eof and not (cancel and cancel.is_set()):
+            received = conn.recv_into(view)
+            if not received:
+                break  # Interrupted - the caller can resume from here
+
+            written += write_decompressed(decompressor, view[:received], file, len(view), remaining - written)
+
+    except OSError:
+        pass  # Timeouts and resets are interruptions too
+
+    except zlib.error as e:
+        raise TransferError(f"corrupt compressed data: {e}")
+
+    return written
+
+
+# Decompress data into file in pieces of at most limit bytes, until the decompressor has nothing
+# more to give for it. Returns the bytes written.
+def write_decompressed(decompressor, data, file, limit, remaining):
+    written = 0
+
+    while not decompressor.eof:
+        output = decompressor.decompress(data, limit)
+        if not output:
+            break
+
+        written += len(output)
+        if written > remaining:
+            raise TransferError("peer sent more data than announced")
+
+        file.write(output)
+        data = decompressor.unconsumed_tail
+
+    return written
@@ -0,0 +1,212 @@
+import struct
+
+# Binary framing for client-server datagrams, offered by the client in AUTHX and used once the
+# server accepts it. A frame is one fixed-size block, then the variable-length data:
+#   fixed:   magic (0xB7), version, opcode, request id (uint32, 0 = untagged), then per field of
+#            the opcode's schema: s = uint16 byte length of a UTF-8 string, H = uint16, I = uint32,
+#            L = uint16 byte length of a list of UTF-8 strings joined by NUL
+#   data:    the bytes of the s and L fields, in schema order
+# Strings are length-prefixed, so filenames containing spaces or ", " survive the trip (NUL cannot
+# occur in a filename). Because every length and integer sits at a fixed offset, a frame is
+# unpacked with a single precompiled struct, by straight-line code generated per schema (a loop
+# over the fields costs more than str.split does on a text request). 0xB7 is never the first byte of a UTF-8
+# text request, so the server tells the two protocols apart per datagram and keeps answering text
+# requests from older clients in text.
+
+# Name under which the binary protocol is negotiated
+PROTOCOL = "bin1"
+
+# Capability offered in AUTHX by clients that renew their lease at the interval the server grants
+LEASE_CAPABILITY = "lease"
+
+MAGIC = 0xB7
+VERSION = 1
+HEADER = "!BBBI"
+
+# next_cursor value of the last page of a list
+NO_CURSOR = 0xFFFFFFFF
+
+# Commands that take a trailing (cursor, page_size) and answer with list pages
+PAGED_COMMANDS = {"ACTIVE_PEERS", "LIST_FILES", "SEARCH_FILES", "QUERY_PEERS", "QUERY_HASH", "STATS"}
+
+# Format: {command: (opcode, schema)}
+REQUESTS = {
+    "HEARTBEAT": (0x02, "sHI"),                                                     # username, active uploads, free KB/s
+    "ACTIVE_PEERS": (0x03, "sIH"),                                                  # username, cursor, page size
+    "PUBLISH": (0x04, "ssHs"),                                                      # username, filename, tcp port, content hash or ""
+    "UNPUBLISH": (0x05, "ssH"),                                                     # username, filename, tcp port
+    "LIST_FILES": (0x06, "sIH"),                                                    # username, cursor, page size
+    "SEARCH_FILES": (0x07, "ssIH"),                                                 # substring, username, cursor, page size
+    "QUERY_FILE": (0x08, "ss"),                                                     # filename, username
+    "QUERY_PEERS": (0x09, "ssIH"),                                                  # filename, username, cursor, page size
+    "PUBLISH_BATCH": (0x0A, "sHLL"),                                                # username, tcp port, content hashes ("" if unknown), filenames
+    "UNPUBLISH_BATCH": (0x0B, "sHL"),                                               # username, tcp port, filenames
+    "QUERY_CONTENT": (0x0C, "ss"),                                                  # filename, username
+    "QUERY_HASH": (0x0D, "ssIH"),                                                   # content hash, username, cursor, page size
+    "STATS": (0x0E, "sIH"),                                                         # username, cursor, page size
+}
+
+# List pages: seq, pages, total items, next cursor, items
+PAGE_SCHEMA = "HHIIL"
+
+# Format: {reply key: (opcode, schema)}
+REPLIES = {
+    "ACTIVE_PEERS": (0x81, PAGE_SCHEMA),
+    "ACTIVE_PEERS_FAIL": (0x82, ""),
+    "PUB_SUCCESS": (0x83, ""),
+    "PUB_FAIL": (0x84, ""),
+    "UNPUB_SUCCESS": (0x85, ""),
+    "UNPUB_FAIL": (0x86, ""),
+    "PUBLISHED_FILES": (0x87, PAGE_SCHEMA),
+    "FAIL_PUBLISHED_FILES": (0x88, ""),
+    "FOUND_FILES": (0x89, PAGE_SCHEMA),
+    "FAIL_FOUND_FILES": (0x8A, ""),
+    "QUERY_SUCCESS": (0x8B, "sH"),                                                  # peer ip, peer tcp port
+    "QUERY_FAIL": (0x8C, ""),
+    "FILE_PEERS": (0x8D, PAGE_SCHEMA),
+    "PUB_BATCH": (0x8E, "s"),                                                       # "1" or "0" per file, in request order
+    "UNPUB_BATCH": (0x8F, "s"),
+    "CONTENT": (0x90, "s"),                                                         # content hash, "" if the publishers sent none
+    "STATS": (0x91, PAGE_SCHEMA),                                                   # "name=value" items
+    "STATS_FAIL": (0x92, ""),
+}
+
+# Reply keys whose payload is a list of items, sent as pages
+LIST_REPLIES = {key for key, (_, schema) in REPLIES.items() if schema == PAGE_SCHEMA}
+
+
+
+# Build the encoder and decoder for a schema. The fixed block holds the header and one length or
+# integer per field; the functions are generated as source, the way collections.namedtuple does,
+# so encoding and decoding a frame is a single struct call plus slicing with no per-field loop.
+#   encode(opcode, request_id, fields) -> bytes
+#   decode(data) -> (request id, [field, ...]); raises struct.error or ValueError if malformed
+def _compile(schema):
+    layout = struct.Struct(HEADER + "".join("I" if code == "I" else "H" for code in schema))
+    names = [f"f{index}" for index in range(len(schema))]
+
+    encode = [f"def encode(opcode, request_id, fields):",
+              f"    {''.join(name + ', ' for name in names)}= fields" if names else ""]
+    fixed, data = [], []
+    for code, name in zip(schema, names):
+        if code == "s":
+            encode.append(f"    {name} = {name}.encode()")
+        elif code == "L":
+            encode.append(f"    {name} = '\\0'.join({name}).encode()")
+        else:
+            fixed.append(name)
+            continue
+        fixed.append(f"len({name})")
+        data.append(name)
+    encode.append(f"    return pack(MAGIC, VERSION, opcode, request_id, {', '.join(fixed)})"
+                  + "".join(f" + {name}" for name in data))
+
+    decode = [f"def decode(data):",
+              f"    _, _, _, request_id, {''.join(name + ', ' for name in names)}= unpack_from(data)",
+              f"    position = {layout.size}"]
+    values = []
+    for code, name in zip(schema, names):
+        if code == "I" or code == "H":
+            values.append(name)
+            continue
+        decode.append(f"    start, position = position, position + {name}")
+        value = "str(data[start:position], 'utf-8')"
+        decode.append(f"    {name} = {value}" if code == "s" else f"    {name} = {value}.split('\\0') if {name} else []")
+        values.append(name)
+    decode.append(f"    if position != len(data):")
+    decode.append(f"        raise ValueError('frame length does not match its fields')")
+    decode.append(f"    return request_id, [{', '.join(values)}]")
+
+    namespace = {"pack": layout.pack, "unpack_from": layout.unpack_from, "MAGIC": MAGIC, "VERSION": VERSION}
+    exec("\n".join(encode + decode), namespace)
+    return namespace["encode"], namespace["decode"]
+
+
+_CODECS = {schema: _compile(schema) for _, schema in [*REQUESTS.values(), *REPLIES.values()]}
+_REQUEST_OPCODES = {opcode: (command, _CODECS[schema][1]) for command, (opcode, schema) in REQUESTS.items()}
+_REPLY_OPCODES = {opcode: (key, _CODECS[schema][1]) for key, (opcode, schema) in REPLIES.items()}
+
+
+# True if a datagram is a binary frame rather than a text request
+def is_binary(data):
+    return len(data) > 0 and data[0] == MAGIC
+
+
+def encode_request(request_id, command, fields):
+    opcode, schema = REQUESTS[command]
+    return _encode(opcode, request_id, schema, fields)
+
+
+def encode_reply(request_id, key, fields):
+    opcode, schema = REPLIES[key]
+    return _encode(opcode, request_id, schema, fields)
+
+
+# Decode a request frame into (request id, command, fields). Raises ValueError if it is malformed.
+def decode_request(data):
+    command, request_id, fields = _decode(data, _REQUEST_OPCODES)
+    return request_id, command, fields
+
+
+# Decode a reply frame into (request id, (key, *fields)), the same shape parse_text_reply produces
+def decode_reply(data):
+    key, request_id, fields = _decode(data, _REPLY_OPCODES)
+    if key in LIST_REPLIES and fields[3] == NO_CURSOR:
+        fields[3] = None
+    return request_id, (key, *fields)
+
+
+# Text form of a request - paged commands carry their cursor and page size as "PAGE <cursor> <page_size>",
+# and list fields (batch filenames) are newline-separated
+def format_text_request(command, fields):
+    fields = ["\n".join(field) if isinstance(field, list) else str(field) for field in fields]
+    if command in PAGED_COMMANDS:
+        fields.insert(len(fields) - 2, "PAGE")
+    return " ".join([command, *fields])
+
+
+# Parse a text reply into (key, *fields): list pages become (key, seq, pages, total, next cursor or None, items),
+# QUERY_SUCCESS becomes (key, ip, port), AUTH_SUCCESS carries a {setting: value} dict, batch replies carry their
+# per-file results, CONTENT its hash and anything else is (key,)
+def parse_text_reply(text):
+    key, _, rest = text.partition(" ")
+
+    if rest.startswith("PAGE "):
+        fields = rest[5:].split(" ", 4)
+        return (key, int(fields[0]), int(fields[1]), int(fields[2]), None if fields[3] == "-" else int(fields[3]),
+                fields[4].split(", ") if len(fields) == 5 else [])
+
+    if key == "QUERY_SUCCESS":
+        peer_ip, peer_port = rest.split(" ")
+        return key, peer_ip, int(peer_port)
+
+    if key == "PUB_BATCH" or key == "UNPUB_BATCH" or key == "CONTENT":
+        return key, rest
+
+    if key == "AUTH_SUCCESS":
+        return key, dict(setting.split("=", 1) for setting in rest.split())
+
+    return (key,)
+
+
+def _encode(opcode, request_id, schema, fields):
+    if len(fields) != len(schema):
+        raise ValueError(f"expected {len(schema)} fields, got {len(fields)}")
+    return _CODECS[schema][0](opcode, request_id, fields)
+
+
+# Returns (command or reply key, request id, fields)
+def _decode(data, opcodes):
+    if len(data) < 3 or data[1] != VERSION:
+        raise ValueError("unsupported frame version")
+
+    entry = opcodes.get(data[2])
+    if entry is None:
+        raise ValueError(f"unknown opcode {data[2]:#x}")
+
+    try:
+        request_id, fields = entry[1](data)
+    except struct.error:
+        raise ValueError("truncated frame") from None
+
+    return entry[0], request_id, fields